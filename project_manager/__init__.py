@@ -1,9 +1,16 @@
 __version__ = "0.0.0.post63.dev0+eed4ce6"
 
+from project_manager.project_manager import AsyncCommonPSCommands
+from project_manager.project_manager import AsyncCommonPSCommands as ACPSC
+from project_manager.project_manager import AsyncCondaEnvManager
+from project_manager.project_manager import AsyncCondaEnvManager as ACEM
+from project_manager.project_manager import AsyncPoetryProjectManager
+from project_manager.project_manager import AsyncPoetryProjectManager as APPM
 from project_manager.project_manager import CommonPSCommands
 from project_manager.project_manager import CommonPSCommands as CPSC
 from project_manager.project_manager import CondaEnvManager
 from project_manager.project_manager import CondaEnvManager as CEM
+from project_manager.project_manager import CondaShellSessionPool
 from project_manager.project_manager import GitProjectManager
 from project_manager.project_manager import GitProjectManager as GPM
 from project_manager.project_manager import LocalProjectManager
@@ -12,6 +19,7 @@ from project_manager.project_manager import PoetryProjectManager
 from project_manager.project_manager import PoetryProjectManager as PPM
 from project_manager.project_manager import ProjectManager
 from project_manager.project_manager import ProjectManager as PM
+from project_manager.project_manager import ProjectInventoryScanner
 from project_manager.project_manager import SublimeBuildConfigGenerator
 from project_manager.project_manager import SublimeBuildConfigGenerator as SBCG
 
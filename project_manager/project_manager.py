@@ -1,15 +1,33 @@
+import asyncio
+import atexit
+import bisect
+import copy
+import hashlib
 import json
+import math
 import os
 import platform
 import re
+import select
+import selectors
+import shlex
+import shutil
 import subprocess
 import sys
-from collections import defaultdict, deque
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import reduce
 from os import PathLike
 from pathlib import Path, PosixPath
 from subprocess import Popen
-from typing import Any, Dict, List, Union
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, NamedTuple, Union
 
 
 def import_optional_dependency(object_name: str):
@@ -26,6 +44,18 @@ def import_optional_dependency(object_name: str):
     elif object_name == "parse_single_constraint":
         from poetry.core.semver import parse_single_constraint
         mod_to_return = parse_single_constraint
+    elif object_name == "Marker":
+        from packaging.markers import Marker
+        mod_to_return = Marker
+    elif object_name == "Requirement":
+        from packaging.requirements import Requirement
+        mod_to_return = Requirement
+    elif object_name == "toml_loads":
+        try:
+            from tomllib import loads
+        except ImportError:
+            from tomli import loads
+        mod_to_return = loads
     return mod_to_return
 
 
@@ -96,8 +126,9 @@ class ProjectManager:
             "visualstudiocode",
         ]
         gy_cmd = ["gy", "generate"] + git_ignores_to_add
-        p_gy = subprocess.Popen(gy_cmd, stdout=subprocess.PIPE, text=True)
-        output = p_gy.communicate()[0]
+        gy_output = ListSink(streams=("stdout",), strip=False)
+        CommonPSCommands.run_command(gy_cmd, text=True, verbose=False, sinks=[gy_output])
+        output = "".join(f"{l}\n" for l in gy_output.lines)
         return output
 
     @staticmethod
@@ -132,30 +163,21 @@ class PoetryProjectManager:
     @staticmethod
     def search_for_toml_files(filepath: str, toml_pattern: str) -> Path:
         """
-
+        Returns the closest directory (filepath itself, or one of its parents) that contains toml_pattern, see
+        ProjectRootResolver
 
         :param filepath:
         :type filepath: str
         :param toml_pattern:
         :type toml_pattern: str
         :rtype: Path
+        :raises FileNotFoundError: if no directory up to the filesystem root contains toml_pattern
 
         """
-        cur_path = Path(filepath)
-        if cur_path.is_file():
-            if Path(filepath).name == toml_pattern:
-                return Path(filepath).parent
-            else:
-                return PoetryProjectManager.search_for_toml_files(
-                    cur_path.parent.as_posix(), toml_pattern
-                )
-        if cur_path.is_dir():
-            if toml_pattern in os.listdir(filepath):
-                return cur_path
-            else:
-                return PoetryProjectManager.search_for_toml_files(
-                    cur_path.parent.as_posix(), toml_pattern
-                )
+        project_root = ProjectRootResolver.resolve(filepath, toml_pattern)
+        if project_root is None:
+            raise FileNotFoundError(f"Unable to find {toml_pattern!r} in {filepath!r} or any of its parents")
+        return project_root
 
     @staticmethod
     def get_poetry_project_dir(
@@ -262,7 +284,7 @@ class PoetryProjectManager:
         """
         assert isinstance(except_obj, ModuleNotFoundError)
         dependency = PoetryProjectManager.get_missing_poetry_dependency(
-            except_obj, ignore_verion=ignore_verion
+            except_obj, ignore_verion=ignore_verion, file_importing_from=file_importing_from
         )
         break_stmnt = input(f"poetry add {dependency}? [q to break]")
         if break_stmnt.lower() == "q":
@@ -317,12 +339,308 @@ class PoetryProjectManager:
                 cur_dependencies[cur_name] = ""
         return cur_dependencies
 
+    @staticmethod
+    def get_bulk_add_spec(dependency_name: str, dependency_val: Union[str, Dict[str, Any]] = "") -> str:
+        """
+        Turns a dependency (as returned by format_deps_from_reqs_txt or read from a pyproject.toml section) into a
+        single `poetry add` argument, keeping its pin
+
+        :param dependency_name:
+        :type dependency_name: str
+        :param dependency_val: e.g. "==1.2.3", "^1.2", "*", a git requirement line or a toml inline table
+            (Default value = "")
+        :type dependency_val: Union[str, Dict[str, Any]]
+        :rtype: str
+
+        """
+        if isinstance(dependency_val, Mapping):
+            if dependency_val.get("git"):
+                git_url = dependency_val["git"]
+                if ("://" in git_url) and not git_url.startswith("git+"):
+                    git_url = f"git+{git_url}"
+                ref = next((dependency_val[k] for k in ("rev", "tag", "branch") if dependency_val.get(k)), "")
+                return f"{git_url}@{ref}" if ref else git_url
+            if dependency_val.get("path"):
+                return str(dependency_val["path"])
+            if dependency_val.get("url"):
+                return str(dependency_val["url"])
+            dependency_val = dependency_val.get("version", "")
+        dependency_val = str(dependency_val or "").strip().strip('"').strip("'")
+        if dependency_val in ("", "*"):
+            return dependency_name
+        if ("://" in dependency_val) or dependency_val.startswith("git+"):
+            return dependency_val
+        if dependency_val[0] in "^~" and not dependency_val.startswith("~="):
+            return f"{dependency_name}@{dependency_val}"
+        if dependency_val[0] in "=<>!~":
+            return f"{dependency_name}{dependency_val}"
+        return f"{dependency_name}=={dependency_val}"
+
+    @staticmethod
+    def bisect_add_dependencies(
+            dir_containing_pyproject_toml: str,
+            poetry_proj_conda_env_name: str,
+            dependency_specs: Dict[str, str],
+            options: str = "",
+    ) -> List[str]:
+        """
+        Adds dependency_specs with a single `poetry add` and, when that transaction fails, splits the batch in half and
+        recurses. Batches that resolve are kept (poetry rolls back a failed add, so pyproject.toml only ever holds
+        batches that resolved), so k offending requirements out of n cost O(k log n) resolutions instead of n.
+
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :param dependency_specs: dependency name -> `poetry add` argument
+        :type dependency_specs: Dict[str, str]
+        :param options: e.g. "-D"  (Default value = "")
+        :type options: str
+        :returns: the names of the dependencies that could not be added
+        :rtype: List[str]
+
+        """
+        names = list(dependency_specs)
+        if not names:
+            return []
+        specs = " ".join(
+            PoetryProjectManager.wrap_dep_in_quotes(dependency_specs[n], wrap_in_quotes=True) for n in names
+        )
+        poetry_cmd = PoetryProjectManager.create_poetry_cmd_for_dep(specs, options=options, method="add")
+        rc = PoetryProjectManager.execute_poetry_cmd(
+            poetry_cmd, dir_containing_pyproject_toml, poetry_proj_conda_env_name
+        )
+        if rc == 0:
+            return []
+        if len(names) == 1:
+            return names
+        mid = len(names) // 2
+        failed = []
+        for half in (names[:mid], names[mid:]):
+            failed += PoetryProjectManager.bisect_add_dependencies(
+                dir_containing_pyproject_toml,
+                poetry_proj_conda_env_name,
+                {n: dependency_specs[n] for n in half},
+                options=options,
+            )
+        return failed
+
+    @staticmethod
+    def add_dependencies_in_bulk(
+            dir_containing_pyproject_toml: str,
+            poetry_proj_conda_env_name: str,
+            dependencies: Dict[str, Union[str, Dict[str, Any]]],
+            options: str = "",
+    ) -> Dict[str, str]:
+        """
+        Adds every dependency (pinned) in one poetry transaction, isolating the ones that break the resolution with
+        bisect_add_dependencies and retrying those unpinned
+
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :param dependencies: dependency name -> pin, as returned by format_deps_from_reqs_txt
+        :type dependencies: Dict[str, Union[str, Dict[str, Any]]]
+        :param options: e.g. "-D"  (Default value = "")
+        :type options: str
+        :returns: dependency name -> "added" (as pinned), "unpinned" or "failed"
+        :rtype: Dict[str, str]
+
+        """
+        pinned_specs = {
+            name: PoetryProjectManager.get_bulk_add_spec(name, val)
+            for name, val in dependencies.items()
+            if name.lower() != "python"
+        }
+        status = {name: "added" for name in pinned_specs}
+        failed = PoetryProjectManager.bisect_add_dependencies(
+            dir_containing_pyproject_toml, poetry_proj_conda_env_name, pinned_specs, options=options
+        )
+        unpinned_specs = {name: name for name in failed if pinned_specs[name] != name}
+        still_failed = set(failed) - set(unpinned_specs)
+        if unpinned_specs:
+            print(f"Unable to add {list(unpinned_specs)} with pinned versions\nAttempting to add without pinning")
+            still_failed.update(
+                PoetryProjectManager.bisect_add_dependencies(
+                    dir_containing_pyproject_toml, poetry_proj_conda_env_name, unpinned_specs, options=options
+                )
+            )
+        for name in failed:
+            status[name] = "failed" if name in still_failed else "unpinned"
+        if still_failed:
+            print(f"Unable to add poetry dependencies {sorted(still_failed)}")
+        return status
+
+    @staticmethod
+    def poetry_lock(dir_containing_pyproject_toml: str, poetry_proj_conda_env_name: str, no_update: bool = True) -> int:
+        """
+        Equivalent to poetry lock [--no-update]
+
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :param no_update: keep the versions already locked for untouched dependencies  (Default value = True)
+        :type no_update: bool
+        :rtype: int
+
+        """
+        poetry_cmd = "poetry lock --no-update" if no_update else "poetry lock"
+        return PoetryProjectManager.execute_poetry_cmd(
+            poetry_cmd, dir_containing_pyproject_toml, poetry_proj_conda_env_name
+        )
+
+    @staticmethod
+    def poetry_install(dir_containing_pyproject_toml: str, poetry_proj_conda_env_name: str, options: str = "") -> int:
+        """
+        Equivalent to poetry install {options}
+
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :param options:  (Default value = "")
+        :type options: str
+        :rtype: int
+
+        """
+        poetry_cmd = f"poetry install {options}".strip()
+        return PoetryProjectManager.execute_poetry_cmd(
+            poetry_cmd, dir_containing_pyproject_toml, poetry_proj_conda_env_name
+        )
+
+    @staticmethod
+    def lock_with_cache(dir_containing_pyproject_toml: str, poetry_proj_conda_env_name: str,
+                        no_update: bool = True) -> int:
+        """
+        Drops in the poetry.lock PoetryLockCache has for the same dependencies, or runs poetry_lock and stores the
+        result. Projects PoetryLockCache.get_key can't key are always locked with poetry_lock.
+
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :param no_update: see poetry_lock  (Default value = True)
+        :type no_update: bool
+        :rtype: int
+
+        """
+        pyproject_toml_path = Path(dir_containing_pyproject_toml).joinpath("pyproject.toml")
+        key = PoetryLockCache.get_key(pyproject_toml_path)
+        if key is None:
+            print("Not using the lock cache, some dependencies are develop paths or unpinned git repos")
+            return PoetryProjectManager.poetry_lock(dir_containing_pyproject_toml, poetry_proj_conda_env_name,
+                                                    no_update=no_update)
+        entry_path = PoetryLockCache.lookup(key)
+        if entry_path is not None:
+            PoetryLockCache.restore(entry_path, dir_containing_pyproject_toml)
+            return 0
+        rc = PoetryProjectManager.poetry_lock(dir_containing_pyproject_toml, poetry_proj_conda_env_name,
+                                              no_update=no_update)
+        if rc == 0:
+            PoetryLockCache.store(key, pyproject_toml_path.with_name("poetry.lock"))
+        return rc
+
+    @staticmethod
+    def install_with_lock_cache(dir_containing_pyproject_toml: str, poetry_proj_conda_env_name: str) -> int:
+        """
+        lock_with_cache followed by poetry_install, so a cache hit installs without resolving anything
+
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :rtype: int
+
+        """
+        rc = PoetryProjectManager.lock_with_cache(dir_containing_pyproject_toml, poetry_proj_conda_env_name)
+        if rc != 0:
+            return rc
+        return PoetryProjectManager.poetry_install(dir_containing_pyproject_toml, poetry_proj_conda_env_name)
+
+    @staticmethod
+    def get_lock_cache_stats(verbose: bool = True) -> Dict[str, int]:
+        """
+        Returns (and prints) the hits, misses, stores, evictions and size of PoetryLockCache
+
+        :param verbose:  (Default value = True)
+        :type verbose: bool
+        :rtype: Dict[str, int]
+
+        """
+        stats = PoetryLockCache.stats()
+        if verbose:
+            print(", ".join(f"{k}: {v}" for k, v in stats.items()))
+        return stats
+
+    @staticmethod
+    def add_dependencies_directly(
+            dir_containing_pyproject_toml: str,
+            poetry_proj_conda_env_name: str,
+            dependencies_by_type: Dict[str, Dict[str, Union[str, Dict[str, Any]]]],
+            lock: bool = True,
+            remove_by_type: Dict[str, List[str]] = None,
+            use_lock_cache: bool = False,
+    ) -> int:
+        """
+        Writes every dependency straight into pyproject.toml (see PyprojectTomlEditor), then runs a single
+        `poetry lock --no-update` and `poetry install` instead of one `poetry add` per dependency. pyproject.toml is
+        restored if the lock fails.
+
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :param dependencies_by_type: "dev" or "" -> {dependency name: pin}
+        :type dependencies_by_type: Dict[str, Dict[str, Union[str, Dict[str, Any]]]]
+        :param lock: lock and install after editing  (Default value = True)
+        :type lock: bool
+        :param remove_by_type: "dev" or "" -> dependency names to drop in the same pass  (Default value = None)
+        :type remove_by_type: Dict[str, List[str]]
+        :param use_lock_cache: lock with lock_with_cache  (Default value = False)
+        :type use_lock_cache: bool
+        :rtype: int
+
+        """
+        pyproject_toml_path = Path(dir_containing_pyproject_toml).joinpath("pyproject.toml")
+        with open(pyproject_toml_path, "r") as f:
+            original_contents = f.read()
+        edits = [
+            ("set", dependency_type, name, val)
+            for dependency_type, dependencies in dependencies_by_type.items()
+            for name, val in (dependencies or {}).items()
+            if name.lower() != "python"
+        ]
+        edits += [
+            ("remove", dependency_type, name, None)
+            for dependency_type, names in (remove_by_type or {}).items()
+            for name in names
+        ]
+        PyprojectTomlEditor.apply(edits, pyproject_toml_path)
+        if not lock:
+            return 0
+        if use_lock_cache:
+            rc = PoetryProjectManager.lock_with_cache(dir_containing_pyproject_toml, poetry_proj_conda_env_name)
+        else:
+            rc = PoetryProjectManager.poetry_lock(dir_containing_pyproject_toml, poetry_proj_conda_env_name)
+        if rc != 0:
+            print(f"Unable to lock the dependencies added to {pyproject_toml_path.as_posix()!r}, now restoring it")
+            with open(pyproject_toml_path, "w") as f:
+                f.write(original_contents)
+            return rc
+        rc = PoetryProjectManager.poetry_install(dir_containing_pyproject_toml, poetry_proj_conda_env_name)
+        return rc
+
     @staticmethod
     def add_poetry_package_from_requirements_txt(
             dir_containing_pyproject_toml: str,
             poetry_proj_conda_env_name: str,
             path_to_requirements_txt: str,
             warn_before_add=True,
+            add_mode: str = "each",
+            incremental: bool = False,
+            prune: bool = False,
     ):
         """
 
@@ -336,6 +654,12 @@ class PoetryProjectManager:
         :param try_pinned_versions:  (Default value = False)
         :type try_pinned_versions: bool
         :param warn_before_add:  (Default value = True)
+        :param add_mode: see LocalProjectManager.iterate_and_add_dependencies  (Default value = "each")
+        :type add_mode: str
+        :param incremental: see LocalProjectManager.iterate_and_add_dependencies  (Default value = False)
+        :type incremental: bool
+        :param prune: see LocalProjectManager.iterate_and_add_dependencies  (Default value = False)
+        :type prune: bool
 
         """
         reqs = CommonPSCommands.parse_requirements_txt(path_to_requirements_txt)
@@ -344,7 +668,10 @@ class PoetryProjectManager:
                                                               dest_pyproject_toml_dir=dir_containing_pyproject_toml,
                                                               poetry_proj_conda_env_name=poetry_proj_conda_env_name,
                                                               toml_section_type="",
-                                                              warn_before_add=warn_before_add)
+                                                              warn_before_add=warn_before_add,
+                                                              add_mode=add_mode,
+                                                              incremental=incremental,
+                                                              prune=prune)
         return rc
 
     @staticmethod
@@ -966,27 +1293,32 @@ class PoetryProjectManager:
         return env_name
 
     @staticmethod
-    def get_missing_poetry_dependency(caught_exception, ignore_verion=True):
+    def get_missing_poetry_dependency(caught_exception, ignore_verion=True, file_importing_from: str = None):
         """
-
+        Returns the `poetry add` argument for the module caught_exception failed to import. Unless ignore_verion is
+        True it's pinned to the version in the project's poetry.lock (see PoetryLockIndex), or to the constraint in
+        its pyproject.toml when the lock doesn't have it.
 
         :param caught_exception:
         :param ignore_verion:  (Default value = True)
+        :param file_importing_from: a file of the project, defaults to the file that raised caught_exception
+            (Default value = None)
+        :type file_importing_from: str
 
         """
-        dep_name = caught_exception.name
-        if not ignore_verion:
-            deps = PoetryProjectManager.get_import_error_dependencies_from_imported_py_poetry_proj_file(
-                caught_exception
-            )
-        else:
-            deps = {dep_name: dep_name}
-        if not ignore_verion:
-            dep_version = deps.get(dep_name)
-            dependency = f'{dep_name}=="{dep_version}"'
-        else:
-            dependency = dep_name
-        return dependency
+        dep_name = caught_exception.name.split(".")[0]
+        if ignore_verion:
+            return dep_name
+        if file_importing_from is None:
+            file_importing_from = CommonPSCommands.get_traceback_file_origin(caught_exception)
+        poetry_lock_path = PoetryLockIndex.find_poetry_lock(file_importing_from)
+        package = PoetryLockIndex.get(poetry_lock_path, dep_name) if poetry_lock_path else None
+        if package is not None:
+            return f"{package.name}=={package.version}"
+        deps = PoetryProjectManager.get_poetry_module_dependencies(file_importing_from)
+        canonical_deps = {PyprojectTomlEditor.canonicalize_name(k): v for k, v in deps.items()}
+        dep_version = canonical_deps.get(PyprojectTomlEditor.canonicalize_name(dep_name), "")
+        return PoetryProjectManager.get_bulk_add_spec(dep_name, dep_version)
 
     @staticmethod
     def add_notebook_ipykernel_dependencies_to_pypoetry(
@@ -1025,9 +1357,306 @@ class PoetryProjectManager:
         return rc
 
 
+class CommandResult(NamedTuple):
+    """
+    Structured result of a command that was run through CommonPSCommands.stream_command
+    """
+
+    rc: int
+    duration: float
+    stdout_bytes: int
+    stderr_bytes: int
+    cmd_args: Union[List[str], str]
+
+
+class OutputSink:
+    """
+    Receives decoded lines (without their line terminator) from a running command.
+
+    stream is either "stdout" or "stderr"
+    """
+
+    def write(self, stream: str, line: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class ConsoleSink(OutputSink):
+    """
+    Prints stdout lines to sys.stdout and stderr lines to sys.stderr
+    """
+
+    def write(self, stream: str, line: str) -> None:
+        print(line, file=sys.stderr if stream == "stderr" else sys.stdout)
+
+
+class ListSink(OutputSink):
+    """
+    Collects lines in memory, optionally only for some streams
+    """
+
+    def __init__(self, streams=("stdout", "stderr"), strip: bool = True):
+        self.streams = tuple(streams)
+        self.strip = strip
+        self.lines = []
+
+    def write(self, stream: str, line: str) -> None:
+        if stream in self.streams:
+            self.lines.append(line.strip() if self.strip else line)
+
+
+class FileSink(OutputSink):
+    """
+    Writes lines to a file path (appending) or to an already opened text file object
+    """
+
+    def __init__(self, path_or_file, mode: str = "a"):
+        if hasattr(path_or_file, "write"):
+            self.f = path_or_file
+            self.owns_file = False
+        else:
+            self.f = open(path_or_file, mode)
+            self.owns_file = True
+
+    def write(self, stream: str, line: str) -> None:
+        self.f.write(line + "\n")
+
+    def close(self) -> None:
+        if self.owns_file:
+            self.f.close()
+        else:
+            self.f.flush()
+
+
+class CallbackSink(OutputSink):
+    """
+    Hands every line to a callable with the signature callback(stream, line)
+    """
+
+    def __init__(self, callback: Callable[[str, str], Any]):
+        self.callback = callback
+
+    def write(self, stream: str, line: str) -> None:
+        self.callback(stream, line)
+
+
 class CommonPSCommands:
     """ """
 
+    # "shell" starts a new shell for every chain of commands, "session" reuses a pre-activated shell per conda env and
+    # "direct" runs each command without a shell under the cached environment variables of the activated conda env
+    conda_execution_mode: str = "shell"
+
+    @staticmethod
+    def get_output_sinks(sinks: List[OutputSink] = None, verbose: bool = True, collect_stripped_text: bool = False):
+        """
+        Returns the sinks to stream a command into and the ListSink collecting stripped stdout text
+
+        :param sinks:
+        :param verbose:
+        :param collect_stripped_text:
+
+        """
+        all_sinks = list(sinks or [])
+        if verbose:
+            all_sinks.append(ConsoleSink())
+        text_collected = ListSink(streams=("stdout",))
+        if collect_stripped_text:
+            all_sinks.append(text_collected)
+        return all_sinks, text_collected
+
+    @staticmethod
+    def format_command_result(
+            result: CommandResult,
+            text_collected: ListSink,
+            verbose: bool = True,
+            collect_stripped_text: bool = False,
+            return_result: bool = False,
+    ):
+        """
+        Reports a finished command and returns what run_command callers expect: the return code, (return code,
+        collected text) or the CommandResult itself
+
+        :param result:
+        :param text_collected:
+        :param verbose:
+        :param collect_stripped_text:
+        :param return_result:
+
+        """
+        if verbose:
+            if result.rc:  # 0s won't be printed
+                print(result.rc)
+            else:
+                print(f"Success!\nFinished running {result.cmd_args}")
+        if return_result:
+            return result
+        if collect_stripped_text:
+            return result.rc, text_collected.lines
+        return result.rc
+
+    @staticmethod
+    def dispatch_line(sinks: List[OutputSink], stream: str, raw_line: bytes):
+        """
+        Decodes a raw line and hands it to every sink
+
+        :param sinks:
+        :param stream: "stdout" or "stderr"
+        :param raw_line:
+        """
+        line = raw_line.decode("utf-8", errors="replace").rstrip("\r\n")
+        for sink in sinks:
+            sink.write(stream, line)
+
+    @staticmethod
+    def pump_with_selector(p: Popen, sinks: List[OutputSink], input_data: bytes = None):
+        """
+        Reads stdout and stderr of p together (and feeds input_data to stdin) without blocking on either pipe
+
+        :param p:
+        :param sinks:
+        :param input_data:
+        :return: byte counts for stdout and stderr
+        """
+        byte_counts = {"stdout": 0, "stderr": 0}
+        partial_lines = {"stdout": b"", "stderr": b""}
+        pending_input = memoryview(input_data) if input_data else None
+        with selectors.DefaultSelector() as sel:
+            for stream in ("stdout", "stderr"):
+                pipe = getattr(p, stream)
+                if pipe is not None:
+                    sel.register(pipe, selectors.EVENT_READ, stream)
+            if p.stdin is not None:
+                if pending_input is None:
+                    p.stdin.close()
+                else:
+                    # a blocking write larger than the free pipe buffer would stall until the child reads it,
+                    # while the child may itself be stalled on a full stdout/stderr pipe we are not draining
+                    os.set_blocking(p.stdin.fileno(), False)
+                    sel.register(p.stdin, selectors.EVENT_WRITE, "stdin")
+            while sel.get_map():
+                for key, _ in sel.select():
+                    stream = key.data
+                    if stream == "stdin":
+                        try:
+                            n_written = os.write(key.fd, pending_input[:select.PIPE_BUF])
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            n_written = len(pending_input)
+                        pending_input = pending_input[n_written:]
+                        if not pending_input:
+                            sel.unregister(key.fileobj)
+                            key.fileobj.close()
+                        continue
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                        if partial_lines[stream]:
+                            CommonPSCommands.dispatch_line(sinks, stream, partial_lines[stream])
+                            partial_lines[stream] = b""
+                        continue
+                    byte_counts[stream] += len(chunk)
+                    *complete_lines, partial_lines[stream] = (partial_lines[stream] + chunk).split(b"\n")
+                    for raw_line in complete_lines:
+                        CommonPSCommands.dispatch_line(sinks, stream, raw_line)
+        return byte_counts["stdout"], byte_counts["stderr"]
+
+    @staticmethod
+    def pump_with_threads(p: Popen, sinks: List[OutputSink], input_data: bytes = None):
+        """
+        Windows can't select on pipes, so stdout and stderr are drained by one reader thread each
+
+        :param p:
+        :param sinks:
+        :param input_data:
+        :return: byte counts for stdout and stderr
+        """
+        byte_counts = {"stdout": 0, "stderr": 0}
+        sink_lock = threading.Lock()
+
+        def drain(stream):
+            pipe = getattr(p, stream)
+            for raw_line in iter(pipe.readline, b""):
+                byte_counts[stream] += len(raw_line)
+                with sink_lock:
+                    CommonPSCommands.dispatch_line(sinks, stream, raw_line)
+            pipe.close()
+
+        readers = [
+            threading.Thread(target=drain, args=(stream,), daemon=True)
+            for stream in ("stdout", "stderr")
+            if getattr(p, stream) is not None
+        ]
+        for reader in readers:
+            reader.start()
+        if p.stdin is not None:
+            try:
+                if input_data:
+                    p.stdin.write(input_data)
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+        for reader in readers:
+            reader.join()
+        return byte_counts["stdout"], byte_counts["stderr"]
+
+    @staticmethod
+    def stream_command(
+            cmd_args: Union[List[str], str],
+            *args,
+            sinks: List[OutputSink] = None,
+            stdin=None,
+            input_data: Union[bytes, str] = None,
+            close_sinks: bool = True,
+            **kwargs
+    ) -> CommandResult:
+        """
+        Runs a command and streams stdout and stderr line by line to sinks while it runs.
+
+        Both pipes are read together, so a chatty stderr can't fill up its pipe and deadlock the child process.
+
+        :param cmd_args:
+        :type cmd_args: Union[str, List[str]]
+        :param *args:
+        :param sinks: (Default value = None) nothing is done with the output if no sinks are given
+        :type sinks: List[OutputSink]
+        :param stdin: (Default value = None) subprocess.PIPE is closed right away unless input_data is given
+        :param input_data: (Default value = None) data written to stdin of the child process
+        :type input_data: Union[bytes, str]
+        :param close_sinks: (Default value = True) close the sinks once the command finished
+        :type close_sinks: bool
+        :param **kwargs: passed to subprocess.Popen
+        :rtype: CommandResult
+
+        """
+        sinks = list(sinks or [])
+        for text_kwarg in ("text", "universal_newlines", "encoding", "errors", "stdout", "stderr"):
+            kwargs.pop(text_kwarg, None)  # output is always read as bytes and decoded per line
+        if isinstance(input_data, str):
+            input_data = input_data.encode()
+        if input_data is not None:
+            stdin = subprocess.PIPE
+        start = time.perf_counter()
+        p = subprocess.Popen(
+            cmd_args, *args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
+        )
+        try:
+            if platform.system() == "Windows":
+                stdout_bytes, stderr_bytes = CommonPSCommands.pump_with_threads(p, sinks, input_data)
+            else:
+                stdout_bytes, stderr_bytes = CommonPSCommands.pump_with_selector(p, sinks, input_data)
+            rc = p.wait()
+        finally:
+            if close_sinks:
+                for sink in sinks:
+                    sink.close()
+        duration = time.perf_counter() - start
+        return CommandResult(rc, duration, stdout_bytes, stderr_bytes, cmd_args)
+
     @staticmethod
     def run_command(
             cmd_args: Union[List[str], str],
@@ -1038,8 +1667,10 @@ class CommonPSCommands:
             return_process=False,
             collect_stripped_text=False,
             verbose=True,
+            sinks: List[OutputSink] = None,
+            return_result=False,
             **kwargs
-    ) -> Union[int, Popen]:
+    ) -> Union[int, Popen, CommandResult]:
         """
 
 
@@ -1052,8 +1683,10 @@ class CommonPSCommands:
         :param return_process:  (Default value = False)
         :param collect_stripped_text:  (Default value = False)
         :param verbose:  (Default value = True)
+        :param sinks: extra sinks that receive the output  (Default value = None)
+        :param return_result: return a CommandResult instead of the return code  (Default value = False)
         :param **kwargs:
-        :rtype: Union[Popen,int]
+        :rtype: Union[Popen,int,CommandResult]
 
         """
         if isinstance(cmd_args, str):
@@ -1065,47 +1698,66 @@ class CommonPSCommands:
                     cmd_args = [cmd_args]
         if collect_stripped_text:
             return_process = False
-        p = subprocess.Popen(
-            cmd_args, *args, stdin=stdin, stdout=stdout, text=text, **kwargs
+        if return_process or (stdout is not subprocess.PIPE):
+            p = subprocess.Popen(
+                cmd_args, *args, stdin=stdin, stdout=stdout, text=text, **kwargs
+            )
+            if return_process:
+                return p
+            return p.wait()
+        all_sinks, text_collected = CommonPSCommands.get_output_sinks(sinks, verbose, collect_stripped_text)
+        result = CommonPSCommands.stream_command(cmd_args, *args, sinks=all_sinks, stdin=stdin, **kwargs)
+        return CommonPSCommands.format_command_result(
+            result, text_collected, verbose, collect_stripped_text, return_result
         )
-        if return_process:
-            return p
-        text_collected = (
-            []
-        )  # TODO: Find out built-ins on polling and collecting this output
-        while True:
-            cur_status = p.poll()
-            if cur_status:  # 0s won't be printed
-                print(cur_status)
-            output = p.stdout.readline()
-            if (output == "") and p.poll() is not None:  # might be redundant
-                break
-            if output:
-                cur_text = output.strip()
-                if collect_stripped_text:
-                    text_collected.append(cur_text)
-                if verbose:
-                    print(cur_text)
-            if cur_status == 0:
-                print(f"Success!\nFinished running {cmd_args}")
-                break
-        rc = p.poll()
-        if collect_stripped_text:
-            return rc, text_collected
-        return rc
 
     @staticmethod
-    def chain_and_execute_commands(cmds: List[str], *args, **kwargs) -> int:
+    def chain_and_execute_commands(cmds: List[str], *args, execution_mode: str = None, **kwargs) -> int:
         """
 
+        If the first command activates a conda env and the execution mode is "session", the remaining commands are sent
+        to a pre-activated shell from CondaShellSessionPool instead of starting (and activating) a new shell. If the
+        execution mode is "direct", the remaining commands are run one by one with shell=False under the cached
+        activation environment of the conda env (see CondaActivationCache); chains that need a shell fall back to
+        the default behavior
 
         :param cmds:
         :type cmds: List[str]
         :param *args:
+        :param execution_mode: overrides CommonPSCommands.conda_execution_mode  (Default value = None)
+        :type execution_mode: str
         :param **kwargs:
         :rtype: int
 
         """
+        if execution_mode is None:
+            execution_mode = CommonPSCommands.conda_execution_mode
+        env_name = CondaEnvManager.get_env_name_from_activate_str(cmds[0]) if cmds else None
+        direct_cmds = None
+        if (execution_mode == "direct") and env_name and (len(cmds) > 1):
+            direct_cmds = [CommonPSCommands.split_direct_cmd(cmd) for cmd in cmds[1:]]
+            if None in direct_cmds:
+                direct_cmds = None
+        use_session = (execution_mode == "session") and env_name and (len(cmds) > 1)
+        if direct_cmds or (use_session and CondaShellSessionPool.is_supported()):
+            all_sinks, text_collected = CommonPSCommands.get_output_sinks(
+                kwargs.get("sinks"), kwargs.get("verbose", True), kwargs.get("collect_stripped_text", False)
+            )
+            if direct_cmds:
+                result = CommonPSCommands.run_direct_cmds(
+                    env_name, direct_cmds, act_env_str=cmds[0], cwd=kwargs.get("cwd"), sinks=all_sinks
+                )
+            else:
+                result = CondaShellSessionPool.run(
+                    env_name, cmds[1:], act_env_str=cmds[0], cwd=kwargs.get("cwd"), sinks=all_sinks
+                )
+            return CommonPSCommands.format_command_result(
+                result,
+                text_collected,
+                kwargs.get("verbose", True),
+                kwargs.get("collect_stripped_text", False),
+                kwargs.get("return_result", False),
+            )
         cmd = " && ".join(cmds)
         kwargs["shell"] = True
         kwargs["text"] = True
@@ -1113,75 +1765,167 @@ class CommonPSCommands:
         return rc
 
     @staticmethod
-    def get_python_dirs():
-        """ """
-        p = Path(".")
-        current_files = list(p.iterdir())
-        all_python_dirs = list(
-            filter(
-                lambda x: x.is_dir()
-                          and ("." not in str(x))
-                          and (not str(x).startswith("__")),
-                current_files,
-            )
-        )
-        return all_python_dirs
-
-    @staticmethod
-    def get_traceback_file_origin(e):
+    def split_direct_cmd(cmd: str):
         """
+        Splits a shell command str into (argv, input_data) so it can run with shell=False.
 
+        A leading echo_yes(return_cmd=True) pipe becomes input_data. None is returned if the command needs a shell
+        (pipes, redirects, chaining, variable expansion or command substitution).
 
-        :param e:
+        :param cmd:
+        :type cmd: str
 
         """
-        path_to_loaded_module = e.__traceback__.tb_next.tb_frame.f_locals["__file__"]
-        return path_to_loaded_module
-
-    @staticmethod
-    def read_toml(path_to_toml, start_line="tool.poetry.dependencies", verbose: bool = False) -> Dict[str, str]:
+        input_data = None
+        yes = CommonPSCommands.echo_yes(return_cmd=True)
+        if cmd.startswith(yes):
+            cmd = cmd[len(yes):]
+            input_data = "yes\n"
+        if ("$" in cmd) or ("`" in cmd):
+            return None
+        lexer = shlex.shlex(cmd, posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        try:
+            argv = list(lexer)
+        except ValueError:
+            return None
+        if (not argv) or any(token and set(token) <= set(lexer.punctuation_chars) for token in argv):
+            return None
+        return argv, input_data
+
+    @staticmethod
+    def run_direct_cmds(
+            env_name: str,
+            direct_cmds: List,
+            act_env_str: str = None,
+            cwd: str = None,
+            sinks: List[OutputSink] = None,
+    ) -> CommandResult:
         """
-        Reads for toml file using open context manager in order to reduce 3rd party toml parser deps
+        Runs (argv, input_data) pairs from split_direct_cmd one after the other with shell=False under the activation
+        environment of env_name, stopping at the first failure just like a chain of && would
 
-        :param path_to_toml:
-        :param start_line: (Default value = "tool.poetry.dependencies")
+        :param env_name:
+        :type env_name: str
+        :param direct_cmds:
+        :param act_env_str:  (Default value = None)
+        :type act_env_str: str
+        :param cwd:  (Default value = None)
+        :type cwd: str
+        :param sinks:  (Default value = None)
+        :type sinks: List[OutputSink]
+        :rtype: CommandResult
 
         """
-        # TODO: This might not work if a dependency spans multiple lines
-        toml_dict = defaultdict(lambda: {})
-        all_dicts = deque()
-        with open(path_to_toml, "r") as f:
-            all_lines = f.readlines()
-            for i, l in enumerate(all_lines):
-                is_section = ('[' in l) and (']' in l) and ('=' not in l)
-                if is_section:
-                    cur_section_name = l.replace('[', '').replace(']', '').strip()
-                    cur_dict = toml_dict[cur_section_name]
-                else:
-                    cur_dict = all_dicts.pop()
-                cur_line = l.strip()
-                if is_section:
-                    all_dicts.append(cur_dict)
-                elif not is_section:
-                    if verbose:
-                        print(cur_line)
-                    if cur_line:
-                        key, *value = cur_line.split(
-                            "="
-                        )  # assuming we have simple dependencies with 1 = sign
-                        key = key.strip()
-                        value = "=".join(value)
-                        if len(value) == 2:
-                            pass
-                        else:
-                            value = value.replace('"', "").strip()
-
-                        cur_dict[key] = value
-                    all_dicts.append(cur_dict)
-        if start_line:
-            dict_to_return = toml_dict[start_line].copy()
-            return dict_to_return
-        return toml_dict
+        sinks = list(sinks or [])
+        env = CondaActivationCache.get_activated_environ(env_name, act_env_str=act_env_str)
+        rc, duration, stdout_bytes, stderr_bytes = 0, 0.0, 0, 0
+        all_argv = []
+        try:
+            for argv, input_data in direct_cmds:
+                exe = shutil.which(argv[0], path=env.get("PATH")) or argv[0]
+                all_argv.append(argv)
+                result = CommonPSCommands.stream_command(
+                    [exe] + argv[1:],
+                    sinks=sinks,
+                    input_data=input_data,
+                    close_sinks=False,
+                    cwd=cwd,
+                    env=env,
+                    shell=False,
+                )
+                rc = result.rc
+                duration += result.duration
+                stdout_bytes += result.stdout_bytes
+                stderr_bytes += result.stderr_bytes
+                if rc != 0:
+                    break
+        except FileNotFoundError as e:
+            print(e)
+            rc = 127
+        finally:
+            for sink in sinks:
+                sink.close()
+        return CommandResult(rc, duration, stdout_bytes, stderr_bytes, all_argv)
+
+    @staticmethod
+    def run_in_conda_env(env_name: str, cmd: Union[List[str], str], cwd: str = None, **kwargs):
+        """
+        Runs one command inside a conda env without starting a shell or activating the env
+
+        :param env_name:
+        :type env_name: str
+        :param cmd: argv list or a command str without shell syntax
+        :type cmd: Union[List[str], str]
+        :param cwd:  (Default value = None)
+        :type cwd: str
+        :param **kwargs: verbose, collect_stripped_text, sinks or return_result like run_command
+
+        """
+        if isinstance(cmd, str):
+            direct_cmd = CommonPSCommands.split_direct_cmd(cmd)
+            assert direct_cmd is not None, f"{cmd!r} needs a shell to run"
+        else:
+            direct_cmd = (list(cmd), None)
+        verbose = kwargs.get("verbose", True)
+        collect_stripped_text = kwargs.get("collect_stripped_text", False)
+        all_sinks, text_collected = CommonPSCommands.get_output_sinks(
+            kwargs.get("sinks"), verbose, collect_stripped_text
+        )
+        result = CommonPSCommands.run_direct_cmds(env_name, [direct_cmd], cwd=cwd, sinks=all_sinks)
+        return CommonPSCommands.format_command_result(
+            result, text_collected, verbose, collect_stripped_text, kwargs.get("return_result", False)
+        )
+
+    @staticmethod
+    def get_python_dirs():
+        """ """
+        p = Path(".")
+        current_files = list(p.iterdir())
+        all_python_dirs = list(
+            filter(
+                lambda x: x.is_dir()
+                          and ("." not in str(x))
+                          and (not str(x).startswith("__")),
+                current_files,
+            )
+        )
+        return all_python_dirs
+
+    @staticmethod
+    def get_traceback_file_origin(e):
+        """
+
+
+        :param e:
+
+        """
+        path_to_loaded_module = e.__traceback__.tb_next.tb_frame.f_locals["__file__"]
+        return path_to_loaded_module
+
+    @staticmethod
+    def read_toml(path_to_toml, start_line="tool.poetry.dependencies", verbose: bool = False) -> Mapping:
+        """
+        Reads a toml file through TomlParseCache, so reading the same unchanged file again doesn't parse it again
+
+        The returned mappings are read-only views shared by every caller, use .copy() (or dict()) for something mutable
+
+        :param path_to_toml:
+        :param start_line: dotted name of the table to return, or "" for every table keyed by its dotted name
+            (Default value = "tool.poetry.dependencies")
+        :param verbose:  (Default value = False)
+        :type verbose: bool
+        :rtype: Mapping
+
+        """
+        tables = TomlParseCache.get_tables(path_to_toml)
+        if not start_line:
+            return tables
+        table = tables.get(start_line, MappingProxyType({}))
+        if verbose:
+            for key, value in table.items():
+                print(f"{key} = {value!r}")
+        return table
 
     @staticmethod
     def echo_yes(return_cmd: bool = False) -> Union[str, Popen]:
@@ -1315,27 +2059,46 @@ class CondaEnvManager:
         return all_env_names, all_env_paths
 
     @staticmethod
-    def get_conda_envs():
-        """ """
-        conda_cmd = ["conda", "info", "--envs"]
-        with subprocess.Popen(conda_cmd, stdout=subprocess.PIPE, text=True) as p:
-            output, errors = p.communicate()
+    def get_conda_envs(use_cli: bool = False):
+        """
+        Returns the names and prefixes of all known conda envs (envs outside of the envs dirs have an empty name,
+        just like in `conda info --envs`)
+
+        :param use_cli: parse `conda info --envs` instead of reading CondaEnvIndex  (Default value = False)
+        :type use_cli: bool
 
-        all_lines = output.replace(r"*", " ").split("\n")
+        """
+        if not use_cli:
+            records = CondaEnvIndex.get_records()
+            return [r.name for r in records], [r.prefix for r in records]
+        conda_cmd = ["conda", "info", "--envs"]
+        rc, all_lines = CommonPSCommands.run_command(
+            conda_cmd, text=True, verbose=False, collect_stripped_text=True
+        )
+        all_lines = [l.replace(r"*", " ") for l in all_lines]
         all_lines = list(filter(None, all_lines))  # remove empty strs
         all_lines = list(filter(lambda x: "#" not in x, all_lines))  # remove comments
         env_names, env_paths = CondaEnvManager.get_env_info_from_lines(all_lines)
         return env_names, env_paths
 
     @staticmethod
-    def get_kernel_specs():
-        """ """
-        kernel_cmd = ["jupyter", "kernelspec", "list"]
-        with subprocess.Popen(kernel_cmd, stdout=subprocess.PIPE, text=True) as p:
-            output, errors = p.communicate()
+    def get_kernel_specs(use_cli: bool = False):
+        """
+        Returns the names and resource directories of all installed kernelspecs
 
-        all_lines = output.strip().replace(r"*", " ").split("\n")
-        all_lines = [l.strip() for l in all_lines if ("Available kernels" not in l)]
+        :param use_cli: parse `jupyter kernelspec list` instead of reading KernelSpecIndex  (Default value = False)
+        :type use_cli: bool
+
+        """
+        if not use_cli:
+            records = KernelSpecIndex.get_records()
+            return [r.name for r in records], [r.resource_dir for r in records]
+        kernel_cmd = ["jupyter", "kernelspec", "list"]
+        rc, all_lines = CommonPSCommands.run_command(
+            kernel_cmd, text=True, verbose=False, collect_stripped_text=True
+        )
+        all_lines = [l.replace(r"*", " ").strip() for l in all_lines]
+        all_lines = [l for l in all_lines if l and ("Available kernels" not in l)]
         kernel_names, kernel_paths = CondaEnvManager.get_env_info_from_lines(all_lines)
         return kernel_names, kernel_paths
 
@@ -1348,18 +2111,10 @@ class CondaEnvManager:
         :type env_name: str
 
         """
-        rel_path_to_kernel = f"Jupyter/kernels/{env_name}/kernel.json"
-        if platform.system() == "Windows":
-            # TODO: Test on PC
-            path_to_kernel = (
-                Path(os.getenv("APPDATA")).resolve().joinpath(rel_path_to_kernel)
-            )
-        else:
-            path_to_kernel = (
-                Path(f"~/Library").expanduser().joinpath(rel_path_to_kernel)
-            )
+        kernel_record = KernelSpecIndex.lookup(env_name)
         try:
-            assert path_to_kernel.exists()
+            assert kernel_record is not None, f"Kernel {env_name!r} does not exist!"
+            path_to_kernel = Path(kernel_record.resource_dir).joinpath("kernel.json")
         except Exception as e:
             print(e)
             raise e
@@ -1373,8 +2128,7 @@ class CondaEnvManager:
         :param kernel_config_path:
 
         """
-        with open(kernel_config_path, "r") as f:
-            kernel_config = json.load(f)
+        kernel_config = copy.deepcopy(KernelSpecIndex.load_spec(kernel_config_path))
         return kernel_config
 
     @staticmethod
@@ -1430,10 +2184,9 @@ class CondaEnvManager:
 
         """
         kernel_names, _ = CondaEnvManager.get_kernel_specs()
-        conda_names, _ = CondaEnvManager.get_conda_envs()
 
         kernel_name_taken = clean_proj_name in kernel_names
-        conda_name_taken = clean_proj_name in conda_names
+        conda_name_taken = CondaEnvIndex.lookup(clean_proj_name) is not None
         if both:
             return (not conda_name_taken) and (not kernel_name_taken)
         else:
@@ -1449,84 +2202,104 @@ class CondaEnvManager:
         :rtype: str
 
         """
+        env_record = CondaEnvIndex.lookup(env_name)
+        if env_record is not None:
+            return Path(env_record.prefix).resolve().as_posix()
         conda_base = CondaEnvManager.get_conda_base()
         path_to_env = (Path(conda_base) / f"envs/{env_name}").resolve().as_posix()
         return path_to_env
 
     @staticmethod
-    def reset_conda_channel_priority(act_env_str: str, *args, **kwargs) -> int:
+    def reset_conda_channel_priority(act_env_str: str, *args, return_cmd: bool = False, **kwargs) -> Union[int, List[str]]:
         """
 
 
         :param act_env_str:
         :type act_env_str: str
         :param *args:
+        :param return_cmd: return the commands to chain instead of running them  (Default value = False)
+        :type return_cmd: bool
         :param **kwargs:
-        :rtype: int
+        :rtype: Union[int, List[str]]
 
         """
         cmd = "conda config --set channel_priority false"
+        if return_cmd:
+            return [act_env_str, cmd]
         rc = CommonPSCommands.chain_and_execute_commands(
             [act_env_str, cmd], *args, **kwargs
         )
         return rc
 
     @staticmethod
-    def upgrade_pip(act_env_str: str, *args, **kwargs) -> int:
+    def upgrade_pip(act_env_str: str, *args, return_cmd: bool = False, **kwargs) -> Union[int, List[str]]:
         """
 
 
         :param act_env_str:
         :type act_env_str: str
         :param *args:
+        :param return_cmd: return the commands to chain instead of running them  (Default value = False)
+        :type return_cmd: bool
         :param **kwargs:
-        :rtype: int
+        :rtype: Union[int, List[str]]
 
         """
         yes = CommonPSCommands.echo_yes(True)
         cmd = yes + "python -m pip install --upgrade pip setuptools wheel"
+        if return_cmd:
+            return [act_env_str, cmd]
         rc = CommonPSCommands.chain_and_execute_commands(
             [act_env_str, cmd], *args, **kwargs
         )
         return rc
 
     @staticmethod
-    def install_ipykernel(act_env_str: str, *args, **kwargs) -> int:
+    def install_ipykernel(act_env_str: str, *args, return_cmd: bool = False, **kwargs) -> Union[int, List[str]]:
         """
 
 
         :param act_env_str:
         :type act_env_str: str
         :param *args:
+        :param return_cmd: return the commands to chain instead of running them  (Default value = False)
+        :type return_cmd: bool
         :param **kwargs:
-        :rtype: int
+        :rtype: Union[int, List[str]]
 
         """
         yes = CommonPSCommands.echo_yes(True)
         cmd = yes + "conda install notebook ipykernel"  # TODO: Don't install, use poetry add
+        if return_cmd:
+            return [act_env_str, cmd]
         rc = CommonPSCommands.chain_and_execute_commands(
             [act_env_str, cmd], *args, **kwargs
         )
         return rc
 
     @staticmethod
-    def add_conda_forge_priority(act_env_str: str, *args, **kwargs) -> int:
+    def add_conda_forge_priority(act_env_str: str, *args, return_cmd: bool = False, **kwargs) -> Union[int, List[str]]:
         """
 
 
         :param act_env_str:
         :type act_env_str: str
         :param *args:
+        :param return_cmd: return the commands to chain instead of running them  (Default value = False)
+        :type return_cmd: bool
         :param **kwargs:
-        :rtype: int
+        :rtype: Union[int, List[str]]
 
         """
         cmd = "conda config --add channels conda-forge"
+        strict_cmd = "conda config --set channel_priority strict"
+        if return_cmd:
+            return [act_env_str, cmd, strict_cmd]
         rc = CommonPSCommands.chain_and_execute_commands(
             [act_env_str, cmd], *args, **kwargs
         )
         if rc == 0:
-            cmd = "conda config --set channel_priority strict"
+            cmd = strict_cmd
             rc = CommonPSCommands.chain_and_execute_commands(
                 [act_env_str, cmd], *args, **kwargs
             )
@@ -1535,39 +2308,91 @@ class CondaEnvManager:
             return rc
 
     @staticmethod
-    def register_kernel(env_name: str, *args, **kwargs) -> int:
+    def register_kernel(
+            env_name: str, *args, return_cmd: bool = False, native: bool = True, **kwargs
+    ) -> Union[int, List[str]]:
         """
 
+        By default the kernelspec is written directly (see KernelSpecInstaller) instead of activating the env and running
+        `ipython kernel install`
 
         :param env_name:
         :type env_name: str
         :param *args:
+        :param return_cmd: return the commands to chain instead of running them  (Default value = False)
+        :type return_cmd: bool
+        :param native: write the kernelspec without running ipython  (Default value = True)
+        :type native: bool
         :param **kwargs:
-        :rtype: int
+        :rtype: Union[int, List[str]]
 
         """
+        if native and (not return_cmd):
+            return CondaEnvManager.register_kernels([env_name])[env_name]
         act_env_str = CondaEnvManager.activate_conda_env(env_name, return_cmd=True)
         cmd = (
             f"ipython kernel install --user --name {env_name} --display-name {env_name}"
         )
+        if return_cmd:
+            return [act_env_str, cmd]
         rc = CommonPSCommands.chain_and_execute_commands(
             [act_env_str, cmd], *args, **kwargs
         )
         return rc
 
     @staticmethod
-    def get_available_conda_versions():
+    def register_kernels(env_names: List[str]) -> Dict[str, int]:
+        """
+        Writes a user kernelspec for every env in env_names (named and displayed like the env)
+
+        :param env_names:
+        :type env_names: List[str]
+        :returns: {env name: 0 if the kernel was registered, else 1}
+        :rtype: Dict[str, int]
+
+        """
+        all_rcs = {}
+        for env_name in env_names:
+            try:
+                env_prefix = CondaEnvManager.get_path_to_conda_env(env_name)
+                assert KernelSpecInstaller.find_ipykernel_dir(env_prefix), f"ipykernel isn't installed in {env_name!r}"
+                KernelSpecInstaller.install_kernel_spec(
+                    env_name,
+                    KernelSpecInstaller.get_env_python(env_prefix),
+                    display_name=env_name,
+                    logo_dir=KernelSpecInstaller.find_logo_dir(env_prefix),
+                )
+                all_rcs[env_name] = 0
+            except Exception as e:
+                print(e)
+                print(f"Unable to register a kernel for {env_name!r}")
+                all_rcs[env_name] = 1
+        return all_rcs
+
+    @staticmethod
+    def get_available_conda_versions(use_cli: bool = False, ttl: float = None, offline: bool = False):
         """
 
         Returns a dict of python versions that are available for Conda:
-        the keys are the python versions
+        the keys are the python versions, from lowest to highest
         the values are tuples corresponding to the Name, Version, Build, and Channel
+        The versions come from the CondaSearchCache snapshot unless use_cli is True
+        :param use_cli: parse the table printed by `conda search python` instead  (Default value = False)
+        :param ttl: max age of the cached snapshot in seconds  (Default value = None)
+        :param offline: only use the cached snapshot  (Default value = False)
         :return:
         """
+        if not use_cli:
+            index = CondaSearchCache.get_index("python", ttl=ttl, offline=offline)
+            versions_available = defaultdict(list)
+            for version in index.versions:
+                versions_available[version].extend(index.builds[version])
+            return versions_available
         args = ["conda", "search", "python"]
-        p = CommonPSCommands.run_command(args, text=True, return_process=True)
-        output, errors = p.communicate()
-        versions_available_ls = list(map(lambda x: x.strip().split(), output.splitlines()[2::]))
+        rc, all_lines = CommonPSCommands.run_command(
+            args, text=True, verbose=False, collect_stripped_text=True
+        )
+        versions_available_ls = list(map(lambda x: x.split(), filter(None, all_lines[2::])))
         versions_available = defaultdict(list)
         for v in versions_available_ls:
             cur_version = v[1]
@@ -1578,43 +2403,77 @@ class CondaEnvManager:
     def get_suitable_python_versions_for_conda(python_version: str):
         """
         Returns a dict of available conda python interpreter versions that meet the python_version contraint passed in
+        The values are the packed version keys VersionConstraintEngine matched against
 
         :param python_version:
         :return:
         """
-        parse_single_constraint = import_optional_dependency('parse_single_constraint')
-        parsed_pyproject_toml_python_version = parse_single_constraint(python_version)
-        available_versions = CondaEnvManager.get_available_conda_versions()
-        parsed_versions = {pv: parse_single_constraint(pv) for pv in available_versions.keys()}
-        filtered_versions = {}
-        for conda_version, parsed_conda_version in parsed_versions.items():
-            if parsed_pyproject_toml_python_version.allows(parsed_conda_version):
-                filtered_versions[conda_version] = parsed_conda_version
-        return filtered_versions
+        catalog = CondaEnvManager.get_python_version_catalog()
+        allowed_versions = VersionConstraintEngine.allowed_versions(catalog, python_version)
+        return {v: CondaSearchCache.get_version_key(v) for v in allowed_versions}
+
+    @staticmethod
+    def get_python_version_catalog() -> "VersionCatalog":
+        """
+        Returns the available conda python versions as a VersionCatalog, rebuilt only when the cached index changes
+
+        :rtype: VersionCatalog
+
+        """
+        return CondaSearchCache.get_catalog("python")
+
+    @staticmethod
+    def is_version_constraint(python_version: str) -> bool:
+        """
+        Returns True if python_version is a constraint rather than a version conda can be given as is
+
+        :param python_version:
+        :type python_version: str
+        :rtype: bool
+
+        """
+        return any(c in python_version for c in "^~*<>=!|,")
 
     @staticmethod
-    def get_python_version_for_conda(python_version: str):
+    def get_python_version_for_conda(python_version: str, catalog: "VersionCatalog" = None):
         """
         This returns a str that specifies the python version to use for a new conda python environment
         The return str must start with 'python='
+        "~" constraints pick the lowest allowed version, every other constraint the highest (pre-releases are skipped)
 
         :param python_version:
+        :param catalog: (Default value = None) defaults to CondaEnvManager.get_python_version_catalog()
         :return:
         """
-        if ("^" in python_version) or ("~" in python_version) or ("*" in python_version):
-            filtered_versions = CondaEnvManager.get_suitable_python_versions_for_conda(python_version)
-            python_version_new = ""
-            if ("^" in python_version):
-                python_version_new = list(filtered_versions.keys())[-1]
-            elif ("~" in python_version):
-                python_version_new = list(filtered_versions.keys())[0]
-            elif ("*" in python_version):
-                python_version_new = list(filtered_versions.keys())[-1]
+        if CondaEnvManager.is_version_constraint(python_version):
+            catalog = catalog or CondaEnvManager.get_python_version_catalog()
+            highest = not (("~" in python_version) and ("^" not in python_version))
+            python_version_new = VersionConstraintEngine.select(catalog, python_version, highest=highest)
+            assert python_version_new, f"No conda python version satisfies {python_version!r}"
             python_version_str = f"python={python_version_new}"
         else:
             python_version_str = f"python={python_version}"
         return python_version_str
 
+    @staticmethod
+    def get_python_versions_for_pyprojects(pyproject_toml_paths: List[str]) -> Dict[str, str]:
+        """
+        Batch version of get_python_version_for_conda for the python constraints of many pyproject.toml files
+
+        :param pyproject_toml_paths:
+        :type pyproject_toml_paths: List[str]
+        :returns: {pyproject.toml path: 'python=...'}
+        :rtype: Dict[str, str]
+
+        """
+        catalog = CondaEnvManager.get_python_version_catalog()
+        return {
+            str(path): CondaEnvManager.get_python_version_for_conda(
+                CommonPSCommands.read_toml(path)["python"], catalog=catalog
+            )
+            for path in pyproject_toml_paths
+        }
+
     @staticmethod
     def create_conda_env(env_name: str, python_version: str) -> int:
         """
@@ -1634,15 +2493,26 @@ class CondaEnvManager:
         return rc
 
     @staticmethod
-    def init_prev_made_conda_env(env_name: str) -> int:
+    def init_prev_made_conda_env(env_name: str, fuse_steps: bool = True) -> int:
         """
 
+        With fuse_steps the steps below run as a BootstrapPlan: one `conda install` for pip/setuptools/wheel/notebook/
+        ipykernel, one write to .condarc and a natively registered kernel
 
         :param env_name:
         :type env_name: str
+        :param fuse_steps: fuse the steps with BootstrapPlanner  (Default value = True)
+        :type fuse_steps: bool
         :rtype: int
 
         """
+        if fuse_steps:
+            plan = BootstrapPlanner.plan(env_name)
+            step_rcs = BootstrapPlanner.execute(plan)
+            for step_name, rc in step_rcs.items():
+                assert rc == 0, f"{step_name} failed for {env_name!r} (rc={rc})"
+            print(f"Bootstrapped {env_name!r}, {plan.saved_launches} process launches saved")
+            return 0
         act_env = CondaEnvManager.activate_conda_env(env_name, return_cmd=True)
         rc = CondaEnvManager.reset_conda_channel_priority(act_env)
         assert rc == 0
@@ -1676,14 +2546,18 @@ class CondaEnvManager:
     #     cmd = y + kernel_cmd_str
 
     @staticmethod
-    def uninstall_kernel(kernel_name: str = ""):
+    def uninstall_kernel(kernel_name: str = "", native: bool = True):
         """
 
 
         :param kernel_name:  (Default value = "")
         :type kernel_name: str
+        :param native: remove the kernelspec directory without running jupyter  (Default value = True)
+        :type native: bool
 
         """
+        if native:
+            return CondaEnvManager.uninstall_kernels([kernel_name])[kernel_name]
         try:
             kernel_names, _ = CondaEnvManager.get_kernel_specs()
             assert kernel_name in kernel_names
@@ -1700,6 +2574,25 @@ class CondaEnvManager:
             rc = CommonPSCommands.run_command([cmd], text=True, shell=True)
         return rc
 
+    @staticmethod
+    def uninstall_kernels(kernel_names: List[str]) -> Dict[str, int]:
+        """
+        Removes the kernelspecs of kernel_names in one pass
+
+        :param kernel_names:
+        :type kernel_names: List[str]
+        :returns: {kernel name: 0 if it was removed, else 1}
+        :rtype: Dict[str, int]
+
+        """
+        removed = KernelSpecInstaller.remove_kernel_specs(kernel_names)
+        all_rcs = {}
+        for kernel_name in kernel_names:
+            if not removed[kernel_name]:
+                print(f"Kernel {kernel_name!r} does not exist!")
+            all_rcs[kernel_name] = 0 if removed[kernel_name] else 1
+        return all_rcs
+
     @staticmethod
     def uninstall_conda_env(conda_env_name: str = ""):
         """
@@ -1710,12 +2603,12 @@ class CondaEnvManager:
 
         """
         try:
-            kernel_names, _ = CondaEnvManager.get_conda_envs()
-            assert conda_env_name in kernel_names
+            assert CondaEnvIndex.lookup(conda_env_name) is not None
         except Exception:
             print(f"Conda {conda_env_name!r} does not exist!")
         conda_cmd = ["conda", "env", "remove", "-n", conda_env_name]
         rc = CommonPSCommands.run_command(conda_cmd, text=True)
+        CondaEnvIndex.invalidate()
         return rc
 
     @staticmethod
@@ -1745,63 +2638,68 @@ class CondaEnvManager:
             return rc1, rc2
 
     @staticmethod
-    def uninstall_conda_envs_and_kernels(conda_env_names):
+    def uninstall_conda_envs_and_kernels(
+            conda_env_names: List[str], max_workers: int = None, use_conda: bool = False
+    ) -> "TeardownReport":
         """
 
+        The envs and their kernels (named like the envs) are removed in bulk by CondaEnvTeardown
 
         :param conda_env_names:
+        :type conda_env_names: List[str]
+        :param max_workers:  (Default value = None) number of env prefixes deleted in parallel
+        :type max_workers: int
+        :param use_conda: remove every env with `conda env remove -p`  (Default value = False)
+        :type use_conda: bool
+        :rtype: TeardownReport
 
         """
-        for env in conda_env_names:
-            print(env)
-            CondaEnvManager.uninstall_conda_and_kernel(env, env)
-            print()
+        return CondaEnvTeardown.teardown(conda_env_names, max_workers=max_workers, use_conda=use_conda)
 
     @staticmethod
-    def get_conda_base() -> str:
+    def get_conda_base(use_cache: bool = True) -> str:
         """
 
+        The result is memoized per CONDA_EXE/PATH (see CondaDiscoveryCache), so `conda info --base` runs once per process
 
-
+        :param use_cache:  (Default value = True)
+        :type use_cache: bool
         :rtype: str
 
         """
+        if use_cache:
+            return CondaDiscoveryCache.get_or_compute(
+                "conda_base", lambda: CondaEnvManager.get_conda_base(use_cache=False)
+            )
         # TODO: Make this work on all platforms
         echo_cmds = ["conda", "info", "--base"]
-        if platform.system() == "Windows":
-            # TODO: This always prints out for windows commands
-            rc, text = CommonPSCommands.run_command(
-                echo_cmds,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                text=True,
-                verbose=False,
-                collect_stripped_text=True,
-            )
-            output = text[
-                0
-            ].strip()  # TODO: last elem is a new line str for some reason
-        else:
-            p = CommonPSCommands.run_command(
-                echo_cmds,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                text=True,
-                return_process=True,
-                shell=False,
-            )
-            output, errors = p.communicate()
+        rc, text = CommonPSCommands.run_command(
+            echo_cmds,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            verbose=False,
+            collect_stripped_text=True,
+            shell=False,
+        )
+        output = next(filter(None, text), "")
         return output.strip()
 
     @staticmethod
-    def get_conda_sh() -> str:
+    def get_conda_sh(use_cache: bool = True) -> str:
         """
 
 
 
+        :param use_cache:  (Default value = True)
+        :type use_cache: bool
         :rtype: str
 
         """
+        if use_cache:
+            return CondaDiscoveryCache.get_or_compute(
+                "conda_sh", lambda: CondaEnvManager.get_conda_sh(use_cache=False)
+            )
         try:
             conda_base = CondaEnvManager.get_conda_base()
             conda_sh = (Path(conda_base.strip()) / "etc/profile.d/conda.sh").resolve()
@@ -1834,7 +2732,7 @@ class CondaEnvManager:
         return all_lines[0]
 
     @staticmethod
-    def activate_conda_env(env_name: str, return_cmd: bool = False) -> str:
+    def activate_conda_env(env_name: str, return_cmd: bool = False, use_cache: bool = True) -> str:
         """
 
 
@@ -1842,9 +2740,16 @@ class CondaEnvManager:
         :type env_name: str
         :param return_cmd:  (Default value = False)
         :type return_cmd: bool
+        :param use_cache: memoize the activation str (Default value = True)
+        :type use_cache: bool
         :rtype: str
 
         """
+        if return_cmd and use_cache:
+            return CondaDiscoveryCache.get_or_compute(
+                ("activate_str", env_name),
+                lambda: CondaEnvManager.activate_conda_env(env_name, return_cmd=True, use_cache=False),
+            )
         #     echo_cmd = ["python", "--version"]
         #     echo_cmd_str = " ".join(echo_cmd)
         conda_sh = CondaEnvManager.get_conda_sh()
@@ -1877,21 +2782,195 @@ class CondaEnvManager:
             return p
 
     @staticmethod
-    def create_and_init_conda_env(clean_env_name: str, python_version: str) -> None:
+    def get_env_name_from_activate_str(act_env_str: str) -> Union[str, None]:
+        """
+        Returns the env name if act_env_str is a str made by activate_conda_env, otherwise None
+
+        :param act_env_str:
+        :type act_env_str: str
+        :rtype: Union[str, None]
+
+        """
+        match = re.fullmatch(r"(?:source \S.* && )?conda activate (\S+)", act_env_str.strip())
+        if match:
+            return match.group(1)
+        return None
+
+    @staticmethod
+    def create_and_init_conda_env(
+            clean_env_name: str, python_version: str, fuse_steps: bool = True, use_solve_cache: bool = False
+    ) -> None:
         """
 
+        With use_solve_cache a bootstrapped env is recreated from the explicit spec CondaSolveCache stored for the same
+        python version, bootstrap steps, channels and platform, instead of being solved again. The spec is stored under
+        the key computed after the bootstrap edited .condarc, i.e. for the channels the env was actually solved with.
 
         :param clean_env_name:
         :type clean_env_name: str
         :param python_version:
         :type python_version: str
+        :param fuse_steps: see init_prev_made_conda_env  (Default value = True)
+        :type fuse_steps: bool
+        :param use_solve_cache:  (Default value = False)
+        :type use_solve_cache: bool
         :rtype: None
 
         """
+        if use_solve_cache:
+            solve_key = CondaEnvManager.get_bootstrap_solve_key(python_version, fuse_steps=fuse_steps)
+            spec_path = CondaSolveCache.lookup(solve_key)
+            if spec_path is not None:
+                rc = CondaEnvManager.create_conda_env_from_explicit_spec(clean_env_name, spec_path)
+                assert rc == 0
+                steps = [
+                    step for step in BootstrapPlanner.get_default_steps()
+                    if step.action not in BootstrapPlanner.install_actions
+                ]
+                step_rcs = BootstrapPlanner.execute(BootstrapPlanner.plan(clean_env_name, steps))
+                for step_name, rc in step_rcs.items():
+                    assert rc == 0, f"{step_name} failed for {clean_env_name!r} (rc={rc})"
+                return
         rc = CondaEnvManager.create_conda_env(clean_env_name, python_version)
         assert rc == 0
-        rc = CondaEnvManager.init_prev_made_conda_env(clean_env_name)
+        rc = CondaEnvManager.init_prev_made_conda_env(clean_env_name, fuse_steps=fuse_steps)
         assert rc == 0
+        if use_solve_cache:
+            solve_key = CondaEnvManager.get_bootstrap_solve_key(python_version, fuse_steps=fuse_steps)
+            CondaSolveCache.store(solve_key, CondaEnvManager.export_explicit_spec(clean_env_name))
+
+    @staticmethod
+    def get_bootstrap_solve_key(python_version: str, fuse_steps: bool = True) -> str:
+        """
+        Returns the CondaSolveCache key of a bootstrapped env: its specs, the current solve context, the bootstrap steps
+        and whether they were fused (the unfused workflow installs with pip instead of conda)
+
+        :param python_version:
+        :type python_version: str
+        :param fuse_steps:  (Default value = True)
+        :type fuse_steps: bool
+        :rtype: str
+
+        """
+        solve_context = {
+            **CondaSolveCache.get_solve_context(),
+            "bootstrap_steps": [
+                [step.name, step.action, list(step.args)] for step in BootstrapPlanner.get_default_steps()
+            ],
+            "fuse_steps": fuse_steps,
+        }
+        return CondaSolveCache.get_key(CondaEnvManager.get_bootstrap_specs(python_version), solve_context=solve_context)
+
+    @staticmethod
+    def get_bootstrap_specs(python_version: str) -> List[str]:
+        """
+        Returns the specs a bootstrapped env is solved for: its python and the packages of the bootstrap installs
+
+        :param python_version:
+        :type python_version: str
+        :rtype: List[str]
+
+        """
+        specs = [CondaEnvManager.get_python_version_for_conda(python_version)]
+        for step in BootstrapPlanner.get_default_steps():
+            if step.action in BootstrapPlanner.install_actions:
+                specs.extend(step.args)
+        return specs
+
+    @staticmethod
+    def clone_conda_env(
+            src_env_name: str, new_env_name: str, register_kernel: bool = True, offline: bool = True
+    ) -> int:
+        """
+        Clones a bootstrapped env with `conda create --clone`, which hardlinks files from the shared pkgs cache and
+        rewrites the prefixes baked into them, so nothing is solved or downloaded. A kernel named new_env_name is
+        registered natively afterwards.
+
+        :param src_env_name:
+        :type src_env_name: str
+        :param new_env_name:
+        :type new_env_name: str
+        :param register_kernel:  (Default value = True)
+        :type register_kernel: bool
+        :param offline: only use the pkgs cache, retrying online if a package isn't cached  (Default value = True)
+        :type offline: bool
+        :rtype: int
+
+        """
+        src_record = CondaEnvIndex.lookup(src_env_name)
+        assert src_record is not None, f"Conda {src_env_name!r} does not exist!"
+        assert CondaEnvIndex.lookup(new_env_name) is None, f"Conda {new_env_name!r} already exists!"
+        if register_kernel:
+            kernel_names, _ = CondaEnvManager.get_kernel_specs()
+            assert new_env_name not in kernel_names, f"Kernel {new_env_name!r} already exists!"
+        clone_cmd = ["conda", "create", "-y", "-n", new_env_name, "--clone", src_record.prefix]
+        rc = 1
+        if offline:
+            rc = CommonPSCommands.run_command(clone_cmd + ["--offline"], text=True)
+            if rc != 0:
+                print("Not every package is in the pkgs cache, cloning online")
+                # new_env_name didn't exist above, so whatever is there now is what the failed clone left behind
+                CondaEnvIndex.invalidate()
+                partial_record = CondaEnvIndex.lookup(new_env_name)
+                if partial_record is not None:
+                    CondaEnvTeardown.remove_prefix(partial_record.prefix)
+        if rc != 0:
+            rc = CommonPSCommands.run_command(clone_cmd, text=True)
+        CondaEnvIndex.invalidate()
+        if (rc == 0) and register_kernel:
+            rc = CondaEnvManager.register_kernel(new_env_name)
+        return rc
+
+    @staticmethod
+    def export_explicit_spec(env_name: str, spec_path: str = None, hash_type: str = "md5") -> str:
+        """
+        Returns (and optionally writes) the explicit spec of an env: every package url with its hash, no solving needed
+        to recreate it. Same as `conda list --explicit --md5`, but read straight from conda-meta
+
+        :param env_name:
+        :type env_name: str
+        :param spec_path:  (Default value = None) file to write the spec to
+        :type spec_path: str
+        :param hash_type: "md5", "sha256" or ""  (Default value = "md5")
+        :type hash_type: str
+        :rtype: str
+
+        """
+        env_record = CondaEnvIndex.lookup(env_name)
+        assert env_record is not None, f"Conda {env_name!r} does not exist!"
+        spec_text = CondaExplicitSpec.render(env_record.prefix, hash_type=hash_type)
+        if spec_path:
+            with open(spec_path, "w") as f:
+                f.write(spec_text)
+        return spec_text
+
+    @staticmethod
+    def create_conda_env_from_explicit_spec(env_name: str, spec_path: str, offline: bool = None) -> int:
+        """
+        Creates env_name from an explicit spec, which skips the solver. With offline left as None, conda runs with
+        --offline when every package of the spec is already in the pkgs cache
+
+        :param env_name:
+        :type env_name: str
+        :param spec_path:
+        :type spec_path: str
+        :param offline:  (Default value = None)
+        :type offline: bool
+        :rtype: int
+
+        """
+        spec_path = Path(spec_path).resolve()
+        if offline is None:
+            missing_packages = CondaExplicitSpec.get_missing_packages(spec_path.read_text())
+            offline = not missing_packages
+            if missing_packages:
+                print(f"{len(missing_packages)} packages aren't cached yet, downloading them")
+        args = ["conda", "create", "-y", "-n", env_name, "--file", spec_path.as_posix()]
+        if offline:
+            args.append("--offline")
+        rc = CommonPSCommands.run_command(args, text=True)
+        CondaEnvIndex.invalidate()
+        return rc
 
 
 class GitProjectManager:
@@ -1945,12 +3024,8 @@ class GitProjectManager:
         assert uname
         repo_to_add = f"git@github.com:{uname}/{repo_name}.git"
         git_cmds = ["git", "remote", "add", "origin", repo_to_add]
-        with subprocess.Popen(
-                git_cmds, stdout=subprocess.PIPE, text=True, cwd=dir_path
-        ) as p:
-            output, errors = p.communicate()
-        print(output)
-        print(errors)
+        rc = CommonPSCommands.run_command(git_cmds, text=True, cwd=dir_path)
+        return rc
 
     @staticmethod
     def replace_global_git_username(new_username):
@@ -1971,12 +3046,8 @@ class GitProjectManager:
             "user.name",
             f'"{new_username}"',
         ]
-        with subprocess.Popen(
-                git_cmds, stdout=subprocess.PIPE, text=True, cwd=dir_path
-        ) as p:
-            output, errors = p.communicate()
-        print(output)
-        print(errors)
+        rc = CommonPSCommands.run_command(git_cmds, text=True, cwd=dir_path)
+        return rc
 
     @staticmethod
     def replace_global_git_email(new_email):
@@ -1996,12 +3067,8 @@ class GitProjectManager:
             "user.email",
             f'"{new_email}"',
         ]
-        with subprocess.Popen(
-                git_cmds, stdout=subprocess.PIPE, text=True, cwd=dir_path
-        ) as p:
-            output, errors = p.communicate()
-        print(output)
-        print(errors)
+        rc = CommonPSCommands.run_command(git_cmds, text=True, cwd=dir_path)
+        return rc
 
     @staticmethod
     def verify_github_ssh():
@@ -2009,12 +3076,8 @@ class GitProjectManager:
         # https://docs.github.com/en/github-ae@latest/github/authenticating-to-github/checking-for-existing-ssh-keys
         dir_path = os.getcwd()
         git_cmds = ["ssh", "-T", "git@github.com"]
-        with subprocess.Popen(
-                git_cmds, stdout=subprocess.PIPE, text=True, cwd=dir_path
-        ) as p:
-            output, errors = p.communicate()
-        print(output)
-        print(errors)
+        rc = CommonPSCommands.run_command(git_cmds, text=True, cwd=dir_path)
+        return rc
 
     @staticmethod
     def create_ssh_key():
@@ -2022,12 +3085,8 @@ class GitProjectManager:
         # https://docs.github.com/en/github-ae@latest/github/authenticating-to-github/generating-a-new-ssh-key-and-adding-it-to-the-ssh-agent
         dir_path = os.getcwd()
         git_cmds = ["ssh", "-T", "git@github.com"]
-        with subprocess.Popen(
-                git_cmds, stdout=subprocess.PIPE, text=True, cwd=dir_path
-        ) as p:
-            output, errors = p.communicate()
-        print(output)
-        print(errors)
+        rc = CommonPSCommands.run_command(git_cmds, text=True, cwd=dir_path)
+        return rc
 
 
 class LocalProjectManager:
@@ -2038,6 +3097,7 @@ class LocalProjectManager:
             clean_env_name: str = "hello_world",
             python_version: str = "3.9",
             add_git: bool = False,
+            use_warm_pool: bool = False,
     ) -> int:
         """
 
@@ -2048,11 +3108,14 @@ class LocalProjectManager:
         :type python_version: str
         :param add_git: Initialize the current directory with `git init` (Default value = False)
         :type add_git: bool
+        :param use_warm_pool: Claim a pre-built env from CondaWarmPool and refill the pool in the background
+            (Default value = False)
+        :type use_warm_pool: bool
         :returns: 0
         :rtype: int
 
         """
-        CondaEnvManager.create_and_init_conda_env(clean_env_name, python_version)
+        LocalProjectManager.create_and_init_conda_env(clean_env_name, python_version, use_warm_pool=use_warm_pool)
         PoetryProjectManager.execute_poetry_init(clean_env_name)
         PoetryProjectManager.link_poetry_proj_with_conda_env(clean_env_name)
         if add_git:
@@ -2071,9 +3134,71 @@ class LocalProjectManager:
         )
         return rc
 
+    @staticmethod
+    def create_and_init_conda_env(
+            clean_env_name: str, python_version: str, use_warm_pool: bool = False, explicit_spec_path: str = None
+    ) -> None:
+        """
+        CondaEnvManager.create_and_init_conda_env, or claiming an env from CondaWarmPool if use_warm_pool is True, or
+        recreating the env from an explicit spec (exported from a bootstrapped env) if explicit_spec_path is given
+
+        :param clean_env_name:
+        :type clean_env_name: str
+        :param python_version:
+        :type python_version: str
+        :param use_warm_pool:  (Default value = False)
+        :type use_warm_pool: bool
+        :param explicit_spec_path:  (Default value = None)
+        :type explicit_spec_path: str
+        :rtype: None
+
+        """
+        if explicit_spec_path:
+            rc = CondaEnvManager.create_conda_env_from_explicit_spec(clean_env_name, explicit_spec_path)
+            assert rc == 0
+            rc = CondaEnvManager.register_kernel(clean_env_name)
+            assert rc == 0
+            return
+        if use_warm_pool and CondaWarmPool.claim(python_version, clean_env_name):
+            rc = CondaEnvManager.register_kernel(clean_env_name)
+            assert rc == 0
+        else:
+            CondaEnvManager.create_and_init_conda_env(clean_env_name, python_version)
+        if use_warm_pool:
+            CondaWarmPool.refill_in_background(python_version)
+
+    @staticmethod
+    def hydrate_conda_env_from_poetry_lock(clean_env_name: str, poetry_lock_path: str, extras: List[str] = None):
+        """
+        LockHydrator.hydrate, followed by `poetry install` if some locked packages (i.e. git dependencies) had to be
+        skipped
+
+        :param clean_env_name:
+        :type clean_env_name: str
+        :param poetry_lock_path:
+        :type poetry_lock_path: str
+        :param extras:  (Default value = None)
+        :type extras: List[str]
+        :rtype: HydrationReport
+
+        """
+        report = LockHydrator.hydrate(clean_env_name, poetry_lock_path, extras=extras)
+        print(f"Installed {len(report.installed)} locked packages into {clean_env_name!r} in {report.duration:.1f}s")
+        if report.rc == 0 and report.skipped:
+            extras_options = " ".join(f"-E {e}" for e in (extras or []))
+            rc = PoetryProjectManager.poetry_install(
+                Path(poetry_lock_path).parent.as_posix(), clean_env_name, options=extras_options
+            )
+            report = report._replace(rc=rc)
+        return report
+
     @staticmethod
     def create_init_link_conda_env_to_existing_poetry_project(
-            clean_env_name: str = "hello_world", python_version: str = "3.9"
+            clean_env_name: str = "hello_world",
+            python_version: str = "3.9",
+            use_warm_pool: bool = False,
+            explicit_spec_path: str = None,
+            hydrate_from_lock: bool = False,
     ):
         """
 
@@ -2083,11 +3208,25 @@ class LocalProjectManager:
         :type clean_env_name: str
         :param python_version:  (Default value = "3.9")
         :type python_version: str
+        :param use_warm_pool: see init_current_dir_as_a_poetry_conda_project  (Default value = False)
+        :type use_warm_pool: bool
+        :param explicit_spec_path: see LocalProjectManager.create_and_init_conda_env  (Default value = None)
+        :type explicit_spec_path: str
+        :param hydrate_from_lock: install the packages of poetry.lock with LockHydrator (when there is one) before
+            poetry touches the env; whatever it skips is installed by `poetry install`  (Default value = False)
+        :type hydrate_from_lock: bool
 
         """
-        CondaEnvManager.create_and_init_conda_env(clean_env_name, python_version)
+        LocalProjectManager.create_and_init_conda_env(
+            clean_env_name, python_version, use_warm_pool=use_warm_pool, explicit_spec_path=explicit_spec_path
+        )
         PoetryProjectManager.link_poetry_proj_with_conda_env(clean_env_name)
         cur_dir = os.getcwd()
+        poetry_lock_path = Path(cur_dir).joinpath("poetry.lock")
+        if hydrate_from_lock and poetry_lock_path.exists():
+            report = LocalProjectManager.hydrate_conda_env_from_poetry_lock(clean_env_name, poetry_lock_path)
+            if report.rc != 0:
+                return report.rc
         rc = PoetryProjectManager.add_notebook_ipykernel_dependencies_to_pypoetry(clean_env_name, cur_dir)
         return rc
 
@@ -2097,6 +3236,9 @@ class LocalProjectManager:
             src_path_to_reqs: str = None,
             dest_path_to_pyproject_toml: str = None,
             warn_before_add=True,
+            add_mode: str = "each",
+            incremental: bool = False,
+            prune: bool = False,
     ):
         """
 
@@ -2110,6 +3252,12 @@ class LocalProjectManager:
         :param try_pinned_versions:  (Default value = False)
         :type try_pinned_versions: bool
         :param warn_before_add:  (Default value = True)
+        :param add_mode: see iterate_and_add_dependencies  (Default value = "each")
+        :type add_mode: str
+        :param incremental: see iterate_and_add_dependencies  (Default value = False)
+        :type incremental: bool
+        :param prune: see iterate_and_add_dependencies  (Default value = False)
+        :type prune: bool
 
         """
         cur_dir = Path(".").resolve()
@@ -2131,19 +3279,95 @@ class LocalProjectManager:
             poetry_proj_conda_env_name=poetry_proj_conda_env_name,
             path_to_requirements_txt=path_to_reqs.as_posix(),
             warn_before_add=warn_before_add,
+            add_mode=add_mode,
+            incremental=incremental,
+            prune=prune,
         )
         return rc
 
     @staticmethod
     def iterate_and_add_dependencies(toml_file_dependencies_section_dict, dest_pyproject_toml_dir: str,
                                      poetry_proj_conda_env_name: str, toml_section_type: str = "",
-                                     warn_before_add: bool = True):
+                                     warn_before_add: bool = True, add_mode: str = "each",
+                                     incremental: bool = False, prune: bool = False):
+        """
+
+        add_mode "each" runs (and optionally prompts for) one `poetry add` per dependency; "bulk" adds every dependency
+        with its pin in a single poetry transaction, bisecting to isolate (and retry unpinned) the ones that fail
+
+        :param toml_file_dependencies_section_dict: dependency name -> pin
+        :param dest_pyproject_toml_dir:
+        :type dest_pyproject_toml_dir: str
+        :param poetry_proj_conda_env_name:
+        :type poetry_proj_conda_env_name: str
+        :param toml_section_type: "dev" to add the dependencies with -D  (Default value = "")
+        :type toml_section_type: str
+        :param warn_before_add:  (Default value = True)
+        :type warn_before_add: bool
+        :param add_mode: "each", "bulk" or "direct" (edit pyproject.toml, then one `poetry lock --no-update` and one
+            `poetry install`, see PoetryProjectManager.add_dependencies_directly)  (Default value = "each")
+        :type add_mode: str
+        :param incremental: only add the dependencies that are missing from (or pinned differently in) the destination
+            pyproject.toml/poetry.lock, see DependencySyncPlanner  (Default value = False)
+        :type incremental: bool
+        :param prune: with incremental, also remove the destination dependencies the source doesn't have, nothing is
+            removed when the source has no such table (toml_file_dependencies_section_dict is None)
+            (Default value = False)
+        :type prune: bool
+        :returns: 0, or a non-zero rc if add_mode is "bulk"/"direct" and some dependencies could not be added
+        :rtype: int
+
+        """
+        assert add_mode in ("each", "bulk", "direct"), f"Unknown add_mode {add_mode!r}"
+        dependency_type = toml_section_type
         if toml_section_type == "dev":
             toml_section_type = "development"
             options = "-D"
         else:
             toml_section_type = "required"
             options = ""
+        to_remove = []
+        if incremental:
+            plan = DependencySyncPlanner.plan(toml_file_dependencies_section_dict, dest_pyproject_toml_dir,
+                                              dependency_type=dependency_type,
+                                              compare_constraints=add_mode != "each")
+            print(plan.describe())
+            if prune and (toml_file_dependencies_section_dict is not None):
+                to_remove = plan.remove
+            toml_file_dependencies_section_dict = plan.changes
+            if not (toml_file_dependencies_section_dict or to_remove):
+                return 0
+            if to_remove and add_mode != "direct":
+                rc = PoetryProjectManager.poetry_remove(
+                    f"{options} {' '.join(to_remove)}".strip(), dest_pyproject_toml_dir, poetry_proj_conda_env_name
+                )
+                if rc != 0:
+                    print(f"Unable to remove {to_remove}")
+                    return rc
+                if not toml_file_dependencies_section_dict:
+                    return 0
+        if add_mode in ("bulk", "direct"):
+            if warn_before_add:
+                resp = input(
+                    f"Would you like to add {len(toml_file_dependencies_section_dict)} {toml_section_type} dependencies to {poetry_proj_conda_env_name!r} in a single transaction?\nEnter [q] to break, enter to continue"
+                )
+                if resp.lower() == "q":
+                    print("Now raising Exception to exit")
+                    raise Exception
+            if add_mode == "direct":
+                return PoetryProjectManager.add_dependencies_directly(
+                    dir_containing_pyproject_toml=dest_pyproject_toml_dir,
+                    poetry_proj_conda_env_name=poetry_proj_conda_env_name,
+                    dependencies_by_type={dependency_type: toml_file_dependencies_section_dict},
+                    remove_by_type={dependency_type: to_remove},
+                )
+            status = PoetryProjectManager.add_dependencies_in_bulk(
+                dir_containing_pyproject_toml=dest_pyproject_toml_dir,
+                poetry_proj_conda_env_name=poetry_proj_conda_env_name,
+                dependencies=toml_file_dependencies_section_dict,
+                options=options,
+            )
+            return int("failed" in status.values())
         for dependency_name, dependency_val in toml_file_dependencies_section_dict.items():
             dep_str = f"{dependency_name}"
             if dep_str.lower() != "python":
@@ -2186,7 +3410,10 @@ class LocalProjectManager:
             src_pyproject_toml: str = None,
             dest_pyproject_toml: str = None,
             warn_before_add: bool = True,
-            dependency_section_name: str = ""):
+            dependency_section_name: str = "",
+            add_mode: str = "each",
+            incremental: bool = False,
+            prune: bool = False):
         """
 
         if dependency_section_name is empty, read both required and dev dependencies from .toml file
@@ -2199,16 +3426,22 @@ class LocalProjectManager:
         :type dest_pyproject_toml: str
         :param warn_before_add:  (Default value = True)
         :type warn_before_add: bool
+        :param add_mode: see iterate_and_add_dependencies, with "direct" the required and dev dependencies are
+            copied over and resolved in a single `poetry lock`  (Default value = "each")
+        :type add_mode: str
+        :param incremental: see iterate_and_add_dependencies  (Default value = False)
+        :type incremental: bool
+        :param prune: see iterate_and_add_dependencies  (Default value = False)
+        :type prune: bool
 
         """
 
         assert Path(src_pyproject_toml).resolve().exists() and Path(dest_pyproject_toml).resolve().exists()
 
-        dependencies = CommonPSCommands.read_toml(src_pyproject_toml, dependency_section_name)
+        dependencies = CommonPSCommands.read_toml(src_pyproject_toml, "")
         if dependency_section_name:
-            dep_dict = {}
-            dep_dict[dependency_section_name] = dependencies.copy()
-            dependencies = dep_dict.copy()
+            # a missing table stays None, so prune doesn't empty the destination
+            dependencies = {dependency_section_name: dependencies.get(dependency_section_name)}
         dest_pyproject_toml_dir = Path(dest_pyproject_toml).parent.as_posix()
         dev_dependency_section_specified = ("dev-dependencies" in dependency_section_name)
 
@@ -2219,14 +3452,49 @@ class LocalProjectManager:
         else:
             dependency_type = "all"
 
-        if (dependency_type == "all") or dev_dependency_section_specified:
+        if add_mode == "direct":
+            dependencies_by_type = {}
+            if (dependency_type == "all") or dev_dependency_section_specified:
+                dependencies_by_type["dev"] = dependencies.get(
+                    dependency_section_name or 'tool.poetry.dev-dependencies'
+                )
+            if (dependency_type == "all") or (not dev_dependency_section_specified):
+                dependencies_by_type[""] = dependencies.get(dependency_section_name or "tool.poetry.dependencies")
+            remove_by_type = {}
+            if incremental:
+                for section_type, section_dependencies in list(dependencies_by_type.items()):
+                    plan = DependencySyncPlanner.plan(section_dependencies, dest_pyproject_toml_dir,
+                                                      dependency_type=section_type)
+                    print(plan.describe())
+                    dependencies_by_type[section_type] = plan.changes
+                    remove_by_type[section_type] = plan.remove if prune and (section_dependencies is not None) else []
+                nothing_to_sync = not any(dependencies_by_type.values()) and not any(remove_by_type.values())
+                if nothing_to_sync:
+                    return 0
+            if warn_before_add:
+                resp = input(
+                    f"Would you like to copy the dependencies of {src_pyproject_toml!r} to {dest_pyproject_toml!r}?\nEnter [q] to break, enter to continue"
+                )
+                if resp.lower() == "q":
+                    print("Now raising Exception to exit")
+                    raise Exception
+            return PoetryProjectManager.add_dependencies_directly(
+                dir_containing_pyproject_toml=dest_pyproject_toml_dir,
+                poetry_proj_conda_env_name=poetry_proj_conda_env_name,
+                dependencies_by_type=dependencies_by_type,
+                remove_by_type=remove_by_type,
+            )
+        if (dependency_type == "all") or dev_dependency_section_specified:
             toml_section_type = "dev"
             dev_dependencies = dependencies.get('tool.poetry.dev-dependencies')
             LocalProjectManager.iterate_and_add_dependencies(toml_file_dependencies_section_dict=dev_dependencies,
                                                              toml_section_type=toml_section_type,
                                                              dest_pyproject_toml_dir=dest_pyproject_toml_dir,
                                                              poetry_proj_conda_env_name=poetry_proj_conda_env_name,
-                                                             warn_before_add=warn_before_add)
+                                                             warn_before_add=warn_before_add,
+                                                             add_mode=add_mode,
+                                                             incremental=incremental,
+                                                             prune=prune)
         if (dependency_type == "all") or (not dev_dependency_section_specified):
             toml_section_type = ""
             if dependency_section_name:
@@ -2237,7 +3505,10 @@ class LocalProjectManager:
                                                              toml_section_type=toml_section_type,
                                                              dest_pyproject_toml_dir=dest_pyproject_toml_dir,
                                                              poetry_proj_conda_env_name=poetry_proj_conda_env_name,
-                                                             warn_before_add=warn_before_add)
+                                                             warn_before_add=warn_before_add,
+                                                             add_mode=add_mode,
+                                                             incremental=incremental,
+                                                             prune=prune)
         return 0
 
     @staticmethod
@@ -2274,12 +3545,16 @@ class LocalProjectManager:
         return rc, path_to_requirements_txt
 
     @staticmethod
-    def create_conda_env_for_existing_pyproject_toml(pyproject_toml_path: str):
+    def create_conda_env_for_existing_pyproject_toml(pyproject_toml_path: str, explicit_spec_path: str = None,
+                                                     hydrate_from_lock: bool = False):
         """
         This creates a conda env for a pre-existing pyproject.toml file. This function should be used if one is interested
         in using conda instead of .venv for a virtual environment.
 
         :param str pyproject_toml_path:
+        :param str explicit_spec_path: recreate the env from this explicit spec (see CondaEnvManager.export_explicit_spec)
+            instead of solving it
+        :param bool hydrate_from_lock: install the adjacent poetry.lock with LockHydrator
         :return:
         """
         old_path = os.getcwd()
@@ -2294,12 +3569,5203 @@ class LocalProjectManager:
                                                                                    both=True)
         python_version = toml_dict.get('tool.poetry.dependencies', {}).get('python', {})
         assert conda_env_name_available and python_version
-        rc = LocalProjectManager.create_init_link_conda_env_to_existing_poetry_project(clean_env_name=project_name,
-                                                                                       python_version=python_version)
+        if explicit_spec_path:
+            explicit_spec_path = Path(old_path).joinpath(explicit_spec_path).as_posix()
+        rc = LocalProjectManager.create_init_link_conda_env_to_existing_poetry_project(
+            clean_env_name=project_name, python_version=python_version, explicit_spec_path=explicit_spec_path,
+            hydrate_from_lock=hydrate_from_lock,
+        )
         os.chdir(old_path)  # Go back to old dir
         return rc
 
 
+class CondaEnvRecord(NamedTuple):
+    """
+    A conda env as found on disk by CondaEnvIndex
+    """
+
+    name: str
+    prefix: str
+    python_version: str
+    mtime: float
+
+
+class CondaEnvIndex:
+    """
+    Lists conda envs without running `conda info --envs`.
+
+    Envs are read from ~/.conda/environments.txt, the subdirectories of every envs dir and the base prefix, and only
+    directories with a conda-meta/history file count as envs (the same check conda uses). The index is rebuilt when
+    environments.txt, an envs dir or any env's history changes.
+    """
+
+    _index = None
+    _lock = threading.Lock()
+    _python_meta_pattern = re.compile(r"python-(\d[^-]*)-[^-]+\.json")
+
+    @staticmethod
+    def get_conda_base() -> str:
+        """
+        Derives the conda base from CONDA_EXE or the conda executable on PATH, only falling back to
+        CondaEnvManager.get_conda_base (which runs `conda info --base`) if neither exists
+
+        :rtype: str
+
+        """
+        conda_exe = os.environ.get("CONDA_EXE") or shutil.which("conda")
+        if conda_exe:
+            conda_base = Path(conda_exe).resolve().parent.parent
+            if conda_base.joinpath("conda-meta").is_dir():
+                return conda_base.as_posix()
+        return CondaEnvManager.get_conda_base()
+
+    @staticmethod
+    def get_envs_dirs(conda_base: str) -> List[Path]:
+        """
+        Returns the envs dirs in conda's order: the env vars, envs_dirs of every .condarc (see
+        CondarcEditor.get_search_path, highest precedence first) and then the defaults
+
+        :param conda_base:
+        :type conda_base: str
+        :rtype: List[Path]
+
+        """
+        envs_dirs = []
+        for env_var in ("CONDA_ENVS_PATH", "CONDA_ENVS_DIRS"):
+            envs_dirs.extend(Path(p).expanduser() for p in os.environ.get(env_var, "").split(os.pathsep) if p)
+        for condarc_path in reversed(CondarcEditor.get_search_path(conda_base)):
+            for envs_dir in CondarcEditor.read_sequence(condarc_path, "envs_dirs"):
+                envs_dirs.append(Path(os.path.expandvars(envs_dir)).expanduser())
+        envs_dirs.append(Path(conda_base).joinpath("envs"))
+        envs_dirs.append(Path("~/.conda/envs").expanduser())
+        return list(dict.fromkeys(envs_dirs))
+
+    @staticmethod
+    def get_environments_txt() -> Path:
+        """ """
+        return Path("~/.conda/environments.txt").expanduser()
+
+    @staticmethod
+    def get_stamp(path) -> Union[int, None]:
+        """
+        Returns the mtime of path in ns, or None if it doesn't exist
+
+        :param path:
+
+        """
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def get_python_version(prefix: str) -> str:
+        """
+        Reads the python version from the conda-meta record of the python package, "" if python isn't installed
+
+        :param prefix:
+        :type prefix: str
+        :rtype: str
+
+        """
+        try:
+            with os.scandir(Path(prefix).joinpath("conda-meta")) as entries:
+                for entry in entries:
+                    match = CondaEnvIndex._python_meta_pattern.fullmatch(entry.name)
+                    if match:
+                        return match.group(1)
+        except OSError:
+            pass
+        return ""
+
+    @staticmethod
+    def get_known_prefixes(conda_base: str, envs_dirs: List[Path]) -> List[str]:
+        """
+        Returns every prefix that contains a conda env, sorted like `conda info --envs`
+
+        :param conda_base:
+        :type conda_base: str
+        :param envs_dirs:
+        :type envs_dirs: List[Path]
+        :rtype: List[str]
+
+        """
+        candidates = {os.path.normpath(conda_base)}
+        for envs_dir in envs_dirs:
+            try:
+                with os.scandir(envs_dir) as entries:
+                    candidates.update(os.path.normpath(e.path) for e in entries if e.is_dir())
+            except OSError:
+                continue
+        try:
+            with open(CondaEnvIndex.get_environments_txt(), "r") as f:
+                candidates.update(os.path.normpath(l.strip()) for l in f if l.strip())
+        except OSError:
+            pass
+        return sorted(p for p in candidates if os.path.isfile(os.path.join(p, "conda-meta", "history")))
+
+    @staticmethod
+    def get_env_name(prefix: str, conda_base: str, envs_dirs: List[Path]) -> str:
+        """
+        Names prefixes like conda does: "base", the folder name for envs in an envs dir and "" for everything else
+
+        :param prefix:
+        :type prefix: str
+        :param conda_base:
+        :type conda_base: str
+        :param envs_dirs:
+        :type envs_dirs: List[Path]
+        :rtype: str
+
+        """
+        if prefix == os.path.normpath(conda_base):
+            return "base"
+        if any(os.path.dirname(prefix) == os.path.normpath(envs_dir) for envs_dir in envs_dirs):
+            return os.path.basename(prefix)
+        return ""
+
+    @staticmethod
+    def get_dirs_signature(conda_base: str, envs_dirs: List[Path]) -> tuple:
+        """
+        Stamps environments.txt and the envs dirs, which change whenever an env is created, renamed or removed, and the
+        .condarc files envs dirs are read from
+
+        :param conda_base:
+        :type conda_base: str
+        :param envs_dirs:
+        :type envs_dirs: List[Path]
+        :rtype: tuple
+
+        """
+        paths = [CondaEnvIndex.get_environments_txt()] + envs_dirs + CondarcEditor.get_search_path(conda_base)
+        return tuple(CondaEnvIndex.get_stamp(p) for p in paths)
+
+    @staticmethod
+    def get_signature(conda_base: str, envs_dirs: List[Path], prefixes) -> tuple:
+        """ """
+        history_paths = [os.path.join(p, "conda-meta", "history") for p in prefixes]
+        dirs_signature = CondaEnvIndex.get_dirs_signature(conda_base, envs_dirs)
+        return dirs_signature + tuple(CondaEnvIndex.get_stamp(p) for p in history_paths)
+
+    @staticmethod
+    def build(conda_base: str = None) -> Dict[str, Any]:
+        """
+        Scans the disk and returns the records, a dict of records by name and the signature used to validate them
+
+        :param conda_base:  (Default value = None)
+        :type conda_base: str
+        :rtype: Dict[str, Any]
+
+        """
+        if conda_base is None:
+            conda_base = CondaEnvIndex.get_conda_base()
+        envs_dirs = CondaEnvIndex.get_envs_dirs(conda_base)
+        prefixes = CondaEnvIndex.get_known_prefixes(conda_base, envs_dirs)
+        records = []
+        history_stamps = {}
+        for prefix in prefixes:
+            history_stamp = CondaEnvIndex.get_stamp(os.path.join(prefix, "conda-meta", "history"))
+            history_stamps[prefix] = history_stamp
+            records.append(
+                CondaEnvRecord(
+                    name=CondaEnvIndex.get_env_name(prefix, conda_base, envs_dirs),
+                    prefix=prefix,
+                    python_version=CondaEnvIndex.get_python_version(prefix),
+                    mtime=history_stamp / 1e9,
+                )
+            )
+        by_name = {}
+        for record in records:
+            if record.name:
+                by_name.setdefault(record.name, record)
+        return {
+            "conda_base": conda_base,
+            "envs_dirs": envs_dirs,
+            "records": tuple(records),
+            "by_name": by_name,
+            "history_stamps": history_stamps,
+            "dirs_signature": CondaEnvIndex.get_dirs_signature(conda_base, envs_dirs),
+            "signature": CondaEnvIndex.get_signature(conda_base, envs_dirs, prefixes),
+        }
+
+    @staticmethod
+    def get_index(refresh: bool = False) -> Dict[str, Any]:
+        """
+        Returns the cached index, rebuilding it if refresh is True or anything it was built from changed
+
+        :param refresh:  (Default value = False)
+        :type refresh: bool
+        :rtype: Dict[str, Any]
+
+        """
+        with CondaEnvIndex._lock:
+            index = CondaEnvIndex._index
+        if (index is not None) and (not refresh):
+            prefixes = [r.prefix for r in index["records"]]
+            signature = CondaEnvIndex.get_signature(index["conda_base"], index["envs_dirs"], prefixes)
+            if signature == index["signature"]:
+                return index
+        index = CondaEnvIndex.build()
+        with CondaEnvIndex._lock:
+            CondaEnvIndex._index = index
+        return index
+
+    @staticmethod
+    def get_records(refresh: bool = False) -> List[CondaEnvRecord]:
+        """
+
+        :param refresh:  (Default value = False)
+        :type refresh: bool
+        :rtype: List[CondaEnvRecord]
+
+        """
+        return list(CondaEnvIndex.get_index(refresh=refresh)["records"])
+
+    @staticmethod
+    def lookup(env_name: str) -> Union[CondaEnvRecord, None]:
+        """
+        Returns the record of env_name, or None if no env with that name exists.
+
+        Only environments.txt, the envs dirs, the .condarc files and the history of the returned env are stat'ed,
+        rather than every env's history like get_index does.
+
+        :param env_name:
+        :type env_name: str
+        :rtype: Union[CondaEnvRecord, None]
+
+        """
+        with CondaEnvIndex._lock:
+            index = CondaEnvIndex._index
+        is_current = (index is not None) and (
+            CondaEnvIndex.get_dirs_signature(index["conda_base"], index["envs_dirs"]) == index["dirs_signature"]
+        )
+        if is_current:
+            record = index["by_name"].get(env_name)
+            if record is None:
+                return None
+            history_path = os.path.join(record.prefix, "conda-meta", "history")
+            if CondaEnvIndex.get_stamp(history_path) == index["history_stamps"][record.prefix]:
+                return record
+        return CondaEnvIndex.get_index(refresh=True)["by_name"].get(env_name)
+
+    @staticmethod
+    def invalidate():
+        """ """
+        with CondaEnvIndex._lock:
+            CondaEnvIndex._index = None
+
+
+class KernelSpecRecord(NamedTuple):
+    """
+    An installed Jupyter kernelspec as found by KernelSpecIndex
+    """
+
+    name: str
+    resource_dir: str
+    spec: Dict[str, Any]
+
+
+class KernelSpecIndex:
+    """
+    Lists Jupyter kernelspecs without running `jupyter kernelspec list`.
+
+    The kernels directories of the standard Jupyter data paths (JUPYTER_PATH, the user data dir, sys.prefix and the
+    system dirs) are searched in the same order Jupyter uses, so the first kernelspec with a name wins. Directory
+    listings are cached by directory mtime and every kernel.json is parsed once per (mtime, size).
+    """
+
+    _listings = {}
+    _specs = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_user_data_dir() -> Path:
+        """ """
+        if os.environ.get("JUPYTER_DATA_DIR"):
+            return Path(os.environ["JUPYTER_DATA_DIR"]).expanduser()
+        if platform.system() == "Windows":
+            return Path(os.environ.get("APPDATA", Path("~").expanduser())).joinpath("jupyter")
+        if platform.system() == "Darwin":
+            return Path("~/Library/Jupyter").expanduser()
+        xdg_data_home = os.environ.get("XDG_DATA_HOME") or Path("~/.local/share").expanduser()
+        return Path(xdg_data_home).joinpath("jupyter")
+
+    @staticmethod
+    def get_jupyter_paths() -> List[Path]:
+        """
+        Returns the Jupyter data paths in order of precedence
+
+        :rtype: List[Path]
+
+        """
+        jupyter_paths = [Path(p).expanduser() for p in os.environ.get("JUPYTER_PATH", "").split(os.pathsep) if p]
+        jupyter_paths.append(KernelSpecIndex.get_user_data_dir())
+        for prefix in (sys.prefix, os.environ.get("CONDA_PREFIX")):
+            if prefix:
+                jupyter_paths.append(Path(prefix).joinpath("share", "jupyter"))
+        if platform.system() == "Windows":
+            jupyter_paths.append(Path(os.environ.get("PROGRAMDATA", "C:\\ProgramData")).joinpath("jupyter"))
+        else:
+            jupyter_paths += [Path("/usr/local/share/jupyter"), Path("/usr/share/jupyter")]
+        return list(dict.fromkeys(jupyter_paths))
+
+    @staticmethod
+    def get_kernel_dirs() -> List[Path]:
+        """ """
+        return [p.joinpath("kernels") for p in KernelSpecIndex.get_jupyter_paths()]
+
+    @staticmethod
+    def list_kernel_dir(kernel_dir: Path) -> Dict[str, str]:
+        """
+        Returns {kernel name: resource dir} for one kernels directory, cached by the directory's mtime
+
+        :param kernel_dir:
+        :type kernel_dir: Path
+        :rtype: Dict[str, str]
+
+        """
+        try:
+            mtime = os.stat(kernel_dir).st_mtime_ns
+        except OSError:
+            return {}
+        with KernelSpecIndex._lock:
+            cached = KernelSpecIndex._listings.get(kernel_dir)
+        if (cached is not None) and (cached[0] == mtime):
+            return cached[1]
+        listing = {}
+        try:
+            with os.scandir(kernel_dir) as entries:
+                for entry in entries:
+                    is_hidden = entry.name.startswith(".")
+                    if (not is_hidden) and entry.is_dir() and os.path.isfile(os.path.join(entry.path, "kernel.json")):
+                        listing[entry.name.lower()] = entry.path
+        except OSError:
+            pass
+        with KernelSpecIndex._lock:
+            KernelSpecIndex._listings[kernel_dir] = (mtime, listing)
+        return listing
+
+    @staticmethod
+    def load_spec(kernel_json_path) -> Dict[str, Any]:
+        """
+        Returns the parsed kernel.json; it's only read again if its mtime or size changed.
+        The returned dict is shared, copy it before modifying it.
+
+        :param kernel_json_path:
+        :rtype: Dict[str, Any]
+
+        """
+        kernel_json_path = os.path.normpath(kernel_json_path)
+        st = os.stat(kernel_json_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with KernelSpecIndex._lock:
+            cached = KernelSpecIndex._specs.get(kernel_json_path)
+        if (cached is not None) and (cached[0] == stamp):
+            return cached[1]
+        with open(kernel_json_path, "r") as f:
+            spec = json.load(f)
+        with KernelSpecIndex._lock:
+            KernelSpecIndex._specs[kernel_json_path] = (stamp, spec)
+        return spec
+
+    @staticmethod
+    def get_specs() -> Dict[str, KernelSpecRecord]:
+        """
+        Returns {kernel name: KernelSpecRecord} for every installed kernelspec
+
+        :rtype: Dict[str, KernelSpecRecord]
+
+        """
+        resource_dirs = {}
+        for kernel_dir in KernelSpecIndex.get_kernel_dirs():
+            for name, resource_dir in KernelSpecIndex.list_kernel_dir(kernel_dir).items():
+                resource_dirs.setdefault(name, resource_dir)
+        specs = {}
+        for name in sorted(resource_dirs):
+            try:
+                spec = KernelSpecIndex.load_spec(os.path.join(resource_dirs[name], "kernel.json"))
+            except (OSError, ValueError):
+                continue  # removed in the meantime or not valid json
+            specs[name] = KernelSpecRecord(name, resource_dirs[name], spec)
+        return specs
+
+    @staticmethod
+    def get_records() -> List[KernelSpecRecord]:
+        """ """
+        return list(KernelSpecIndex.get_specs().values())
+
+    @staticmethod
+    def lookup(kernel_name: str) -> Union[KernelSpecRecord, None]:
+        """
+        Returns the record of kernel_name, or None if it isn't installed
+
+        :param kernel_name:
+        :type kernel_name: str
+        :rtype: Union[KernelSpecRecord, None]
+
+        """
+        kernel_name = kernel_name.lower()
+        for kernel_dir in KernelSpecIndex.get_kernel_dirs():
+            resource_dir = KernelSpecIndex.list_kernel_dir(kernel_dir).get(kernel_name)
+            if resource_dir is None:
+                continue
+            try:
+                spec = KernelSpecIndex.load_spec(os.path.join(resource_dir, "kernel.json"))
+            except (OSError, ValueError):
+                continue
+            return KernelSpecRecord(kernel_name, resource_dir, spec)
+        return None
+
+    @staticmethod
+    def invalidate():
+        """ """
+        with KernelSpecIndex._lock:
+            KernelSpecIndex._listings.clear()
+            KernelSpecIndex._specs.clear()
+
+
+class KernelSpecInstaller:
+    """
+    Writes and removes Jupyter kernelspec directories directly, instead of importing IPython
+    (`ipython kernel install`) or jupyter (`jupyter kernelspec uninstall`).
+
+    A kernelspec is staged next to the kernels directory and renamed into place, so Jupyter never sees a half written
+    kernel.json, and removals rename the directory out of the kernels directory before deleting it.
+    """
+
+    kernel_name_pattern = re.compile(r"[a-z0-9._-]+", re.IGNORECASE)
+    logo_names = ("logo-32x32.png", "logo-64x64.png", "logo-svg.svg")
+
+    @staticmethod
+    def get_env_python(env_prefix: str) -> str:
+        """
+
+        :param env_prefix:
+        :type env_prefix: str
+        :rtype: str
+
+        """
+        if platform.system() == "Windows":
+            return Path(env_prefix).joinpath("python.exe").as_posix()
+        return Path(env_prefix).joinpath("bin", "python").as_posix()
+
+    @staticmethod
+    def get_site_packages_dirs(env_prefix: str) -> List[Path]:
+        """
+
+        :param env_prefix:
+        :type env_prefix: str
+        :rtype: List[Path]
+
+        """
+        env_prefix = Path(env_prefix)
+        return [env_prefix.joinpath("Lib", "site-packages")] + sorted(env_prefix.glob("lib/python*/site-packages"))
+
+    @staticmethod
+    def find_ipykernel_dir(env_prefix: str) -> Union[Path, None]:
+        """
+        Returns the ipykernel package directory of an env, or None if ipykernel isn't installed
+
+        :param env_prefix:
+        :type env_prefix: str
+
+        """
+        for site_packages in KernelSpecInstaller.get_site_packages_dirs(env_prefix):
+            if site_packages.joinpath("ipykernel", "__init__.py").is_file():
+                return site_packages.joinpath("ipykernel")
+        return None
+
+    @staticmethod
+    def find_logo_dir(env_prefix: str) -> Union[Path, None]:
+        """
+        Returns the directory holding ipykernel's logos for an env, or None if there aren't any
+
+        :param env_prefix:
+        :type env_prefix: str
+
+        """
+        candidates = [Path(env_prefix).joinpath("share", "jupyter", "kernels", "python3")]
+        ipykernel_dir = KernelSpecInstaller.find_ipykernel_dir(env_prefix)
+        if ipykernel_dir is not None:
+            candidates.append(ipykernel_dir.joinpath("resources"))
+        for candidate in candidates:
+            if any(candidate.joinpath(logo).is_file() for logo in KernelSpecInstaller.logo_names):
+                return candidate
+        return None
+
+    @staticmethod
+    def get_kernel_json(python_path: str, display_name: str) -> Dict[str, Any]:
+        """
+        Returns the same kernel.json contents `ipython kernel install` writes
+
+        :param python_path:
+        :type python_path: str
+        :param display_name:
+        :type display_name: str
+        :rtype: Dict[str, Any]
+
+        """
+        return {
+            "argv": [python_path, "-m", "ipykernel_launcher", "-f", "{connection_file}"],
+            "display_name": display_name,
+            "language": "python",
+            "metadata": {"debugger": True},
+        }
+
+    @staticmethod
+    def get_kernels_dir(user: bool = True, prefix: str = None) -> Path:
+        """
+        Returns the user kernels dir, or <prefix>/share/jupyter/kernels if user is False
+
+        :param user:  (Default value = True)
+        :type user: bool
+        :param prefix:  (Default value = None)
+        :type prefix: str
+        :rtype: Path
+
+        """
+        if user:
+            return KernelSpecIndex.get_user_data_dir().joinpath("kernels")
+        return Path(prefix or sys.prefix).joinpath("share", "jupyter", "kernels")
+
+    @staticmethod
+    def get_staging_dir(kernels_dir: Path) -> Path:
+        """
+        Returns a new empty directory next to kernels_dir (so renames out of it are atomic) that the caller removes
+
+        :param kernels_dir:
+        :type kernels_dir: Path
+        :rtype: Path
+
+        """
+        return Path(tempfile.mkdtemp(prefix=".kernelspec-staging-", dir=kernels_dir.parent))
+
+    @staticmethod
+    def install_kernel_spec(
+            kernel_name: str,
+            python_path: str,
+            display_name: str = None,
+            logo_dir: Path = None,
+            user: bool = True,
+            prefix: str = None,
+    ) -> Path:
+        """
+        Atomically writes (or replaces) the kernelspec kernel_name and returns its resource directory
+
+        :param kernel_name:
+        :type kernel_name: str
+        :param python_path: interpreter that runs ipykernel_launcher
+        :type python_path: str
+        :param display_name:  (Default value = None) defaults to kernel_name
+        :type display_name: str
+        :param logo_dir:  (Default value = None) directory to copy logo-*.png/svg files from
+        :type logo_dir: Path
+        :param user:  (Default value = True)
+        :type user: bool
+        :param prefix:  (Default value = None)
+        :type prefix: str
+        :rtype: Path
+
+        """
+        assert KernelSpecInstaller.kernel_name_pattern.fullmatch(kernel_name), f"Invalid kernel name {kernel_name!r}"
+        display_name = display_name or kernel_name
+        kernel_name = kernel_name.lower()
+        kernels_dir = KernelSpecInstaller.get_kernels_dir(user=user, prefix=prefix)
+        kernels_dir.mkdir(parents=True, exist_ok=True)
+        resource_dir = kernels_dir.joinpath(kernel_name)
+        staging_dir = KernelSpecInstaller.get_staging_dir(kernels_dir).joinpath(kernel_name)
+        try:
+            staging_dir.mkdir()
+            kernel_json = KernelSpecInstaller.get_kernel_json(python_path, display_name)
+            with open(staging_dir.joinpath("kernel.json"), "w") as f:
+                json.dump(kernel_json, f, indent=1)
+            if logo_dir is not None:
+                for logo in KernelSpecInstaller.logo_names:
+                    if Path(logo_dir).joinpath(logo).is_file():
+                        shutil.copyfile(Path(logo_dir).joinpath(logo), staging_dir.joinpath(logo))
+            if resource_dir.exists():
+                os.replace(resource_dir, staging_dir.with_name(f"{kernel_name}.old"))
+            os.replace(staging_dir, resource_dir)
+        finally:
+            shutil.rmtree(staging_dir.parent, ignore_errors=True)
+        KernelSpecIndex.invalidate()
+        return resource_dir
+
+    @staticmethod
+    def install_kernel_specs(env_prefixes: Dict[str, str], user: bool = True) -> Dict[str, Path]:
+        """
+        Registers many envs at once: {kernel name: env prefix} -> {kernel name: resource dir}
+
+        :param env_prefixes:
+        :type env_prefixes: Dict[str, str]
+        :param user:  (Default value = True)
+        :type user: bool
+        :rtype: Dict[str, Path]
+
+        """
+        return {
+            kernel_name: KernelSpecInstaller.install_kernel_spec(
+                kernel_name,
+                KernelSpecInstaller.get_env_python(env_prefix),
+                logo_dir=KernelSpecInstaller.find_logo_dir(env_prefix),
+                user=user,
+            )
+            for kernel_name, env_prefix in env_prefixes.items()
+        }
+
+    @staticmethod
+    def remove_kernel_specs(kernel_names: List[str]) -> Dict[str, bool]:
+        """
+        Removes the kernelspecs that Jupyter would resolve kernel_names to
+
+        :param kernel_names:
+        :type kernel_names: List[str]
+        :returns: {kernel name: True if it was removed, False if it didn't exist or couldn't be removed}
+        :rtype: Dict[str, bool]
+
+        """
+        all_specs = KernelSpecIndex.get_specs()
+        removed = {}
+        for kernel_name in kernel_names:
+            record = all_specs.get(kernel_name.lower())
+            if record is None:
+                removed[kernel_name] = False
+                continue
+            try:
+                removed[kernel_name] = KernelSpecInstaller.remove_resource_dir(record.resource_dir)
+            except OSError as e:
+                # e.g. a system-wide kernelspec the user can't write to, which shouldn't stop the other removals
+                print(f"Unable to remove kernel {kernel_name!r}: {e}")
+                removed[kernel_name] = False
+        KernelSpecIndex.invalidate()
+        return removed
+
+    @staticmethod
+    def remove_resource_dir(resource_dir: Union[str, Path]) -> bool:
+        """
+        Moves a kernelspec directory out of its kernels dir in one rename and deletes it. Doesn't invalidate
+        KernelSpecIndex.
+
+        :param resource_dir:
+        :type resource_dir: Union[str, Path]
+        :returns: True if it was removed, False if it didn't exist
+        :rtype: bool
+        :raises OSError: if it exists but can't be moved
+
+        """
+        resource_dir = Path(resource_dir)
+        trash_dir = KernelSpecInstaller.get_staging_dir(resource_dir.parent)
+        try:
+            os.replace(resource_dir, trash_dir.joinpath(resource_dir.name))
+            return True
+        except FileNotFoundError:
+            return False
+        finally:
+            shutil.rmtree(trash_dir, ignore_errors=True)
+
+    @staticmethod
+    def remove_kernel_spec(kernel_name: str) -> bool:
+        """
+
+        :param kernel_name:
+        :type kernel_name: str
+        :rtype: bool
+
+        """
+        return KernelSpecInstaller.remove_kernel_specs([kernel_name])[kernel_name]
+
+
+class TeardownResult(NamedTuple):
+    """
+    What CondaEnvTeardown did for one env
+    """
+
+    env_name: str
+    prefix: str
+    kernel_removed: bool
+    env_removed: bool
+    rc: int
+    duration: float
+    error: str
+
+
+class TeardownReport(NamedTuple):
+    """
+    Per-env results of a bulk teardown and how long the whole teardown took
+    """
+
+    results: List[TeardownResult]
+    duration: float
+
+    @property
+    def rc(self) -> int:
+        """ """
+        return 0 if all((r.rc == 0) and (not r.error) for r in self.results) else 1
+
+
+class CondaEnvTeardown:
+    """
+    Removes many conda envs and their kernels at once.
+
+    Envs and kernels are resolved from one snapshot of CondaEnvIndex and KernelSpecIndex, and each env and its kernel
+    are removed together by a bounded pool of worker threads, so a kernel is only removed once its env passed the
+    checks. An env whose packages ship pre-unlink scripts (or every env, when use_conda is True) is removed with
+    `conda env remove -p` instead.
+    """
+
+    max_workers = 4
+
+    @staticmethod
+    def has_pre_unlink_scripts(prefix: str) -> bool:
+        """
+        Returns True if a package in prefix needs conda to run a pre-unlink script before it's removed
+
+        :param prefix:
+        :type prefix: str
+        :rtype: bool
+
+        """
+        for scripts_dir in ("bin", "Scripts"):
+            try:
+                with os.scandir(os.path.join(prefix, scripts_dir)) as entries:
+                    if any("-pre-unlink." in entry.name for entry in entries):
+                        return True
+            except OSError:
+                continue
+        return False
+
+    @staticmethod
+    def get_protected_reason(prefix: str) -> str:
+        """
+        Returns why prefix must not be removed ("it's the active env" or "it's the base env"), or ""
+
+        :param prefix:
+        :type prefix: str
+        :rtype: str
+
+        """
+        real_prefix = os.path.realpath(prefix)
+        active_prefix = os.environ.get("CONDA_PREFIX")
+        if active_prefix and real_prefix == os.path.realpath(active_prefix):
+            return "it's the active env"
+        if real_prefix == os.path.realpath(CondaEnvIndex.get_conda_base()):
+            return "it's the base env"
+        return ""
+
+    @staticmethod
+    def remove_prefix(prefix: str, use_conda: bool = False) -> int:
+        """
+        Deletes an env prefix and returns 0 if it's gone afterwards
+
+        conda-meta/history is deleted first, so conda and CondaEnvIndex stop treating the prefix as an env even if the
+        rest of the tree can't be deleted. Like `conda remove --all`, it refuses to remove the active env or base.
+
+        :param prefix:
+        :type prefix: str
+        :param use_conda:  (Default value = False)
+        :type use_conda: bool
+        :rtype: int
+
+        """
+        protected_reason = CondaEnvTeardown.get_protected_reason(prefix)
+        assert not protected_reason, f"Refusing to remove {prefix!r}: {protected_reason}"
+        if use_conda or CondaEnvTeardown.has_pre_unlink_scripts(prefix):
+            conda_cmd = ["conda", "env", "remove", "-p", prefix, "-y"]
+            return CommonPSCommands.run_command(conda_cmd, text=True, verbose=False)
+        try:
+            os.remove(os.path.join(prefix, "conda-meta", "history"))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(prefix, ignore_errors=True)
+        return 0 if not os.path.exists(prefix) else 1
+
+    @staticmethod
+    def clean_environments_txt(removed_prefixes: List[str]):
+        """
+        Drops removed_prefixes from ~/.conda/environments.txt in one rewrite
+
+        :param removed_prefixes:
+        :type removed_prefixes: List[str]
+
+        """
+        environments_txt = CondaEnvIndex.get_environments_txt()
+        removed_prefixes = {os.path.normpath(p) for p in removed_prefixes}
+        try:
+            with open(environments_txt, "r") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        kept_lines = [l for l in lines if (not l.strip()) or os.path.normpath(l.strip()) not in removed_prefixes]
+        if len(kept_lines) == len(lines):
+            return
+        tmp_path = environments_txt.with_name(f"{environments_txt.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            f.writelines(kept_lines)
+        os.replace(tmp_path, environments_txt)
+
+    @staticmethod
+    def teardown(
+            env_names: List[str],
+            kernel_names: List[str] = None,
+            max_workers: int = None,
+            use_conda: bool = False,
+    ) -> TeardownReport:
+        """
+        Removes the envs in env_names and their kernels
+
+        :param env_names:
+        :type env_names: List[str]
+        :param kernel_names:  (Default value = None) kernel of each env, defaults to the env names
+        :type kernel_names: List[str]
+        :param max_workers:  (Default value = None) defaults to CondaEnvTeardown.max_workers
+        :type max_workers: int
+        :param use_conda: remove every env with `conda env remove -p`  (Default value = False)
+        :type use_conda: bool
+        :rtype: TeardownReport
+
+        """
+        start = time.perf_counter()
+        if kernel_names is None:
+            kernel_names = list(env_names)
+        assert len(kernel_names) == len(env_names), "Every env needs a kernel name"
+        index = CondaEnvIndex.get_index(refresh=True)
+        base_prefix = os.path.normpath(index["conda_base"])
+        all_specs = KernelSpecIndex.get_specs()
+        kernel_name_of = dict(zip(env_names, kernel_names))
+
+        def remove_env(env_name: str) -> TeardownResult:
+            env_start = time.perf_counter()
+            record = index["by_name"].get(env_name)
+            rc, kernel_removed, errors = 1, False, []
+            protected_reason = "" if record is None else CondaEnvTeardown.get_protected_reason(record.prefix)
+            if record is None:
+                errors.append(f"Conda {env_name!r} does not exist!")
+            elif record.prefix == base_prefix:
+                errors.append("Refusing to remove the base env")
+            elif protected_reason:
+                errors.append(f"Refusing to remove {env_name!r}: {protected_reason}")
+            else:
+                kernel_name = kernel_name_of[env_name]
+                kernel_record = all_specs.get(kernel_name.lower())
+                if kernel_record is not None:
+                    try:
+                        kernel_removed = KernelSpecInstaller.remove_resource_dir(kernel_record.resource_dir)
+                    except OSError as e:
+                        errors.append(f"Unable to remove kernel {kernel_name!r}: {e}")
+                try:
+                    rc = CondaEnvTeardown.remove_prefix(record.prefix, use_conda=use_conda)
+                    if rc != 0:
+                        errors.append(f"Unable to remove {record.prefix!r}")
+                except Exception as e:
+                    errors.append(str(e))
+            return TeardownResult(
+                env_name=env_name,
+                prefix=record.prefix if record is not None else "",
+                kernel_removed=kernel_removed,
+                env_removed=rc == 0,
+                rc=rc,
+                duration=time.perf_counter() - env_start,
+                error="; ".join(errors),
+            )
+
+        unique_env_names = list(dict.fromkeys(env_names))
+        with ThreadPoolExecutor(max_workers=max_workers or CondaEnvTeardown.max_workers) as executor:
+            results = list(executor.map(remove_env, unique_env_names))
+        CondaEnvTeardown.clean_environments_txt([r.prefix for r in results if r.env_removed])
+        CondaEnvIndex.invalidate()
+        KernelSpecIndex.invalidate()
+        return TeardownReport(results=results, duration=time.perf_counter() - start)
+
+
+class CondarcEditor:
+    """
+    A minimal line based editor for .condarc files, used instead of starting conda once per `conda config` call.
+
+    Only top level scalars and sequences (block or flow style) are understood; the lines of every other key, comments
+    included, are left untouched. Anything it can't parse raises ValueError so callers can fall back to `conda config`.
+    """
+
+    _key_pattern = re.compile(r"^([A-Za-z_][\w.-]*)\s*:(.*)$")
+
+    @staticmethod
+    def get_user_condarc() -> Path:
+        """
+        Returns the file `conda config` writes to when no --file/--env/--system flag is given
+
+        :rtype: Path
+
+        """
+        return Path("~/.condarc").expanduser()
+
+    @staticmethod
+    def get_search_path(conda_base: str = None) -> List[Path]:
+        """
+        Returns the .condarc files conda reads, lowest precedence first (condarc.d directories aren't included)
+
+        :param conda_base:  (Default value = None)
+        :type conda_base: str
+        :rtype: List[Path]
+
+        """
+        config_dirs = []
+        if platform.system() == "Windows":
+            config_dirs.append(Path("C:/ProgramData/conda"))
+        else:
+            config_dirs += [Path("/etc/conda"), Path("/var/lib/conda")]
+        if conda_base:
+            config_dirs.append(Path(conda_base))
+        if os.environ.get("XDG_CONFIG_HOME"):
+            config_dirs.append(Path(os.environ["XDG_CONFIG_HOME"]).joinpath("conda"))
+        config_dirs += [Path("~/.config/conda").expanduser(), Path("~/.conda").expanduser()]
+        search_path = [config_dir.joinpath(name) for config_dir in config_dirs for name in (".condarc", "condarc")]
+        search_path.append(CondarcEditor.get_user_condarc())
+        if os.environ.get("CONDA_PREFIX"):
+            search_path += [Path(os.environ["CONDA_PREFIX"]).joinpath(name) for name in (".condarc", "condarc")]
+        if os.environ.get("CONDARC"):
+            search_path.append(Path(os.environ["CONDARC"]).expanduser())
+        return list(dict.fromkeys(search_path))
+
+    @staticmethod
+    def read_sequence(condarc_path: Path, key: str) -> List[str]:
+        """
+        Returns the items of a top level sequence of condarc_path, [] if the file or key is missing or can't be parsed
+
+        :param condarc_path:
+        :type condarc_path: Path
+        :param key:
+        :type key: str
+        :rtype: List[str]
+
+        """
+        try:
+            with open(condarc_path, "r") as f:
+                lines = f.read().splitlines()
+            block = CondarcEditor.find_block(lines, key)
+            return [] if block is None else CondarcEditor.get_sequence(lines, block)
+        except (OSError, ValueError):
+            return []
+
+    @staticmethod
+    def read_lines(condarc_path: Path) -> List[str]:
+        """
+        Reads condarc_path, [] if it doesn't exist yet. Like `conda config --file`, only the targeted file is read, so
+        settings of other .condarc files are never copied into it.
+
+        :param condarc_path:
+        :type condarc_path: Path
+        :rtype: List[str]
+
+        """
+        try:
+            with open(condarc_path, "r") as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def strip_value(value: str) -> str:
+        """
+        Drops trailing comments and quotes from a scalar
+
+        :param value:
+        :type value: str
+        :rtype: str
+
+        """
+        value = value.strip()
+        if value[:1] in ("'", '"'):
+            end = value.find(value[0], 1)
+            if end == -1:
+                raise ValueError(f"Unterminated string {value!r}")
+            return value[1:end]
+        return re.split(r"\s+#", value, maxsplit=1)[0].strip()
+
+    @staticmethod
+    def find_block(lines: List[str], key: str):
+        """
+        Returns the (start, end) line range of a top level key, or None if it isn't set
+
+        :param lines:
+        :type lines: List[str]
+        :param key:
+        :type key: str
+
+        """
+        start = None
+        for i, line in enumerate(lines):
+            match = CondarcEditor._key_pattern.match(line)
+            if start is None:
+                if match and match.group(1) == key:
+                    start = i
+                continue
+            is_continuation = (not line.strip()) or line[:1].isspace() or line.startswith(("#", "-"))
+            if not is_continuation:
+                return start, i
+        if start is None:
+            return None
+        return start, len(lines)
+
+    @staticmethod
+    def get_sequence(lines: List[str], block) -> List[str]:
+        """
+        Parses the items of a sequence key
+
+        :param lines:
+        :type lines: List[str]
+        :param block: (start, end) as returned by find_block
+
+        """
+        start, end = block
+        header_value = CondarcEditor._key_pattern.match(lines[start]).group(2)
+        header_value = re.split(r"\s+#", header_value, maxsplit=1)[0].strip()
+        if header_value.startswith("[") and header_value.endswith("]"):
+            return [CondarcEditor.strip_value(v) for v in header_value[1:-1].split(",") if v.strip()]
+        if header_value:
+            raise ValueError(f"{lines[start]!r} isn't a sequence")
+        items = []
+        for line in lines[start + 1: end]:
+            stripped = line.strip()
+            if (not stripped) or stripped.startswith("#"):
+                continue
+            if not stripped.startswith("- "):
+                raise ValueError(f"Unable to parse {line!r}")
+            items.append(CondarcEditor.strip_value(stripped[2:]))
+        return items
+
+    @staticmethod
+    def replace_block(lines: List[str], key: str, new_block: List[str]) -> List[str]:
+        """
+        Swaps the lines of key for new_block, appending it if key isn't set. Comments inside the old block are kept.
+
+        :param lines:
+        :type lines: List[str]
+        :param key:
+        :type key: str
+        :param new_block:
+        :type new_block: List[str]
+        :rtype: List[str]
+
+        """
+        block = CondarcEditor.find_block(lines, key)
+        if block is None:
+            return lines + new_block
+        start, end = block
+        comments = [l for l in lines[start + 1: end] if l.strip().startswith("#")]
+        return lines[:start] + new_block + comments + lines[end:]
+
+    @staticmethod
+    def set_scalar(lines: List[str], key: str, value: str) -> List[str]:
+        """
+        Same as `conda config --set key value`
+
+        :param lines:
+        :type lines: List[str]
+        :param key:
+        :type key: str
+        :param value:
+        :type value: str
+        :rtype: List[str]
+
+        """
+        block = CondarcEditor.find_block(lines, key)
+        if block is not None:
+            start, end = block
+            has_items = any(l.strip() and not l.strip().startswith("#") for l in lines[start + 1: end])
+            if has_items:
+                raise ValueError(f"{key!r} isn't a scalar")
+        return CondarcEditor.replace_block(lines, key, [f"{key}: {value}"])
+
+    @staticmethod
+    def add_item(lines: List[str], key: str, item: str, prepend: bool = True) -> List[str]:
+        """
+        Same as `conda config --prepend/--append key item`, an item that's already there is moved
+
+        :param lines:
+        :type lines: List[str]
+        :param key:
+        :type key: str
+        :param item:
+        :type item: str
+        :param prepend:  (Default value = True)
+        :type prepend: bool
+        :rtype: List[str]
+
+        """
+        block = CondarcEditor.find_block(lines, key)
+        if block is not None:
+            items = CondarcEditor.get_sequence(lines, block)
+        else:
+            # conda keeps the implicit defaults channel when channels is set for the first time
+            items = ["defaults"] if key == "channels" else []
+        items = [i for i in items if i != item]
+        items = [item] + items if prepend else items + [item]
+        return CondarcEditor.replace_block(lines, key, [f"{key}:"] + [f"  - {i}" for i in items])
+
+    @staticmethod
+    def apply(edits, condarc_path: Path = None) -> Path:
+        """
+        Applies edits in order and writes the file once
+
+        :param edits: (op, key, value) tuples where op is "set", "prepend" or "append"
+        :param condarc_path:  (Default value = None) defaults to the user .condarc
+        :type condarc_path: Path
+        :rtype: Path
+
+        """
+        condarc_path = Path(condarc_path or CondarcEditor.get_user_condarc())
+        lines = CondarcEditor.read_lines(condarc_path)
+        for op, key, value in edits:
+            if op == "set":
+                lines = CondarcEditor.set_scalar(lines, key, value)
+            elif op in ("prepend", "append"):
+                lines = CondarcEditor.add_item(lines, key, value, prepend=op == "prepend")
+            else:
+                raise ValueError(f"Unknown condarc edit {op!r}")
+        tmp_path = condarc_path.with_name(f"{condarc_path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, condarc_path)
+        return condarc_path
+
+    @staticmethod
+    def get_cli_cmds(edits) -> List[List[str]]:
+        """
+        Returns the `conda config` calls that make the same edits
+
+        :param edits: (op, key, value) tuples
+        :rtype: List[List[str]]
+
+        """
+        return [["conda", "config", f"--{op}", key, value] for op, key, value in edits]
+
+
+class PyprojectTomlEditor:
+    """
+    A minimal line based editor for the dependency tables of a pyproject.toml, used instead of one `poetry add` per
+    dependency.
+
+    Only `name = value` entries of the given tables are touched (values may span several lines); every other line,
+    comments included, is written back as is.
+    """
+
+    _header_pattern = re.compile(r"^\s*\[\[?\s*([^\[\]]+?)\s*\]\]?\s*(#.*)?$")
+    _key_pattern = re.compile(r"""^\s*("[^"]+"|'[^']+'|[A-Za-z0-9_.-]+)\s*=""")
+    _bare_key_pattern = re.compile(r"[A-Za-z0-9_-]+")
+    _egg_pattern = re.compile(r"[#&]egg=([A-Za-z0-9_.-]+)")
+    _requirement_pattern = re.compile(
+        r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[([^\]]*)\])?\s*([^;]*?)\s*(?:;\s*(.+?))?\s*$"
+    )
+    _comment_pattern = re.compile(r"""^(.*?=\s*(?:"(?:[^"\\]|\\.)*"|'[^']*'))(\s*#.*)$""")
+
+    @staticmethod
+    def canonicalize_name(name: str) -> str:
+        """
+        Normalizes a distribution name the way PEP 503 does, so "Foo_Bar" and "foo-bar" are the same dependency
+
+        :param name:
+        :type name: str
+        :rtype: str
+
+        """
+        return re.sub(r"[-_.]+", "-", name.strip().strip("\"'")).lower()
+
+    @staticmethod
+    def find_section(lines: List[str], section: str):
+        """
+        Returns the (start, end) line range of a table (header included), or None if it isn't there
+
+        :param lines:
+        :type lines: List[str]
+        :param section: e.g. "tool.poetry.dependencies"
+        :type section: str
+
+        """
+        start = None
+        for i, line in enumerate(lines):
+            match = PyprojectTomlEditor._header_pattern.match(line)
+            if not match:
+                continue
+            if start is not None:
+                return start, i
+            if match.group(1).replace(" ", "") == section:
+                start = i
+        if start is None:
+            return None
+        return start, len(lines)
+
+    @staticmethod
+    def get_dev_section(lines: List[str]) -> str:
+        """
+        Returns the table dev dependencies go in, preferring the poetry>=1.2 dev group when the file already has one
+
+        :param lines:
+        :type lines: List[str]
+        :rtype: str
+
+        """
+        for section in ("tool.poetry.group.dev.dependencies", "tool.poetry.dev-dependencies"):
+            if PyprojectTomlEditor.find_section(lines, section) is not None:
+                return section
+        return "tool.poetry.dev-dependencies"
+
+    @staticmethod
+    def get_value_end(lines: List[str], start: int) -> int:
+        """
+        Returns the index after the last line of the entry starting at lines[start], following arrays and inline
+        tables over several lines
+
+        :param lines:
+        :type lines: List[str]
+        :param start:
+        :type start: int
+        :rtype: int
+
+        """
+        depth = 0
+        quote = None
+        i = start
+        while i < len(lines):
+            line = lines[i]
+            j = line.index("=") + 1 if i == start else 0
+            while j < len(line):
+                c = line[j]
+                if quote:
+                    if c == "\\" and quote == '"':
+                        j += 1
+                    elif c == quote:
+                        quote = None
+                elif c in ('"', "'"):
+                    quote = c
+                elif c == "#":
+                    break
+                elif c in "[{":
+                    depth += 1
+                elif c in "]}":
+                    depth -= 1
+                j += 1
+            i += 1
+            if depth <= 0:
+                return i
+        raise ValueError(f"Unterminated value for {lines[start]!r}")
+
+    @staticmethod
+    def find_entry(lines: List[str], block, name: str):
+        """
+        Returns the (start, end) line range of dependency name inside block, or None if it isn't declared
+
+        :param lines:
+        :type lines: List[str]
+        :param block: (start, end) as returned by find_section
+        :param name:
+        :type name: str
+
+        """
+        start, end = block
+        canonical_name = PyprojectTomlEditor.canonicalize_name(name)
+        i = start + 1
+        while i < end:
+            match = PyprojectTomlEditor._key_pattern.match(lines[i])
+            if not match:
+                i += 1
+                continue
+            entry_end = PyprojectTomlEditor.get_value_end(lines, i)
+            if PyprojectTomlEditor.canonicalize_name(match.group(1)) == canonical_name:
+                return i, entry_end
+            i = entry_end
+        return None
+
+    @staticmethod
+    def format_value(value) -> str:
+        """
+        Formats a python value as a TOML (inline) value
+
+        :param value: str, bool, int, float, list or dict
+        :rtype: str
+
+        """
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (int, float)):
+            return str(value)
+        if isinstance(value, Mapping):
+            items = ", ".join(f"{k} = {PyprojectTomlEditor.format_value(v)}" for k, v in value.items())
+            return f"{{ {items} }}"
+        if isinstance(value, (list, tuple)):
+            return "[" + ", ".join(PyprojectTomlEditor.format_value(v) for v in value) + "]"
+        return json.dumps(str(value))
+
+    @staticmethod
+    def format_key(name: str) -> str:
+        """
+        Returns name as a TOML key, quoted unless it's a valid bare key (a dot would otherwise make it a dotted key)
+
+        :param name:
+        :type name: str
+        :rtype: str
+
+        """
+        if PyprojectTomlEditor._bare_key_pattern.fullmatch(name):
+            return name
+        return json.dumps(name)
+
+    @staticmethod
+    def get_toml_value(dependency_val: Union[str, Dict[str, Any]] = ""):
+        """
+        Turns a pin (as returned by format_deps_from_reqs_txt or read from a pyproject.toml section) into the value
+        poetry would have written for it
+
+        :param dependency_val: e.g. "==1.2.3", "^1.2", "", a git requirement line or a toml inline table
+            (Default value = "")
+        :type dependency_val: Union[str, Dict[str, Any]]
+
+        """
+        if not isinstance(dependency_val, str):
+            return dependency_val
+        dependency_val = dependency_val.strip()
+        if not dependency_val:
+            return "*"
+        if "://" in dependency_val:
+            url = dependency_val.split(" @ ", 1)[-1].split("#", 1)[0]
+            if url.startswith("git+"):
+                url = url[len("git+"):]
+            rev = None
+            scheme, _, rest = url.partition("://")
+            if "@" in rest.rsplit("/", 1)[-1]:
+                rest, rev = rest.rsplit("@", 1)
+            value = {"git": f"{scheme}://{rest}"}
+            if rev:
+                value["rev"] = rev
+            return value
+        return dependency_val
+
+    @staticmethod
+    def get_git_dependency_name(requirement_line: str) -> str:
+        """
+        Returns the distribution name of a git requirement line, taken from its #egg= fragment, from a PEP 508
+        "name @ url" line or else from the repository name
+
+        :param requirement_line: e.g. "git+https://github.com/org/repo.git@v1.0#egg=my-pkg"
+        :type requirement_line: str
+        :rtype: str
+
+        """
+        match = PyprojectTomlEditor._egg_pattern.search(requirement_line)
+        if match:
+            return match.group(1)
+        if " @ " in requirement_line:
+            try:
+                return import_optional_dependency("Requirement")(requirement_line).name
+            except ImportError:
+                return requirement_line.split(" @ ", 1)[0].split("[", 1)[0].strip()
+            except ValueError:
+                pass
+        url = requirement_line.split(" @ ", 1)[-1].split("#", 1)[0]
+        repo_name = url.rstrip("/").rsplit("/", 1)[-1].split("@", 1)[0]
+        return repo_name[: -len(".git")] if repo_name.endswith(".git") else repo_name
+
+    @staticmethod
+    def parse_requirement(name: str, dependency_val: Union[str, Dict[str, Any]] = ""):
+        """
+        Splits a dependency into its distribution name and the value poetry would write for it, e.g.
+        ("pandas[excel]>=2.0", "") -> ("pandas", {"version": ">=2.0", "extras": ["excel"]})
+
+        name may be a whole requirements.txt line (as parse_requirements_txt leaves unpinned ones), in which case its
+        extras, specifier and markers are parsed with packaging, or split with a regex if packaging isn't installed
+
+        :param name:
+        :type name: str
+        :param dependency_val: see get_toml_value  (Default value = "")
+        :type dependency_val: Union[str, Dict[str, Any]]
+        :returns: (name, value)
+
+        """
+        name = name.strip()
+        if not isinstance(dependency_val, str):
+            return name, dependency_val
+        dependency_val = dependency_val.strip()
+        if dependency_val[:1] in ("{", "["):
+            return name, dependency_val
+        for requirement_line in (dependency_val, name):
+            if ("://" in requirement_line) or requirement_line.startswith("git+"):
+                git_name = PyprojectTomlEditor.get_git_dependency_name(requirement_line)
+                return git_name, PyprojectTomlEditor.get_toml_value(requirement_line)
+        requirement_line = name
+        if (dependency_val[:1] in "=<>!") or dependency_val.startswith("~="):
+            # a pip style pin, as format_deps_from_reqs_txt returns it
+            requirement_line, dependency_val = f"{name}{dependency_val}", ""
+        try:
+            requirement = import_optional_dependency("Requirement")(requirement_line)
+            requirement_name, extras = requirement.name, sorted(requirement.extras)
+            specifier, marker = str(requirement.specifier), str(requirement.marker or "")
+        except ImportError:
+            match = PyprojectTomlEditor._requirement_pattern.match(requirement_line)
+            if match is None:
+                return name, PyprojectTomlEditor.get_toml_value(dependency_val)
+            requirement_name, extras, specifier, marker = match.groups()
+            extras = sorted(e.strip() for e in (extras or "").split(",") if e.strip())
+            specifier, marker = "".join(specifier.split()), marker or ""
+        except ValueError:
+            return name, PyprojectTomlEditor.get_toml_value(dependency_val)
+        version = specifier or PyprojectTomlEditor.get_toml_value(dependency_val)
+        if not (extras or marker):
+            return requirement_name, version
+        value = {"version": version}
+        if extras:
+            value["extras"] = extras
+        if marker:
+            value["markers"] = marker
+        return requirement_name, value
+
+    @staticmethod
+    def set_dependency(lines: List[str], section: str, name: str, value) -> List[str]:
+        """
+        Declares (or re-pins) name in section, keeping a trailing comment on the entry it replaces
+
+        :param lines:
+        :type lines: List[str]
+        :param section:
+        :type section: str
+        :param name:
+        :type name: str
+        :param name: a dependency name or requirement line, see parse_requirement
+        :type name: str
+        :param value: see get_toml_value, a string starting with "{" or "[" is written as is
+        :rtype: List[str]
+
+        """
+        name, value = PyprojectTomlEditor.parse_requirement(name, value)
+        if isinstance(value, str) and value[:1] in ("{", "["):
+            formatted = value
+        else:
+            formatted = PyprojectTomlEditor.format_value(value)
+        key = PyprojectTomlEditor.format_key(name)
+        block = PyprojectTomlEditor.find_section(lines, section)
+        if block is None:
+            if lines and lines[-1].strip():
+                lines = lines + [""]
+            return lines + [f"[{section}]", f"{key} = {formatted}"]
+        entry = PyprojectTomlEditor.find_entry(lines, block, name)
+        if entry is not None:
+            start, end = entry
+            key = PyprojectTomlEditor._key_pattern.match(lines[start]).group(1)
+            comment = PyprojectTomlEditor._comment_pattern.match(lines[start]) if end - start == 1 else None
+            new_line = f"{key} = {formatted}" + (comment.group(2) if comment else "")
+            return lines[:start] + [new_line] + lines[end:]
+        start, end = block
+        insert_at = start + 1
+        for i in range(start + 1, end):
+            if lines[i].strip() and not lines[i].strip().startswith("#"):
+                insert_at = i + 1
+        return lines[:insert_at] + [f"{key} = {formatted}"] + lines[insert_at:]
+
+    @staticmethod
+    def remove_dependency(lines: List[str], section: str, name: str) -> List[str]:
+        """
+        Drops name from section, if it's declared there
+
+        :param lines:
+        :type lines: List[str]
+        :param section:
+        :type section: str
+        :param name:
+        :type name: str
+        :rtype: List[str]
+
+        """
+        name, _ = PyprojectTomlEditor.parse_requirement(name)
+        block = PyprojectTomlEditor.find_section(lines, section)
+        entry = None if block is None else PyprojectTomlEditor.find_entry(lines, block, name)
+        if entry is None:
+            return lines
+        start, end = entry
+        return lines[:start] + lines[end:]
+
+    @staticmethod
+    def apply(edits, pyproject_toml_path: Path) -> Path:
+        """
+        Applies edits in order and writes the file once
+
+        :param edits: (op, dependency_type, name, value) tuples where op is "set" or "remove" and dependency_type is
+            "dev" or ""
+        :param pyproject_toml_path:
+        :type pyproject_toml_path: Path
+        :rtype: Path
+
+        """
+        pyproject_toml_path = Path(pyproject_toml_path)
+        with open(pyproject_toml_path, "r") as f:
+            lines = f.read().splitlines()
+        for op, dependency_type, name, value in edits:
+            if dependency_type == "dev":
+                section = PyprojectTomlEditor.get_dev_section(lines)
+            else:
+                section = "tool.poetry.dependencies"
+            if op == "set":
+                lines = PyprojectTomlEditor.set_dependency(lines, section, name, value)
+            elif op == "remove":
+                lines = PyprojectTomlEditor.remove_dependency(lines, section, name)
+            else:
+                raise ValueError(f"Unknown pyproject.toml edit {op!r}")
+        tmp_path = pyproject_toml_path.with_name(f"{pyproject_toml_path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, pyproject_toml_path)
+        return pyproject_toml_path
+
+
+class DependencySyncPlan(NamedTuple):
+    """
+    What it takes to bring the dependencies of one table of a pyproject.toml in line with a source (requirements.txt
+    or another pyproject.toml); add and update map dependency names to the pins they should get
+    """
+
+    dependency_type: str
+    add: Dict[str, Any]
+    update: Dict[str, Any]
+    remove: List[str]
+    unchanged: List[str]
+
+    @property
+    def changes(self) -> Dict[str, Any]:
+        """ """
+        return {**self.add, **self.update}
+
+    @property
+    def is_empty(self) -> bool:
+        """ """
+        return not (self.add or self.update or self.remove)
+
+    def describe(self) -> str:
+        """ """
+        section = "dev" if self.dependency_type == "dev" else "required"
+        return (
+            f"{section} dependencies: {len(self.add)} to add, {len(self.update)} to update, "
+            f"{len(self.remove)} not in the source, {len(self.unchanged)} unchanged"
+        )
+
+
+class DependencySyncPlanner:
+    """
+    Diffs the dependencies of a source against a destination pyproject.toml (and its poetry.lock), so a migration only
+    runs poetry for what changed.
+
+    Source requirements are split into name and pin with PyprojectTomlEditor.parse_requirement, then names are
+    compared after PEP 503 normalization and pins after PyprojectTomlEditor.get_toml_value, so "foo[bar]>=1.0" in a
+    requirements.txt matches `foo = { version = ">=1.0", extras = ["bar"] }` and "==1.2" matches "1.2". An exact pin
+    also counts as unchanged when poetry.lock already has that version, and a dependency declared in pyproject.toml
+    but missing from an existing poetry.lock is updated.
+    """
+
+    @staticmethod
+    def normalize_constraint(dependency_val):
+        """
+        Returns a comparable form of a pin, exact pins are spelled "==<version>"
+
+        :param dependency_val:
+
+        """
+        value = PyprojectTomlEditor.get_toml_value(dependency_val)
+        exact_pin = DependencySyncPlanner.get_exact_pin(value)
+        if exact_pin:
+            return f"=={exact_pin}"
+        if isinstance(value, Mapping):
+            return tuple(sorted((k, DependencySyncPlanner.normalize_constraint(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(DependencySyncPlanner.normalize_constraint(v) for v in value)
+        if isinstance(value, str):
+            return value.replace(" ", "") or "*"
+        return value
+
+    @staticmethod
+    def get_exact_pin(dependency_val) -> str:
+        """
+        Returns the version of an exact pin ("==1.2.3" or "1.2.3"), or "" for any other pin
+
+        :param dependency_val:
+        :rtype: str
+
+        """
+        if not isinstance(dependency_val, str):
+            return ""
+        match = re.fullmatch(r"(?:==)?\s*(\d[\w.+!-]*)", dependency_val.strip())
+        return match.group(1) if match else ""
+
+    @staticmethod
+    def get_destination_dependencies(pyproject_toml_path: Path, dependency_type: str = "") -> Dict[str, Any]:
+        """
+        Returns the declared dependencies of a table of pyproject_toml_path, keyed by normalized name
+
+        :param pyproject_toml_path:
+        :type pyproject_toml_path: Path
+        :param dependency_type: "dev" or ""  (Default value = "")
+        :type dependency_type: str
+        :rtype: Dict[str, Any]
+
+        """
+        if dependency_type == "dev":
+            sections = ["tool.poetry.group.dev.dependencies", "tool.poetry.dev-dependencies"]
+        else:
+            sections = ["tool.poetry.dependencies"]
+        dependencies = {}
+        for section in sections:
+            for name, val in CommonPSCommands.read_toml(pyproject_toml_path, start_line=section).items():
+                dependencies[PyprojectTomlEditor.canonicalize_name(name)] = val
+        return dependencies
+
+    @staticmethod
+    def get_locked_versions(poetry_lock_path: Path) -> Union[Dict[str, str], None]:
+        """
+        Returns the locked version of every package keyed by normalized name, or None if there's no poetry.lock
+
+        :param poetry_lock_path:
+        :type poetry_lock_path: Path
+        :rtype: Union[Dict[str, str], None]
+
+        """
+        if not Path(poetry_lock_path).exists():
+            return None
+        return {name: package.version for name, package in PoetryLockIndex.load(poetry_lock_path).items()}
+
+    @staticmethod
+    def plan(
+            src_dependencies: Dict[str, Any],
+            dest_pyproject_toml_dir: str,
+            dependency_type: str = "",
+            compare_constraints: bool = True,
+    ) -> DependencySyncPlan:
+        """
+        Diffs src_dependencies against one table of the pyproject.toml in dest_pyproject_toml_dir
+
+        :param src_dependencies: dependency name (or requirement line) -> pin
+        :type src_dependencies: Dict[str, Any]
+        :param dest_pyproject_toml_dir:
+        :type dest_pyproject_toml_dir: str
+        :param dependency_type: "dev" or ""  (Default value = "")
+        :type dependency_type: str
+        :param compare_constraints: False to only compare names, for callers that add dependencies unpinned
+            (Default value = True)
+        :type compare_constraints: bool
+        :rtype: DependencySyncPlan
+
+        """
+        pyproject_toml_path = Path(dest_pyproject_toml_dir).joinpath("pyproject.toml")
+        dest_dependencies = DependencySyncPlanner.get_destination_dependencies(pyproject_toml_path, dependency_type)
+        locked_versions = DependencySyncPlanner.get_locked_versions(pyproject_toml_path.with_name("poetry.lock"))
+        add, update, unchanged = {}, {}, []
+        src_names = set()
+        for name, val in (src_dependencies or {}).items():
+            parsed_name, parsed_val = PyprojectTomlEditor.parse_requirement(name, val)
+            canonical_name = PyprojectTomlEditor.canonicalize_name(parsed_name)
+            if canonical_name == "python":
+                continue
+            src_names.add(canonical_name)
+            if canonical_name not in dest_dependencies:
+                add[name] = val
+                continue
+            is_locked = (locked_versions is None) or (canonical_name in locked_versions)
+            same_constraint = (not compare_constraints) or (
+                DependencySyncPlanner.normalize_constraint(parsed_val)
+                == DependencySyncPlanner.normalize_constraint(dest_dependencies[canonical_name])
+            )
+            exact_pin = DependencySyncPlanner.get_exact_pin(parsed_val)
+            pin_is_locked = bool(exact_pin) and (locked_versions or {}).get(canonical_name) == exact_pin
+            if is_locked and (same_constraint or pin_is_locked):
+                unchanged.append(name)
+            else:
+                update[name] = val
+        remove = sorted(n for n in dest_dependencies if n != "python" and n not in src_names)
+        return DependencySyncPlan(dependency_type, add, update, remove, unchanged)
+
+
+class BootstrapStep(NamedTuple):
+    """
+    One step of an env bootstrap workflow, named after the CondaEnvManager method it stands for
+
+    action is "condarc" (args are (op, key, value) edits), "conda_install" (args are packages), "conda_update" (args
+    are packages that are upgraded even when they're already installed) or "register_kernel".
+    launches is the number of processes the step starts when it runs on its own.
+    """
+
+    name: str
+    action: str
+    args: tuple
+    launches: int
+
+
+class FusedStep(NamedTuple):
+    """
+    A step of a BootstrapPlan, covering one or more BootstrapSteps
+    """
+
+    names: tuple
+    action: str
+    args: tuple
+    flags: tuple
+    launches: int
+
+
+class BootstrapPlan(NamedTuple):
+    """
+    The fused steps that bootstrap env_name, with the process launches before and after fusing
+    """
+
+    env_name: str
+    steps: List[FusedStep]
+    launches_before: int
+    launches_after: int
+
+    @property
+    def saved_launches(self) -> int:
+        """ """
+        return self.launches_before - self.launches_after
+
+
+class BootstrapPlanner:
+    """
+    Fuses the steps of an env bootstrap so the whole workflow starts as few processes as possible.
+
+    Consecutive installs become a single `conda install -n <env>` transaction (no activation needed), every condarc
+    edit is written straight to .condarc in one pass and kernels are registered natively. Installs get the channel
+    flags the deferred condarc edits would have given them, so they resolve against the same config as before. An
+    install covering a "conda_update" step runs with --update-specs, so those packages are still upgraded.
+    """
+
+    install_actions = ("conda_install", "conda_update")
+
+    @staticmethod
+    def get_default_steps() -> List[BootstrapStep]:
+        """
+        Returns the steps of CondaEnvManager.init_prev_made_conda_env
+
+        Every unfused step starts a shell, `conda shell.posix activate` and the tool itself
+
+        :rtype: List[BootstrapStep]
+
+        """
+        return [
+            BootstrapStep("reset_conda_channel_priority", "condarc", (("set", "channel_priority", "false"),), 3),
+            BootstrapStep("upgrade_pip", "conda_update", ("pip", "setuptools", "wheel"), 3),
+            BootstrapStep("install_ipykernel", "conda_install", ("notebook", "ipykernel"), 3),
+            BootstrapStep(
+                "add_conda_forge_priority",
+                "condarc",
+                (("prepend", "channels", "conda-forge"), ("set", "channel_priority", "strict")),
+                6,
+            ),
+            BootstrapStep("register_kernel", "register_kernel", (), 0),
+        ]
+
+    @staticmethod
+    def can_defer(edit: tuple) -> bool:
+        """
+        Returns True if an install can get the effect of a condarc edit from command line flags
+
+        :param edit: (op, key, value)
+        :type edit: tuple
+        :rtype: bool
+
+        """
+        op, key, value = edit
+        return (op, key) in (("set", "channel_priority"), ("prepend", "channels"))
+
+    @staticmethod
+    def get_install_flags(pending_edits: List[tuple]) -> tuple:
+        """
+        Returns the `conda install` flags that stand in for condarc edits that haven't been written yet, see can_defer
+
+        :param pending_edits:
+        :type pending_edits: List[tuple]
+        :rtype: tuple
+
+        """
+        flags = []
+        channel_priority = None
+        for op, key, value in pending_edits:
+            if key == "channel_priority":
+                channel_priority = value
+            else:
+                # -c channels are searched before the ones in .condarc, like a prepended channel
+                flags = ["-c", value] + flags
+        if str(channel_priority).lower() in ("false", "disabled"):
+            flags.append("--no-channel-priority")
+        elif str(channel_priority).lower() == "strict":
+            flags.append("--strict-channel-priority")
+        return tuple(flags)
+
+    @staticmethod
+    def plan(env_name: str, steps: List[BootstrapStep] = None) -> BootstrapPlan:
+        """
+        Fuses steps into a BootstrapPlan for env_name
+
+        :param env_name:
+        :type env_name: str
+        :param steps:  (Default value = None) defaults to BootstrapPlanner.get_default_steps()
+        :type steps: List[BootstrapStep]
+        :rtype: BootstrapPlan
+
+        """
+        if steps is None:
+            steps = BootstrapPlanner.get_default_steps()
+        fused_steps = []
+        pending_edits, condarc_names = [], []
+        install = None
+        for step in steps:
+            if step.action == "condarc":
+                if install is not None:
+                    fused_steps.append(install)
+                    install = None
+                pending_edits.extend(step.args)
+                condarc_names.append(step.name)
+            elif step.action in BootstrapPlanner.install_actions:
+                if not all(BootstrapPlanner.can_defer(edit) for edit in pending_edits):
+                    fused_steps.append(FusedStep(tuple(condarc_names), "condarc", tuple(pending_edits), (), 0))
+                    pending_edits, condarc_names = [], []
+                if install is None:
+                    flags = BootstrapPlanner.get_install_flags(pending_edits)
+                    install = FusedStep((), "conda_install", (), flags, 1)
+                packages = install.args + tuple(p for p in step.args if p not in install.args)
+                install = install._replace(names=install.names + (step.name,), args=packages)
+                if (step.action == "conda_update") and ("--update-specs" not in install.flags):
+                    install = install._replace(flags=install.flags + ("--update-specs",))
+            else:
+                if install is not None:
+                    fused_steps.append(install)
+                    install = None
+                fused_steps.append(FusedStep((step.name,), step.action, step.args, (), 0))
+        if install is not None:
+            fused_steps.append(install)
+        if pending_edits:
+            fused_steps.append(FusedStep(tuple(condarc_names), "condarc", tuple(pending_edits), (), 0))
+        return BootstrapPlan(
+            env_name=env_name,
+            steps=fused_steps,
+            launches_before=sum(step.launches for step in steps),
+            launches_after=sum(step.launches for step in fused_steps),
+        )
+
+    @staticmethod
+    def run_step(env_name: str, step: FusedStep, **kwargs) -> int:
+        """
+        Runs one fused step and returns its rc
+
+        :param env_name:
+        :type env_name: str
+        :param step:
+        :type step: FusedStep
+        :param **kwargs: passed to CommonPSCommands.run_command
+        :rtype: int
+
+        """
+        if step.action == "conda_install":
+            conda_cmd = ["conda", "install", "-y", "-n", env_name, *step.flags, *step.args]
+            return CommonPSCommands.run_command(conda_cmd, text=True, **kwargs)
+        if step.action == "condarc":
+            try:
+                CondarcEditor.apply(step.args)
+                return 0
+            except (OSError, ValueError) as e:
+                print(e)
+                print("Unable to edit .condarc directly, falling back to `conda config`")
+            rc = 0
+            for conda_cmd in CondarcEditor.get_cli_cmds(step.args):
+                rc = CommonPSCommands.run_command(conda_cmd, text=True, **kwargs)
+                if rc != 0:
+                    break
+            return rc
+        if step.action == "register_kernel":
+            return CondaEnvManager.register_kernel(env_name)
+        raise ValueError(f"Unknown bootstrap action {step.action!r}")
+
+    @staticmethod
+    def execute(plan: BootstrapPlan, **kwargs) -> Dict[str, int]:
+        """
+        Runs a plan until a step fails
+
+        :param plan:
+        :type plan: BootstrapPlan
+        :param **kwargs: passed to CommonPSCommands.run_command
+        :returns: {name of each step that ran: rc of the fused step that covered it}
+        :rtype: Dict[str, int]
+
+        """
+        step_rcs = {}
+        for step in plan.steps:
+            rc = BootstrapPlanner.run_step(plan.env_name, step, **kwargs)
+            step_rcs.update((name, rc) for name in step.names)
+            if rc != 0:
+                break
+        return step_rcs
+
+
+class CondaSearchParser(OutputSink):
+    """
+    Incrementally parses the stdout of `conda search --json <package>` while conda is still printing it.
+
+    Every package record is decoded (with JSONDecoder.raw_decode) as soon as it's complete and reduced to a
+    (Name, Version, Build, Channel) tuple, so the whole document is never held in memory.
+    """
+
+    def __init__(self, package: str):
+        self.package = package
+        self.decoder = json.JSONDecoder()
+        self.array_start = re.compile(r'"%s"\s*:\s*\[' % re.escape(package))
+        self.buffer = ""
+        self.in_array = False
+        self.done = False
+        self.records = []
+        self.error = ""
+
+    def write(self, stream: str, line: str) -> None:
+        if (stream != "stdout") or self.done:
+            return
+        self.buffer += line + "\n"
+        if not self.in_array:
+            match = self.array_start.search(self.buffer)
+            if match is None:
+                return
+            self.buffer = self.buffer[match.end():]
+            self.in_array = True
+        if ("}" in line) or ("]" in line):
+            self.parse()
+
+    def parse(self) -> None:
+        pos = 0
+        while True:
+            while (pos < len(self.buffer)) and (self.buffer[pos] in " \t\r\n,"):
+                pos += 1
+            if pos >= len(self.buffer):
+                break
+            if self.buffer[pos] == "]":
+                self.done = True
+                break
+            try:
+                record, pos_end = self.decoder.raw_decode(self.buffer, pos)
+            except json.JSONDecodeError:
+                break  # the record isn't complete yet
+            self.records.append((record["name"], record["version"], record["build"], record["channel"]))
+            pos = pos_end
+        self.buffer = self.buffer[pos:]
+
+    def close(self) -> None:
+        if self.in_array:
+            return
+        try:
+            self.error = json.loads(self.buffer).get("error", "")
+        except (json.JSONDecodeError, AttributeError):
+            self.error = self.buffer.strip()
+
+
+class CondaVersionIndex(NamedTuple):
+    """
+    The versions of a conda package, sorted from lowest to highest, with the builds of every version
+    """
+
+    package: str
+    created: float
+    versions: tuple
+    version_keys: tuple
+    builds: Dict[str, List[tuple]]
+
+
+class CondaSearchCache:
+    """
+    Caches `conda search --json <package>` on disk (under $XDG_CACHE_HOME/project_manager) as a CondaVersionIndex.
+
+    A snapshot is reused until it's older than ttl seconds, and used regardless of its age when conda can't reach the
+    channels. Snapshots are keyed by the conda install, the platform and the user .condarc, so changing channels
+    starts a new one.
+    """
+
+    ttl = 24 * 60 * 60
+    _lock = threading.Lock()
+    _indexes = {}
+    _catalogs = {}
+    _version_pattern = re.compile(r"(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:\.\d+)*(?:(a|b|rc)(\d*))?")
+    _pre_ranks = {"a": 0, "b": 1, "rc": 2}
+
+    @staticmethod
+    def get_version_key(version: str) -> tuple:
+        """
+        Returns a sortable (major, minor, micro, pre_rank, pre_num) tuple, final releases sort after their pre-releases
+
+        :param version:
+        :type version: str
+        :rtype: tuple
+
+        """
+        match = CondaSearchCache._version_pattern.match(version)
+        if match is None:
+            return (-1, -1, -1, -1, -1)
+        major, minor, micro, pre, pre_num = match.groups()
+        pre_rank = CondaSearchCache._pre_ranks[pre] if pre else 3
+        return (int(major), int(minor or 0), int(micro or 0), pre_rank, int(pre_num or 0))
+
+    @staticmethod
+    def get_cache_dir() -> Path:
+        """ """
+        if platform.system() == "Windows" and os.environ.get("LOCALAPPDATA"):
+            cache_home = Path(os.environ["LOCALAPPDATA"])
+        else:
+            cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path("~/.cache").expanduser())
+        return cache_home.joinpath("project_manager")
+
+    @staticmethod
+    def get_cache_path(package: str) -> Path:
+        """
+        Returns the snapshot file of package for the current conda install, platform and user .condarc
+
+        :param package:
+        :type package: str
+        :rtype: Path
+
+        """
+        try:
+            condarc = CondarcEditor.get_user_condarc().read_text()
+        except OSError:
+            condarc = ""
+        key_parts = [
+            package,
+            CondaEnvIndex.get_conda_base(),
+            platform.system(),
+            platform.machine(),
+            os.environ.get("CONDARC", ""),
+            condarc,
+        ]
+        key = hashlib.sha1(json.dumps(key_parts).encode()).hexdigest()[:16]
+        return CondaSearchCache.get_cache_dir().joinpath(f"conda_search_{package}_{key}.json")
+
+    @staticmethod
+    def build_index(package: str, records: List[tuple], created: float = None) -> CondaVersionIndex:
+        """
+        Groups (Name, Version, Build, Channel) records by version, sorted by CondaSearchCache.get_version_key
+
+        :param package:
+        :type package: str
+        :param records:
+        :type records: List[tuple]
+        :param created:  (Default value = None) defaults to now
+        :type created: float
+        :rtype: CondaVersionIndex
+
+        """
+        builds = defaultdict(list)
+        for record in records:
+            builds[record[1]].append(tuple(record))
+        versions = tuple(sorted(builds, key=CondaSearchCache.get_version_key))
+        return CondaVersionIndex(
+            package=package,
+            created=time.time() if created is None else created,
+            versions=versions,
+            version_keys=tuple(CondaSearchCache.get_version_key(v) for v in versions),
+            builds={v: builds[v] for v in versions},
+        )
+
+    @staticmethod
+    def fetch(package: str) -> Union[CondaVersionIndex, None]:
+        """
+        Runs `conda search --json package`, returns None if conda failed
+
+        :param package:
+        :type package: str
+        :rtype: Union[CondaVersionIndex, None]
+
+        """
+        parser = CondaSearchParser(package)
+        result = CommonPSCommands.stream_command(["conda", "search", "--json", package], sinks=[parser])
+        if (result.rc != 0) or (not parser.done):
+            print(parser.error or f"`conda search {package}` failed with rc={result.rc}")
+            return None
+        return CondaSearchCache.build_index(package, parser.records)
+
+    @staticmethod
+    def load(cache_path: Path) -> Union[CondaVersionIndex, None]:
+        """
+
+        :param cache_path:
+        :type cache_path: Path
+        :rtype: Union[CondaVersionIndex, None]
+
+        """
+        try:
+            with open(cache_path, "r") as f:
+                snapshot = json.load(f)
+            return CondaSearchCache.build_index(snapshot["package"], snapshot["records"], snapshot["created"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def save(cache_path: Path, index: CondaVersionIndex):
+        """
+        Atomically writes a snapshot of index to cache_path
+
+        :param cache_path:
+        :type cache_path: Path
+        :param index:
+        :type index: CondaVersionIndex
+
+        """
+        snapshot = {
+            "package": index.package,
+            "created": index.created,
+            "records": [list(build) for v in index.versions for build in index.builds[v]],
+        }
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, cache_path)
+
+    @staticmethod
+    def get_index(
+            package: str = "python", ttl: float = None, refresh: bool = False, offline: bool = False
+    ) -> CondaVersionIndex:
+        """
+        Returns the version index of package from memory, the disk snapshot or conda, in that order.
+        If none of them has it, an empty index with created=0 is returned and not kept.
+
+        :param package:  (Default value = "python")
+        :type package: str
+        :param ttl:  (Default value = None) max age of a snapshot in seconds, defaults to CondaSearchCache.ttl
+        :type ttl: float
+        :param refresh: ignore the cached snapshots  (Default value = False)
+        :type refresh: bool
+        :param offline: never run conda, use the cached snapshot however old it is  (Default value = False)
+        :type offline: bool
+        :rtype: CondaVersionIndex
+
+        """
+        ttl = CondaSearchCache.ttl if ttl is None else ttl
+        cache_path = CondaSearchCache.get_cache_path(package)
+        with CondaSearchCache._lock:
+            index = CondaSearchCache._indexes.get(cache_path)
+        if index is None:
+            index = CondaSearchCache.load(cache_path)
+        is_fresh = (index is not None) and (time.time() - index.created < ttl)
+        if (not offline) and (refresh or (not is_fresh)):
+            fetched_index = CondaSearchCache.fetch(package)
+            if fetched_index is not None:
+                index = fetched_index
+                CondaSearchCache.save(cache_path, index)
+        if index is None:
+            # nothing to fall back on, so the next call tries conda again instead of reusing a fresh-looking empty index
+            return CondaSearchCache.build_index(package, [], created=0)
+        with CondaSearchCache._lock:
+            CondaSearchCache._indexes[cache_path] = index
+        return index
+
+    @staticmethod
+    def get_catalog(package: str = "python", **kwargs) -> "VersionCatalog":
+        """
+        Returns the VersionCatalog of the index get_index returns, built once per index
+
+        :param package:  (Default value = "python")
+        :type package: str
+        :param kwargs: passed to CondaSearchCache.get_index
+        :rtype: VersionCatalog
+
+        """
+        index = CondaSearchCache.get_index(package, **kwargs)
+        with CondaSearchCache._lock:
+            memo = CondaSearchCache._catalogs.get(package)
+        if (memo is not None) and (memo[0] is index):
+            return memo[1]
+        catalog = VersionConstraintEngine.build_catalog(index.versions)
+        with CondaSearchCache._lock:
+            CondaSearchCache._catalogs[package] = (index, catalog)
+        return catalog
+
+    @staticmethod
+    def invalidate(remove_snapshots: bool = False):
+        """
+        Drops the indexes and catalogs held in memory and optionally the snapshots on disk
+
+        :param remove_snapshots:  (Default value = False)
+        :type remove_snapshots: bool
+
+        """
+        with CondaSearchCache._lock:
+            CondaSearchCache._indexes.clear()
+            CondaSearchCache._catalogs.clear()
+        if remove_snapshots:
+            for cache_path in CondaSearchCache.get_cache_dir().glob("conda_search_*.json"):
+                cache_path.unlink()
+
+
+class VersionCatalog(NamedTuple):
+    """
+    Candidate versions parsed once into packed keys (see CondaSearchCache.get_version_key) and sorted for bisect
+    """
+
+    versions: tuple
+    keys: tuple
+    final_versions: tuple
+    final_keys: tuple
+
+
+class VersionConstraintEngine:
+    """
+    Matches poetry style version constraints against a VersionCatalog without importing poetry-core.
+
+    A constraint is compiled once into sorted, non overlapping [low, high) ranges of packed version keys, so every
+    lookup is a couple of bisects. Supported clauses: ^, ~, ~=, ==, =, !=, >=, >, <=, <, *, X.Y.* and bare versions,
+    joined with "," or spaces (and) and "||" (or). Like poetry, "<X.Y" excludes the pre-releases of X.Y.
+    """
+
+    min_key = ()
+    max_key = (math.inf,)
+    _lock = threading.Lock()
+    _compiled = {}
+    _clause_pattern = re.compile(r"^(\^|~=|~|==|!=|>=|<=|>|<|=)?(.*)$")
+    _release_pattern = re.compile(r"^v?(\d+(?:\.\d+)*)(\.\*)?")
+    _operator_spacing = re.compile(r"(\^|~=|~|==|!=|>=|<=|>|<|=)\s+")
+
+    @staticmethod
+    def build_catalog(versions) -> VersionCatalog:
+        """
+        Sorts and deduplicates versions
+
+        :param versions:
+        :rtype: VersionCatalog
+
+        """
+        keyed = sorted({(CondaSearchCache.get_version_key(v), v) for v in versions})
+        finals = [(k, v) for k, v in keyed if k[3] == 3]
+        return VersionCatalog(
+            versions=tuple(v for _, v in keyed),
+            keys=tuple(k for k, _ in keyed),
+            final_versions=tuple(v for _, v in finals),
+            final_keys=tuple(k for k, _ in finals),
+        )
+
+    @staticmethod
+    def get_release_bound(parts: List[int], index: int) -> tuple:
+        """
+        Returns the key just below every pre-release of the release made by bumping parts[index]
+
+        :param parts:
+        :type parts: List[int]
+        :param index:
+        :type index: int
+        :rtype: tuple
+
+        """
+        bumped = parts[:index] + [parts[index] + 1]
+        bumped += [0] * (3 - len(bumped))
+        return tuple(bumped[:3]) + (-1, 0)
+
+    @staticmethod
+    def get_successor(key: tuple) -> tuple:
+        """
+        Returns the smallest key greater than key
+
+        :param key:
+        :type key: tuple
+        :rtype: tuple
+
+        """
+        return key[:4] + (key[4] + 1,)
+
+    @staticmethod
+    def compile_clause(clause: str) -> List[tuple]:
+        """
+        Compiles a single clause (e.g. "^3.8", ">=3.8", "3.10.*") into [low, high) ranges
+
+        :param clause:
+        :type clause: str
+        :rtype: List[tuple]
+
+        """
+        engine = VersionConstraintEngine
+        operator, version = engine._clause_pattern.match(clause).groups()
+        operator = operator or "=="
+        if version in ("", "*"):
+            return [(engine.min_key, engine.max_key)] if operator != "!=" else []
+        release_match = engine._release_pattern.match(version)
+        if release_match is None:
+            raise ValueError(f"Unable to parse the version constraint {clause!r}")
+        parts = [int(p) for p in release_match.group(1).split(".")]
+        key = CondaSearchCache.get_version_key(version.lstrip("v"))
+        is_prerelease = key[3] != 3
+        if release_match.group(2):  # X.Y.* wildcard
+            low = tuple((parts + [0, 0])[:3]) + (-1, 0)
+            ranges = [(low, engine.get_release_bound(parts, len(parts) - 1))]
+            if operator == "!=":
+                ranges = [(engine.min_key, ranges[0][0]), (ranges[0][1], engine.max_key)]
+            return ranges
+        if operator in ("==", "="):
+            return [(key, engine.get_successor(key))]
+        if operator == "!=":
+            return [(engine.min_key, key), (engine.get_successor(key), engine.max_key)]
+        if operator == ">=":
+            return [(key, engine.max_key)]
+        if operator == ">":
+            return [(engine.get_successor(key), engine.max_key)]
+        if operator == "<=":
+            return [(engine.min_key, engine.get_successor(key))]
+        if operator == "<":
+            high = key if is_prerelease else tuple((parts + [0, 0])[:3]) + (-1, 0)
+            return [(engine.min_key, high)]
+        if operator == "^":
+            non_zero = [i for i, p in enumerate(parts[:3]) if p != 0]
+            index = non_zero[0] if non_zero else min(len(parts), 3) - 1
+            return [(key, engine.get_release_bound(parts, index))]
+        if operator == "~":
+            return [(key, engine.get_release_bound(parts, 0 if len(parts) == 1 else 1))]
+        # ~=
+        return [(key, engine.get_release_bound(parts, max(len(parts) - 2, 0)))]
+
+    @staticmethod
+    def intersect(ranges_a: List[tuple], ranges_b: List[tuple]) -> List[tuple]:
+        """ """
+        ranges = []
+        for low_a, high_a in ranges_a:
+            for low_b, high_b in ranges_b:
+                low, high = max(low_a, low_b), min(high_a, high_b)
+                if low < high:
+                    ranges.append((low, high))
+        return VersionConstraintEngine.merge(ranges)
+
+    @staticmethod
+    def merge(ranges: List[tuple]) -> List[tuple]:
+        """ """
+        merged = []
+        for low, high in sorted(ranges):
+            if merged and low <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+            else:
+                merged.append((low, high))
+        return merged
+
+    @staticmethod
+    def compile(constraint: str) -> tuple:
+        """
+        Compiles (and memoizes) a whole constraint into sorted, non overlapping [low, high) key ranges
+
+        :param constraint:
+        :type constraint: str
+        :rtype: tuple
+
+        """
+        engine = VersionConstraintEngine
+        with engine._lock:
+            ranges = engine._compiled.get(constraint)
+        if ranges is not None:
+            return ranges
+        normalized = engine._operator_spacing.sub(r"\1", constraint.strip().strip('"').strip("'"))
+        all_ranges = []
+        for alternative in re.split(r"\|\|?", normalized):
+            alternative_ranges = [(engine.min_key, engine.max_key)]
+            for clause in re.split(r"[,\s]+", alternative.strip()):
+                if clause:
+                    alternative_ranges = engine.intersect(alternative_ranges, engine.compile_clause(clause))
+            all_ranges.extend(alternative_ranges)
+        ranges = tuple(engine.merge(all_ranges))
+        with engine._lock:
+            engine._compiled[constraint] = ranges
+        return ranges
+
+    @staticmethod
+    def get_candidates(catalog: VersionCatalog, allow_prereleases: bool) -> tuple:
+        """ """
+        if allow_prereleases:
+            return catalog.versions, catalog.keys
+        return catalog.final_versions, catalog.final_keys
+
+    @staticmethod
+    def allowed_versions(catalog: VersionCatalog, constraint: str, allow_prereleases: bool = True) -> List[str]:
+        """
+        Returns the versions of catalog that constraint allows, from lowest to highest
+
+        :param catalog:
+        :type catalog: VersionCatalog
+        :param constraint:
+        :type constraint: str
+        :param allow_prereleases:  (Default value = True)
+        :type allow_prereleases: bool
+        :rtype: List[str]
+
+        """
+        versions, keys = VersionConstraintEngine.get_candidates(catalog, allow_prereleases)
+        allowed = []
+        for low, high in VersionConstraintEngine.compile(constraint):
+            allowed.extend(versions[bisect.bisect_left(keys, low): bisect.bisect_left(keys, high)])
+        return allowed
+
+    @staticmethod
+    def select(
+            catalog: VersionCatalog, constraint: str, highest: bool = True, allow_prereleases: bool = False
+    ) -> Union[str, None]:
+        """
+        Returns the highest (or lowest) version of catalog that constraint allows, None if there isn't one
+
+        :param catalog:
+        :type catalog: VersionCatalog
+        :param constraint:
+        :type constraint: str
+        :param highest:  (Default value = True)
+        :type highest: bool
+        :param allow_prereleases:  (Default value = False)
+        :type allow_prereleases: bool
+        :rtype: Union[str, None]
+
+        """
+        versions, keys = VersionConstraintEngine.get_candidates(catalog, allow_prereleases)
+        ranges = VersionConstraintEngine.compile(constraint)
+        for low, high in (reversed(ranges) if highest else ranges):
+            start, end = bisect.bisect_left(keys, low), bisect.bisect_left(keys, high)
+            if start < end:
+                return versions[end - 1] if highest else versions[start]
+        return None
+
+    @staticmethod
+    def select_many(
+            catalog: VersionCatalog, constraints, highest: bool = True, allow_prereleases: bool = False
+    ) -> Dict[str, Union[str, None]]:
+        """
+        Batch version of select: {constraint: selected version}
+
+        :param catalog:
+        :type catalog: VersionCatalog
+        :param constraints: iterable of constraints
+        :param highest:  (Default value = True)
+        :type highest: bool
+        :param allow_prereleases:  (Default value = False)
+        :type allow_prereleases: bool
+        :rtype: Dict[str, Union[str, None]]
+
+        """
+        return {
+            constraint: VersionConstraintEngine.select(catalog, constraint, highest, allow_prereleases)
+            for constraint in dict.fromkeys(constraints)
+        }
+
+
+class CondaWarmPool:
+    """
+    Keeps pre-built, bootstrapped conda envs per python version so a new project only has to rename one of them.
+
+    Pool envs are named pm_warm_<python version>_<id>. An env is marked ready (in the warm_pool state dir next to the
+    CondaSearchCache snapshots) once it was created and bootstrapped, without a kernel. It's claimed with an atomic
+    mkdir, so two processes never get the same env, and then renamed with `conda rename`. That clones the env with
+    hardlinks and fixes the prefixes baked into its scripts, which moving the directory wouldn't.
+    """
+
+    env_name_prefix = "pm_warm_"
+    size = 1
+    stale_after = 6 * 60 * 60
+    _lock = threading.Lock()
+    _refill_procs = {}
+
+    @staticmethod
+    def get_state_dir() -> Path:
+        """ """
+        state_dir = CondaSearchCache.get_cache_dir().joinpath("warm_pool")
+        state_dir.mkdir(parents=True, exist_ok=True)
+        return state_dir
+
+    @staticmethod
+    def get_pool_key(python_version: str) -> str:
+        """
+        Resolves python_version (a version or a constraint) to the version conda installs and slugifies it
+
+        :param python_version:
+        :type python_version: str
+        :rtype: str
+
+        """
+        python_version_str = CondaEnvManager.get_python_version_for_conda(python_version)
+        return re.sub(r"[^0-9A-Za-z]", "_", python_version_str[len("python="):])
+
+    @staticmethod
+    def get_pool_env_names(pool_key: str) -> List[str]:
+        """
+
+        :param pool_key:
+        :type pool_key: str
+        :rtype: List[str]
+
+        """
+        env_name_start = f"{CondaWarmPool.env_name_prefix}{pool_key}_"
+        return [r.name for r in CondaEnvIndex.get_records() if r.name.startswith(env_name_start)]
+
+    @staticmethod
+    def get_marker(env_name: str, state: str) -> Path:
+        """
+        Returns the path of the "building", "ready" or "claim" marker of a pool env
+
+        :param env_name:
+        :type env_name: str
+        :param state:
+        :type state: str
+        :rtype: Path
+
+        """
+        return CondaWarmPool.get_state_dir().joinpath(f"{env_name}.{state}")
+
+    @staticmethod
+    def list_ready(pool_key: str) -> List[str]:
+        """
+        Returns the pool envs of pool_key that are bootstrapped and not claimed yet
+
+        :param pool_key:
+        :type pool_key: str
+        :rtype: List[str]
+
+        """
+        return [
+            env_name
+            for env_name in CondaWarmPool.get_pool_env_names(pool_key)
+            if CondaWarmPool.get_marker(env_name, "ready").exists()
+            and not CondaWarmPool.get_marker(env_name, "claim").exists()
+        ]
+
+    @staticmethod
+    def list_building(pool_key: str) -> List[str]:
+        """
+        Returns the pool envs of pool_key whose build is in progress (started less than stale_after seconds ago)
+
+        :param pool_key:
+        :type pool_key: str
+        :rtype: List[str]
+
+        """
+        return [
+            building_marker.name[: -len(".building")]
+            for building_marker in CondaWarmPool.get_state_dir().glob(
+                f"{CondaWarmPool.env_name_prefix}{pool_key}_*.building"
+            )
+            if time.time() - building_marker.stat().st_mtime <= CondaWarmPool.stale_after
+        ]
+
+    @staticmethod
+    def acquire_refill_lock(pool_key: str) -> bool:
+        """
+        Takes the pool-level refill lock of pool_key with an atomic mkdir, returns False if another refill holds it
+
+        A lock older than stale_after is left behind by a refill that died, so it's taken over.
+
+        :param pool_key:
+        :type pool_key: str
+        :rtype: bool
+
+        """
+        lock_dir = CondaWarmPool.get_state_dir().joinpath(f"{pool_key}.refill.lock")
+        try:
+            lock_dir.mkdir()
+        except FileExistsError:
+            try:
+                if time.time() - lock_dir.stat().st_mtime <= CondaWarmPool.stale_after:
+                    return False
+                os.utime(lock_dir)
+            except FileNotFoundError:
+                return CondaWarmPool.acquire_refill_lock(pool_key)
+        return True
+
+    @staticmethod
+    def build_env(python_version: str) -> Union[str, None]:
+        """
+        Creates and bootstraps one pool env, returns its name or None if that failed
+
+        :param python_version:
+        :type python_version: str
+        :rtype: Union[str, None]
+
+        """
+        pool_key = CondaWarmPool.get_pool_key(python_version)
+        env_name = f"{CondaWarmPool.env_name_prefix}{pool_key}_{uuid.uuid4().hex[:8]}"
+        building_marker = CondaWarmPool.get_marker(env_name, "building")
+        building_marker.write_text(str(os.getpid()))
+        python_version_str = CondaEnvManager.get_python_version_for_conda(python_version)
+        rc = CondaEnvManager.create_conda_env(env_name, python_version_str[len("python="):])
+        if rc == 0:
+            steps = [step for step in BootstrapPlanner.get_default_steps() if step.action != "register_kernel"]
+            step_rcs = BootstrapPlanner.execute(BootstrapPlanner.plan(env_name, steps))
+            rc = 0 if (len(step_rcs) == len(steps)) and not any(step_rcs.values()) else 1
+        if rc != 0:
+            print(f"Unable to build the warm env {env_name!r}")
+            CondaEnvTeardown.teardown([env_name], kernel_names=[env_name])
+            building_marker.unlink()
+            return None
+        CondaWarmPool.get_marker(env_name, "ready").touch()
+        building_marker.unlink()
+        CondaEnvIndex.invalidate()
+        return env_name
+
+    @staticmethod
+    def refill(python_version: str, size: int = None) -> List[str]:
+        """
+        Builds pool envs until size of them are ready, returns the names of the new ones
+
+        Envs another process is still building count toward size, and only one refill per pool key runs at a time, so
+        concurrent refills don't overshoot the pool size.
+
+        :param python_version:
+        :type python_version: str
+        :param size:  (Default value = None) defaults to CondaWarmPool.size
+        :type size: int
+        :rtype: List[str]
+
+        """
+        size = CondaWarmPool.size if size is None else size
+        pool_key = CondaWarmPool.get_pool_key(python_version)
+        built_env_names = []
+        if not CondaWarmPool.acquire_refill_lock(pool_key):
+            return built_env_names
+        try:
+            pending = len(CondaWarmPool.list_ready(pool_key)) + len(CondaWarmPool.list_building(pool_key))
+            for _ in range(max(size - pending, 0)):
+                env_name = CondaWarmPool.build_env(python_version)
+                if env_name is None:
+                    break
+                built_env_names.append(env_name)
+        finally:
+            CondaWarmPool.get_state_dir().joinpath(f"{pool_key}.refill.lock").rmdir()
+        return built_env_names
+
+    @staticmethod
+    def get_refill_args(python_version: str, size: int = None) -> List[str]:
+        """
+        Returns the command that runs CondaWarmPool.refill in a new python process
+
+        :param python_version:
+        :type python_version: str
+        :param size:  (Default value = None)
+        :type size: int
+        :rtype: List[str]
+
+        """
+        script = (
+            "import json, sys; from project_manager.project_manager import CondaWarmPool; "
+            "CondaWarmPool.refill(*json.loads(sys.argv[1]))"
+        )
+        return [sys.executable, "-c", script, json.dumps([python_version, size])]
+
+    @staticmethod
+    def refill_in_background(python_version: str, size: int = None) -> Popen:
+        """
+        Starts (at most) one detached refill process per python version and returns it
+
+        The process runs in its own session, so the refill carries on after this interpreter exits and isn't killed
+        along with the terminal's process group. Its output goes to <pool key>.refill.log in the state dir.
+
+        :param python_version:
+        :type python_version: str
+        :param size:  (Default value = None)
+        :type size: int
+        :rtype: Popen
+
+        """
+        pool_key = CondaWarmPool.get_pool_key(python_version)
+        with CondaWarmPool._lock:
+            proc = CondaWarmPool._refill_procs.get(pool_key)
+            if (proc is None) or (proc.poll() is not None):
+                env = dict(os.environ)
+                package_root = Path(__file__).resolve().parent.parent.as_posix()
+                env["PYTHONPATH"] = os.pathsep.join(p for p in (package_root, env.get("PYTHONPATH")) if p)
+                if platform.system() == "Windows":
+                    detach_kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS}
+                else:
+                    detach_kwargs = {"start_new_session": True}
+                log_path = CondaWarmPool.get_state_dir().joinpath(f"{pool_key}.refill.log")
+                with open(log_path, "ab") as log_file:
+                    proc = subprocess.Popen(
+                        CondaWarmPool.get_refill_args(python_version, size),
+                        stdin=subprocess.DEVNULL,
+                        stdout=log_file,
+                        stderr=subprocess.STDOUT,
+                        env=env,
+                        **detach_kwargs,
+                    )
+                CondaWarmPool._refill_procs[pool_key] = proc
+        return proc
+
+    @staticmethod
+    def claim(python_version: str, new_env_name: str) -> bool:
+        """
+        Renames a ready pool env to new_env_name, returns False if the pool had none
+
+        :param python_version:
+        :type python_version: str
+        :param new_env_name:
+        :type new_env_name: str
+        :rtype: bool
+
+        """
+        for env_name in CondaWarmPool.list_ready(CondaWarmPool.get_pool_key(python_version)):
+            claim_marker = CondaWarmPool.get_marker(env_name, "claim")
+            try:
+                claim_marker.mkdir()
+            except FileExistsError:
+                continue  # claimed by someone else in the meantime
+            rc = CommonPSCommands.run_command(["conda", "rename", "-n", env_name, new_env_name], text=True)
+            CondaEnvIndex.invalidate()
+            if rc != 0:
+                print(f"Unable to rename the warm env {env_name!r} to {new_env_name!r}")
+                claim_marker.rmdir()
+                return False
+            CondaWarmPool.get_marker(env_name, "ready").unlink()
+            claim_marker.rmdir()
+            return True
+        return False
+
+    @staticmethod
+    def prune(stale_after: float = None) -> TeardownReport:
+        """
+        Removes pool envs whose build never finished and started more than stale_after seconds ago
+
+        :param stale_after:  (Default value = None) defaults to CondaWarmPool.stale_after
+        :type stale_after: float
+        :rtype: TeardownReport
+
+        """
+        stale_after = CondaWarmPool.stale_after if stale_after is None else stale_after
+        stale_env_names = []
+        for building_marker in CondaWarmPool.get_state_dir().glob("*.building"):
+            if time.time() - building_marker.stat().st_mtime > stale_after:
+                env_name = building_marker.name[: -len(".building")]
+                stale_env_names.append(env_name)
+                building_marker.unlink()
+                CondaWarmPool.get_marker(env_name, "ready").unlink(missing_ok=True)
+        return CondaEnvTeardown.teardown(stale_env_names, kernel_names=stale_env_names)
+
+
+class CondaExplicitSpec:
+    """
+    Reads and writes explicit conda package lists (the format of `conda list --explicit --md5`) without running conda.
+
+    The spec of an env is rendered straight from the records in its conda-meta directory, and a spec can be checked
+    against the pkgs cache, so an env can be recreated with `conda create --file <spec> --offline` whenever every
+    package is already cached.
+    """
+
+    _auth_pattern = re.compile(r"^(\w+://)[^/@]+@")
+    _token_pattern = re.compile(r"/t/[^/]+")
+    _archive_suffixes = (".tar.bz2", ".conda")
+
+    @staticmethod
+    def get_subdir() -> str:
+        """
+        Returns the conda subdir (e.g. linux-64) of this machine
+
+        :rtype: str
+
+        """
+        system = {"Linux": "linux", "Darwin": "osx", "Windows": "win"}.get(platform.system(), platform.system().lower())
+        machine = platform.machine().lower()
+        arch = {"x86_64": "64", "amd64": "64", "arm64": "arm64", "aarch64": "aarch64", "ppc64le": "ppc64le"}.get(
+            machine, "32" if machine in ("i386", "i686", "x86") else machine
+        )
+        if (system == "linux") and (arch == "arm64"):
+            arch = "aarch64"
+        return f"{system}-{arch}"
+
+    @staticmethod
+    def remove_auth(url: str) -> str:
+        """
+        Strips user:password@ and /t/<token> from a channel url, like `conda list --explicit` does
+
+        :param url:
+        :type url: str
+        :rtype: str
+
+        """
+        return CondaExplicitSpec._token_pattern.sub("", CondaExplicitSpec._auth_pattern.sub(r"\1", url), count=1)
+
+    @staticmethod
+    def read_records(prefix: str) -> List[Dict[str, Any]]:
+        """
+        Returns the conda-meta records of the packages installed in prefix, without their file lists
+
+        :param prefix:
+        :type prefix: str
+        :rtype: List[Dict[str, Any]]
+
+        """
+        records = []
+        with os.scandir(Path(prefix).joinpath("conda-meta")) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.is_file():
+                    with open(entry.path, "r") as f:
+                        record = json.load(f)
+                    for bulky_key in ("files", "paths_data"):
+                        record.pop(bulky_key, None)
+                    records.append(record)
+        return records
+
+    @staticmethod
+    def sort_records(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Orders records so dependencies come before their dependents (alphabetically among equals)
+
+        :param records:
+        :type records: List[Dict[str, Any]]
+        :rtype: List[Dict[str, Any]]
+
+        """
+        by_name = {record["name"]: record for record in records}
+        remaining = {
+            name: {d.split()[0] for d in record.get("depends", [])} & set(by_name) - {name}
+            for name, record in by_name.items()
+        }
+        sorted_records = []
+        while remaining:
+            ready = sorted(name for name, deps in remaining.items() if not deps)
+            if not ready:
+                ready = sorted(remaining)[:1]  # break a dependency cycle
+            for name in ready:
+                sorted_records.append(by_name[name])
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return sorted_records
+
+    @staticmethod
+    def render(prefix: str, hash_type: str = "md5") -> str:
+        """
+        Returns the explicit spec of the env at prefix
+
+        :param prefix:
+        :type prefix: str
+        :param hash_type: "md5", "sha256" or "" for urls without hashes  (Default value = "md5")
+        :type hash_type: str
+        :rtype: str
+
+        """
+        records = CondaExplicitSpec.sort_records(CondaExplicitSpec.read_records(prefix))
+        subdirs = [r.get("subdir") for r in records if r.get("subdir") not in (None, "noarch")]
+        subdir = max(set(subdirs), key=subdirs.count) if subdirs else CondaExplicitSpec.get_subdir()
+        lines = [
+            "# This file may be used to create an environment using:",
+            "# $ conda create --name <env> --file <this file>",
+            f"# platform: {subdir}",
+            "@EXPLICIT",
+        ]
+        for record in records:
+            url = record.get("url")
+            if (not url) or url.startswith("<unknown>"):
+                lines.append(f"# no URL for: {record.get('fn')}")
+                continue
+            url = CondaExplicitSpec.remove_auth(url)
+            hash_value = record.get(hash_type) if hash_type else None
+            lines.append(url + (f"#{hash_value}" if hash_value else ""))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def parse(spec_text: str) -> List[str]:
+        """
+        Returns the package urls (with their #hash) of an explicit spec
+
+        :param spec_text:
+        :type spec_text: str
+        :rtype: List[str]
+
+        """
+        lines = [l.strip() for l in spec_text.splitlines()]
+        assert "@EXPLICIT" in lines, "Not an explicit spec, it's missing the @EXPLICIT marker"
+        return [l for l in lines[lines.index("@EXPLICIT") + 1:] if l and not l.startswith("#")]
+
+    @staticmethod
+    def get_pkgs_dirs() -> List[Path]:
+        """
+        Returns the package caches conda looks in: $CONDA_PKGS_DIRS or <conda base>/pkgs and ~/.conda/pkgs
+
+        :rtype: List[Path]
+
+        """
+        if os.environ.get("CONDA_PKGS_DIRS"):
+            return [Path(p).expanduser() for p in os.environ["CONDA_PKGS_DIRS"].split(",") if p]
+        pkgs_dirs = [Path("~/.conda/pkgs").expanduser()]
+        conda_base = CondaEnvIndex.get_conda_base()
+        if conda_base:
+            pkgs_dirs.insert(0, Path(conda_base).joinpath("pkgs"))
+        return pkgs_dirs
+
+    @staticmethod
+    def is_cached(url: str, pkgs_dirs: List[Path] = None) -> bool:
+        """
+        Returns True if the package of url is in a pkgs cache, either as an archive or already extracted
+
+        :param url:
+        :type url: str
+        :param pkgs_dirs:  (Default value = None) defaults to CondaExplicitSpec.get_pkgs_dirs()
+        :type pkgs_dirs: List[Path]
+        :rtype: bool
+
+        """
+        fn = url.split("#", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        dist_name = fn
+        for suffix in CondaExplicitSpec._archive_suffixes:
+            if fn.endswith(suffix):
+                dist_name = fn[: -len(suffix)]
+        for pkgs_dir in (pkgs_dirs or CondaExplicitSpec.get_pkgs_dirs()):
+            if pkgs_dir.joinpath(fn).is_file() or pkgs_dir.joinpath(dist_name, "info", "index.json").is_file():
+                return True
+        return False
+
+    @staticmethod
+    def get_missing_packages(spec_text: str) -> List[str]:
+        """
+        Returns the urls of an explicit spec whose packages aren't cached yet
+
+        :param spec_text:
+        :type spec_text: str
+        :rtype: List[str]
+
+        """
+        pkgs_dirs = CondaExplicitSpec.get_pkgs_dirs()
+        return [url for url in CondaExplicitSpec.parse(spec_text) if not CondaExplicitSpec.is_cached(url, pkgs_dirs)]
+
+
+class CondaSolveCache:
+    """
+    Content addressed cache of conda solves, stored as explicit specs under $XDG_CACHE_HOME/project_manager/solves.
+
+    The key hashes the requested specs with the channels, channel priority and platform they were solved for, so a hit
+    can be replayed with `conda create --file <spec>` (see CondaExplicitSpec) without running the solver. Entries
+    expire ttl seconds after they were stored.
+    """
+
+    ttl = 7 * 24 * 60 * 60
+    hits = 0
+    misses = 0
+    expired = 0
+    stores = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_cache_dir() -> Path:
+        """ """
+        return CondaSearchCache.get_cache_dir().joinpath("solves")
+
+    @staticmethod
+    def get_solve_context() -> Dict[str, Any]:
+        """
+        Returns the channels, channel priority and platform the next solve would use
+
+        :rtype: Dict[str, Any]
+
+        """
+        lines = CondarcEditor.read_lines(CondarcEditor.get_user_condarc())
+        channels = ["defaults"]
+        channel_priority = "flexible"
+        try:
+            block = CondarcEditor.find_block(lines, "channels")
+            if block is not None:
+                channels = CondarcEditor.get_sequence(lines, block)
+            block = CondarcEditor.find_block(lines, "channel_priority")
+            if block is not None:
+                channel_priority = CondarcEditor.strip_value(CondarcEditor._key_pattern.match(lines[block[0]]).group(2))
+        except ValueError:
+            channels = lines  # fall back to keying on the whole .condarc
+        if os.environ.get("CONDA_CHANNEL_PRIORITY"):
+            channel_priority = os.environ["CONDA_CHANNEL_PRIORITY"]
+        return {
+            "channels": channels,
+            "channel_priority": str(channel_priority).lower(),
+            "subdir": CondaExplicitSpec.get_subdir(),
+        }
+
+    @staticmethod
+    def get_key(specs: List[str], solve_context: Dict[str, Any] = None) -> str:
+        """
+        Hashes specs (in any order) together with the solve context
+
+        :param specs:
+        :type specs: List[str]
+        :param solve_context:  (Default value = None) defaults to CondaSolveCache.get_solve_context()
+        :type solve_context: Dict[str, Any]
+        :rtype: str
+
+        """
+        solve_context = solve_context or CondaSolveCache.get_solve_context()
+        key_parts = {"specs": sorted({" ".join(spec.split()) for spec in specs}), **solve_context}
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def get_entry_path(key: str) -> Path:
+        """ """
+        return CondaSolveCache.get_cache_dir().joinpath(f"{key}.txt")
+
+    @staticmethod
+    def count(stat: str):
+        """ """
+        with CondaSolveCache._lock:
+            setattr(CondaSolveCache, stat, getattr(CondaSolveCache, stat) + 1)
+
+    @staticmethod
+    def lookup(key: str, ttl: float = None) -> Union[Path, None]:
+        """
+        Returns the explicit spec stored under key, None on a miss or if the entry expired (it's removed then)
+
+        :param key:
+        :type key: str
+        :param ttl:  (Default value = None) defaults to CondaSolveCache.ttl
+        :type ttl: float
+        :rtype: Union[Path, None]
+
+        """
+        ttl = CondaSolveCache.ttl if ttl is None else ttl
+        entry_path = CondaSolveCache.get_entry_path(key)
+        try:
+            age = time.time() - entry_path.stat().st_mtime
+        except OSError:
+            CondaSolveCache.count("misses")
+            return None
+        if age > ttl:
+            entry_path.unlink(missing_ok=True)
+            CondaSolveCache.count("expired")
+            CondaSolveCache.count("misses")
+            return None
+        CondaSolveCache.count("hits")
+        return entry_path
+
+    @staticmethod
+    def store(key: str, spec_text: str) -> Path:
+        """
+        Atomically stores an explicit spec under key
+
+        :param key:
+        :type key: str
+        :param spec_text:
+        :type spec_text: str
+        :rtype: Path
+
+        """
+        CondaExplicitSpec.parse(spec_text)
+        entry_path = CondaSolveCache.get_entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = entry_path.with_name(f"{entry_path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(spec_text)
+        os.replace(tmp_path, entry_path)
+        CondaSolveCache.count("stores")
+        return entry_path
+
+    @staticmethod
+    def prune(ttl: float = None) -> int:
+        """
+        Removes expired entries and returns how many were removed
+
+        :param ttl:  (Default value = None) defaults to CondaSolveCache.ttl
+        :type ttl: float
+        :rtype: int
+
+        """
+        ttl = CondaSolveCache.ttl if ttl is None else ttl
+        removed = 0
+        for entry_path in CondaSolveCache.get_cache_dir().glob("*.txt"):
+            if time.time() - entry_path.stat().st_mtime > ttl:
+                entry_path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """ """
+        with CondaSolveCache._lock:
+            return {
+                "hits": CondaSolveCache.hits,
+                "misses": CondaSolveCache.misses,
+                "expired": CondaSolveCache.expired,
+                "stores": CondaSolveCache.stores,
+                "entries": len(list(CondaSolveCache.get_cache_dir().glob("*.txt"))),
+            }
+
+    @staticmethod
+    def reset_stats():
+        """ """
+        with CondaSolveCache._lock:
+            CondaSolveCache.hits = CondaSolveCache.misses = CondaSolveCache.expired = CondaSolveCache.stores = 0
+
+
+class ProjectRootResolver:
+    """
+    Maps directories to the closest directory (themselves or a parent) that contains a marker file such as
+    pyproject.toml, for the lifetime of the process.
+
+    Directory listings are cached and only listed again when the directory's mtime changes, and results (None
+    included) are cached per (directory, marker) along with the mtimes of the directories that were searched, so a
+    cached result costs one `stat` per directory between the start and the project root.
+    """
+
+    max_entries: int = 4096
+    hits: int = 0
+    misses: int = 0
+    listings: int = 0
+    _listings = OrderedDict()
+    _roots = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_mtime(directory: str) -> Union[int, None]:
+        """
+        Returns the mtime of directory, or None if it isn't a directory
+
+        :param directory:
+        :type directory: str
+        :rtype: Union[int, None]
+
+        """
+        try:
+            stat = os.stat(directory)
+        except OSError:
+            return None
+        return stat.st_mtime_ns if os.path.isdir(directory) else None
+
+    @staticmethod
+    def cache_put(cache: OrderedDict, key, value):
+        """
+        Stores value in one of the bounded caches, dropping the least recently used entries
+
+        :param cache:
+        :type cache: OrderedDict
+        :param key:
+        :param value:
+
+        """
+        with ProjectRootResolver._lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > ProjectRootResolver.max_entries:
+                cache.popitem(last=False)
+
+    @staticmethod
+    def get_listing(directory: str, mtime: int) -> frozenset:
+        """
+        Returns the names in directory, listing it only if mtime differs from the cached listing
+
+        :param directory:
+        :type directory: str
+        :param mtime: as returned by get_mtime
+        :type mtime: int
+        :rtype: frozenset
+
+        """
+        with ProjectRootResolver._lock:
+            cached = ProjectRootResolver._listings.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            names = frozenset()
+        with ProjectRootResolver._lock:
+            ProjectRootResolver.listings += 1
+        ProjectRootResolver.cache_put(ProjectRootResolver._listings, directory, (mtime, names))
+        return names
+
+    @staticmethod
+    def get_start_dir(filepath: str) -> str:
+        """
+        Returns the directory a search starts from; a file (or a path that doesn't exist) is searched from its parent
+
+        :param filepath:
+        :type filepath: str
+        :rtype: str
+
+        """
+        filepath = os.path.abspath(filepath)
+        if os.path.isdir(filepath):
+            return filepath
+        return os.path.dirname(filepath)
+
+    @staticmethod
+    def is_valid(chain) -> bool:
+        """
+        Checks that none of the directories searched for a cached result changed since
+
+        :param chain: ((directory, mtime), ...)
+
+        """
+        return all(ProjectRootResolver.get_mtime(d) == m for d, m in chain)
+
+    @staticmethod
+    def find_root(directory: str, toml_pattern: str, resolved: Dict[str, Any] = None) -> Union[Path, None]:
+        """
+        Walks up from directory until a directory contains toml_pattern
+
+        :param directory: absolute path of a directory
+        :type directory: str
+        :param toml_pattern:
+        :type toml_pattern: str
+        :param resolved: directory -> result of the directories already resolved in this batch, trusted without
+            checking their mtimes again  (Default value = None)
+        :type resolved: Dict[str, Any]
+        :rtype: Union[Path, None]
+
+        """
+        resolved = {} if resolved is None else resolved
+        key = (directory, toml_pattern)
+        with ProjectRootResolver._lock:
+            cached = ProjectRootResolver._roots.get(key)
+        if cached is not None and ProjectRootResolver.is_valid(cached[1]):
+            with ProjectRootResolver._lock:
+                ProjectRootResolver.hits += 1
+            resolved[directory] = cached[0]
+            return cached[0]
+        with ProjectRootResolver._lock:
+            ProjectRootResolver.misses += 1
+        chain = []
+        visited = []
+        cur_dir = directory
+        project_root = None
+        while True:
+            if cur_dir in resolved:
+                project_root = resolved[cur_dir]
+                break
+            mtime = ProjectRootResolver.get_mtime(cur_dir)
+            chain.append((cur_dir, mtime))
+            visited.append(cur_dir)
+            if mtime is not None and toml_pattern in ProjectRootResolver.get_listing(cur_dir, mtime):
+                project_root = Path(cur_dir)
+                break
+            parent = os.path.dirname(cur_dir)
+            if parent == cur_dir:
+                break
+            cur_dir = parent
+        for d in visited:
+            resolved[d] = project_root
+        ProjectRootResolver.cache_put(ProjectRootResolver._roots, key, (project_root, tuple(chain)))
+        return project_root
+
+    @staticmethod
+    def resolve(filepath: str, toml_pattern: str = "pyproject.toml") -> Union[Path, None]:
+        """
+        Returns the closest directory (filepath itself, or one of its parents) that contains toml_pattern, or None
+
+        :param filepath:
+        :type filepath: str
+        :param toml_pattern:  (Default value = "pyproject.toml")
+        :type toml_pattern: str
+        :rtype: Union[Path, None]
+
+        """
+        start_dir = ProjectRootResolver.get_start_dir(filepath)
+        return ProjectRootResolver.find_root(start_dir, toml_pattern)
+
+    @staticmethod
+    def resolve_many(filepaths, toml_pattern: str = "pyproject.toml") -> Dict[str, Union[Path, None]]:
+        """
+        Resolves every path in filepaths, searching each distinct directory once
+
+        :param filepaths: iterable of paths (i.e. every file of a source tree)
+        :param toml_pattern:  (Default value = "pyproject.toml")
+        :type toml_pattern: str
+        :rtype: Dict[str, Union[Path, None]]
+
+        """
+        resolved = {}
+        project_roots = {}
+        for filepath in filepaths:
+            start_dir = ProjectRootResolver.get_start_dir(filepath)
+            if start_dir not in resolved:
+                ProjectRootResolver.find_root(start_dir, toml_pattern, resolved=resolved)
+            project_roots[str(filepath)] = resolved[start_dir]
+        return project_roots
+
+    @staticmethod
+    def invalidate():
+        """ """
+        with ProjectRootResolver._lock:
+            ProjectRootResolver._listings.clear()
+            ProjectRootResolver._roots.clear()
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """ """
+        with ProjectRootResolver._lock:
+            return {
+                "hits": ProjectRootResolver.hits,
+                "misses": ProjectRootResolver.misses,
+                "listings": ProjectRootResolver.listings,
+                "entries": len(ProjectRootResolver._roots),
+            }
+
+    @staticmethod
+    def reset_stats():
+        """ """
+        with ProjectRootResolver._lock:
+            ProjectRootResolver.hits = 0
+            ProjectRootResolver.misses = 0
+            ProjectRootResolver.listings = 0
+
+
+class ProjectInventoryRecord(NamedTuple):
+    """
+    One project found by ProjectInventoryScanner; env_name is the env its poetry.toml points at and python its python
+    constraint ("" when they aren't declared)
+    """
+
+    root: str
+    markers: tuple
+    name: str
+    env_name: str
+    python: str
+    dependency_count: int
+    error: str = ""
+
+
+class ProjectInventoryScanner:
+    """
+    Walks a tree of projects with `os.scandir` across worker threads and yields a ProjectInventoryRecord for every
+    directory holding a pyproject.toml, poetry.toml or requirements.txt, as soon as it's found.
+
+    VCS metadata, node_modules, caches and virtual/conda envs (directories holding pyvenv.cfg or conda-meta) are pruned
+    and symlinked directories are never followed.
+    """
+
+    markers = ("pyproject.toml", "poetry.toml", "requirements.txt")
+    prune_dirs = frozenset(
+        {
+            ".git", ".hg", ".svn", "node_modules", ".venv", "venv", "__pycache__", ".tox", ".nox", ".mypy_cache",
+            ".pytest_cache", ".ipynb_checkpoints", ".eggs", "site-packages",
+        }
+    )
+    env_markers = ("pyvenv.cfg", "conda-meta")
+
+    @staticmethod
+    def count_requirements(requirements_txt_path: str) -> int:
+        """
+        Counts the requirement lines of a requirements.txt, ignoring comments and pip options
+
+        :param requirements_txt_path:
+        :type requirements_txt_path: str
+        :rtype: int
+
+        """
+        with open(requirements_txt_path, "r") as f:
+            lines = [l.split("#", 1)[0].strip() for l in f]
+        return sum(1 for l in lines if l and not l.startswith("-"))
+
+    @staticmethod
+    def build_record(directory: str, markers) -> ProjectInventoryRecord:
+        """
+        Reads the markers found in directory into a ProjectInventoryRecord
+
+        :param directory:
+        :type directory: str
+        :param markers: names of the marker files in directory
+        :rtype: ProjectInventoryRecord
+
+        """
+        name, env_name, python, dependency_count, errors = "", "", "", 0, []
+        if "pyproject.toml" in markers:
+            try:
+                with open(os.path.join(directory, "pyproject.toml"), "r") as f:
+                    tables = TomlParseCache.parse(f.read())
+                poetry_dependencies = tables.get("tool.poetry.dependencies", {})
+                project = tables.get("project", {})
+                name = tables.get("tool.poetry", {}).get("name", "") or project.get("name", "")
+                python = poetry_dependencies.get("python", "") or project.get("requires-python", "")
+                dependency_count = len([d for d in poetry_dependencies if d.lower() != "python"])
+                dependency_count += len(project.get("dependencies", []))
+            except Exception as e:
+                errors.append(f"pyproject.toml: {e}")
+        if "poetry.toml" in markers:
+            try:
+                with open(os.path.join(directory, "poetry.toml"), "r") as f:
+                    virtualenvs_path = TomlParseCache.parse(f.read()).get("virtualenvs", {}).get("path", "")
+                env_name = Path(virtualenvs_path).name if virtualenvs_path else ""
+            except Exception as e:
+                errors.append(f"poetry.toml: {e}")
+        if ("requirements.txt" in markers) and not dependency_count:
+            try:
+                dependency_count = ProjectInventoryScanner.count_requirements(
+                    os.path.join(directory, "requirements.txt")
+                )
+            except Exception as e:
+                errors.append(f"requirements.txt: {e}")
+        return ProjectInventoryRecord(
+            directory, tuple(sorted(markers)), name, env_name, str(python), dependency_count, "; ".join(errors)
+        )
+
+    @staticmethod
+    def scan_dir(directory: str, prune_dirs: frozenset):
+        """
+        Lists directory once, returning its subdirectories to scan and its record (or None if it has no markers)
+
+        :param directory:
+        :type directory: str
+        :param prune_dirs:
+        :type prune_dirs: frozenset
+
+        """
+        subdirs, markers = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name in ProjectInventoryScanner.env_markers:
+                        return [], None
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in prune_dirs:
+                                subdirs.append(entry.path)
+                        elif entry.name in ProjectInventoryScanner.markers:
+                            markers.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            return [], None
+        record = ProjectInventoryScanner.build_record(directory, markers) if markers else None
+        return subdirs, record
+
+    @staticmethod
+    def scan(root: str = ".", max_workers: int = 8, prune_dirs=None):
+        """
+        Yields the ProjectInventoryRecord of every project under root (in no particular order) as the walk goes
+
+        :param root:  (Default value = ".")
+        :type root: str
+        :param max_workers:  (Default value = 8)
+        :type max_workers: int
+        :param prune_dirs: directory names to skip  (Default value = None) defaults to ProjectInventoryScanner.prune_dirs
+
+        """
+        prune_dirs = frozenset(ProjectInventoryScanner.prune_dirs if prune_dirs is None else prune_dirs)
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            pending = {pool.submit(ProjectInventoryScanner.scan_dir, os.path.abspath(root), prune_dirs)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subdirs, record = future.result()
+                    pending.update(pool.submit(ProjectInventoryScanner.scan_dir, d, prune_dirs) for d in subdirs)
+                    if record is not None:
+                        yield record
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def write_ndjson(records, stream) -> int:
+        """
+        Writes one JSON object per record and line, flushing as it goes
+
+        :param records: iterable of ProjectInventoryRecord
+        :param stream: text stream
+        :returns: the number of records written
+        :rtype: int
+
+        """
+        count = 0
+        for record in records:
+            stream.write(json.dumps(record._asdict()) + "\n")
+            stream.flush()
+            count += 1
+        return count
+
+    @staticmethod
+    def write_json(records, stream) -> int:
+        """
+        Writes the records as a JSON array, one element at a time
+
+        :param records: iterable of ProjectInventoryRecord
+        :param stream: text stream
+        :returns: the number of records written
+        :rtype: int
+
+        """
+        count = 0
+        stream.write("[")
+        for record in records:
+            stream.write(("," if count else "") + "\n  " + json.dumps(record._asdict()))
+            count += 1
+        stream.write("\n]\n" if count else "]\n")
+        stream.flush()
+        return count
+
+    @staticmethod
+    def write_inventory(root: str = ".", output_path: str = None, output_format: str = "ndjson",
+                        max_workers: int = 8) -> int:
+        """
+        Scans root and streams its inventory to output_path (or stdout)
+
+        :param root:  (Default value = ".")
+        :type root: str
+        :param output_path:  (Default value = None)
+        :type output_path: str
+        :param output_format: "ndjson" or "json"  (Default value = "ndjson")
+        :type output_format: str
+        :param max_workers:  (Default value = 8)
+        :type max_workers: int
+        :returns: the number of projects found
+        :rtype: int
+
+        """
+        writers = {"ndjson": ProjectInventoryScanner.write_ndjson, "json": ProjectInventoryScanner.write_json}
+        if output_format not in writers:
+            raise ValueError(f"Unknown inventory format {output_format!r}")
+        records = ProjectInventoryScanner.scan(root, max_workers=max_workers)
+        if output_path is None:
+            return writers[output_format](records, sys.stdout)
+        with open(output_path, "w") as f:
+            return writers[output_format](records, f)
+
+
+class TomlParseCache:
+    """
+    Process wide cache of parsed toml files, keyed on (path, mtime, size) so an edited file is parsed again.
+
+    Files are parsed with tomllib (or tomli on python<3.11) and fall back to a line based reader that only understands
+    `key = value` lines. Every file is kept as a read-only view of its tables, keyed by dotted name
+    ("tool.poetry.dependencies"), with nested tables as read-only views and arrays as tuples.
+    """
+
+    max_entries: int = 256
+    hits: int = 0
+    misses: int = 0
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_stat_key(path_to_toml: Path):
+        """
+        Returns the (mtime, size) of path_to_toml
+
+        :param path_to_toml:
+        :type path_to_toml: Path
+
+        """
+        stat = os.stat(path_to_toml)
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def freeze(value):
+        """
+        Turns dicts into read-only views and lists into tuples, recursively
+
+        :param value:
+
+        """
+        if isinstance(value, dict):
+            return MappingProxyType({k: TomlParseCache.freeze(v) for k, v in value.items()})
+        if isinstance(value, list):
+            return tuple(TomlParseCache.freeze(v) for v in value)
+        return value
+
+    @staticmethod
+    def flatten_tables(document: Dict[str, Any], prefix: str = "", tables: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        Returns every (nested) table of document keyed by its dotted name, arrays of tables included
+
+        :param document:
+        :type document: Dict[str, Any]
+        :param prefix:  (Default value = "")
+        :type prefix: str
+        :param tables:  (Default value = None)
+        :type tables: Dict[str, Any]
+        :rtype: Dict[str, Any]
+
+        """
+        tables = {} if tables is None else tables
+        for key, value in document.items():
+            name = f"{prefix}.{key}" if prefix else key
+            if isinstance(value, dict):
+                tables[name] = value
+                TomlParseCache.flatten_tables(value, name, tables)
+            elif isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+                tables[name] = value
+        return tables
+
+    @staticmethod
+    def parse_lines(text: str) -> Dict[str, Dict[str, str]]:
+        """
+        Line based reader used when neither tomllib nor tomli is available; values are kept as unquoted strings and
+        keys before the first table go in the "" table
+
+        :param text:
+        :type text: str
+        :rtype: Dict[str, Dict[str, str]]
+
+        """
+        tables = defaultdict(dict)
+        cur_dict = tables[""]
+        for line in text.splitlines():
+            cur_line = line.strip()
+            if (not cur_line) or cur_line.startswith("#"):
+                continue
+            is_section = cur_line.startswith("[") and cur_line.endswith("]") and ("=" not in cur_line)
+            if is_section:
+                cur_dict = tables[cur_line.strip("[]").strip()]
+                continue
+            key, *value = cur_line.split("=")
+            cur_dict[key.strip().strip('"')] = "=".join(value).replace('"', "").strip()
+        if not tables[""]:
+            del tables[""]
+        return dict(tables)
+
+    @staticmethod
+    def parse(text: str) -> Dict[str, Any]:
+        """
+        Parses text into its tables keyed by dotted name
+
+        :param text:
+        :type text: str
+        :rtype: Dict[str, Any]
+
+        """
+        try:
+            loads = import_optional_dependency("toml_loads")
+        except ImportError:
+            return TomlParseCache.parse_lines(text)
+        return TomlParseCache.flatten_tables(loads(text))
+
+    @staticmethod
+    def get_tables(path_to_toml) -> Mapping:
+        """
+        Returns the read-only tables of path_to_toml, parsing it only if it changed since it was last read
+
+        :param path_to_toml:
+        :rtype: Mapping
+
+        """
+        path_to_toml = Path(path_to_toml).resolve()
+        stat_key = TomlParseCache.get_stat_key(path_to_toml)
+        with TomlParseCache._lock:
+            entry = TomlParseCache._entries.get(path_to_toml)
+            if entry is not None and entry[0] == stat_key:
+                TomlParseCache.hits += 1
+                TomlParseCache._entries.move_to_end(path_to_toml)
+                return entry[1]
+            TomlParseCache.misses += 1
+        with open(path_to_toml, "r") as f:
+            text = f.read()
+        tables = TomlParseCache.freeze(TomlParseCache.parse(text))
+        with TomlParseCache._lock:
+            TomlParseCache._entries[path_to_toml] = (stat_key, tables)
+            TomlParseCache._entries.move_to_end(path_to_toml)
+            while len(TomlParseCache._entries) > TomlParseCache.max_entries:
+                TomlParseCache._entries.popitem(last=False)
+        return tables
+
+    @staticmethod
+    def invalidate(path_to_toml=None):
+        """
+        Forgets path_to_toml, or every file if it's None
+
+        :param path_to_toml:  (Default value = None)
+
+        """
+        with TomlParseCache._lock:
+            if path_to_toml is None:
+                TomlParseCache._entries.clear()
+            else:
+                TomlParseCache._entries.pop(Path(path_to_toml).resolve(), None)
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """ """
+        with TomlParseCache._lock:
+            return {
+                "hits": TomlParseCache.hits,
+                "misses": TomlParseCache.misses,
+                "entries": len(TomlParseCache._entries),
+            }
+
+    @staticmethod
+    def reset_stats():
+        """ """
+        with TomlParseCache._lock:
+            TomlParseCache.hits = 0
+            TomlParseCache.misses = 0
+
+
+class PoetryLockPackage(NamedTuple):
+    """
+    A package pinned in a poetry.lock; files are ({"file": ..., "hash": "sha256:..."}, ...) and source is the lock's
+    source table (i.e. {"type": "legacy", "url": ...}) or None for PyPI
+    """
+
+    name: str
+    version: str
+    python_versions: str
+    markers: Any
+    hashes: tuple
+    files: tuple
+    source: Any
+    optional: bool
+
+
+class PoetryLockIndex:
+    """
+    Process wide index of poetry.lock files, keyed on (path, mtime, size) like TomlParseCache.
+
+    Packages are indexed by their PEP 503 normalized name, so versions, hashes and markers can be looked up without
+    starting poetry. Both lock layouts are understood: per package `files` (poetry>=1.2) and `[metadata.files]`.
+    """
+
+    max_entries: int = 64
+    hits: int = 0
+    misses: int = 0
+    _indexes = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def find_poetry_lock(path: str) -> Union[Path, None]:
+        """
+        Returns the poetry.lock of the project path belongs to, or None if that project isn't locked
+
+        The project is the nearest directory with a pyproject.toml, so a nested project without a lock never picks up
+        the poetry.lock of an enclosing one.
+
+        :param path:
+        :type path: str
+        :rtype: Union[Path, None]
+
+        """
+        project_root = ProjectRootResolver.resolve(path)
+        if project_root is None:
+            return None
+        poetry_lock_path = project_root.joinpath("poetry.lock")
+        return poetry_lock_path if poetry_lock_path.is_file() else None
+
+    @staticmethod
+    def build_index(tables: Mapping) -> Dict[str, PoetryLockPackage]:
+        """
+        Indexes the [[package]] tables of a parsed poetry.lock by normalized name
+
+        :param tables: as returned by TomlParseCache.parse
+        :type tables: Mapping
+        :rtype: Dict[str, PoetryLockPackage]
+
+        """
+        metadata_files = {
+            PyprojectTomlEditor.canonicalize_name(name): files
+            for name, files in tables.get("metadata.files", {}).items()
+        }
+        index = {}
+        for package in tables.get("package", ()):
+            canonical_name = PyprojectTomlEditor.canonicalize_name(package["name"])
+            files = package.get("files") or metadata_files.get(canonical_name, ())
+            files = tuple(MappingProxyType(dict(f)) for f in files)
+            index[canonical_name] = PoetryLockPackage(
+                name=package["name"],
+                version=package["version"],
+                python_versions=package.get("python-versions", "*"),
+                markers=package.get("markers", ""),
+                hashes=tuple(f["hash"] for f in files if f.get("hash")),
+                files=files,
+                source=MappingProxyType(dict(package["source"])) if package.get("source") else None,
+                optional=bool(package.get("optional", False)),
+            )
+        return index
+
+    @staticmethod
+    def load(poetry_lock_path) -> Mapping:
+        """
+        Returns the read-only index of poetry_lock_path, parsing it only if it changed since it was last read
+
+        :param poetry_lock_path:
+        :rtype: Mapping
+
+        """
+        poetry_lock_path = Path(poetry_lock_path).resolve()
+        stat_key = TomlParseCache.get_stat_key(poetry_lock_path)
+        with PoetryLockIndex._lock:
+            entry = PoetryLockIndex._indexes.get(poetry_lock_path)
+            if entry is not None and entry[0] == stat_key:
+                PoetryLockIndex.hits += 1
+                PoetryLockIndex._indexes.move_to_end(poetry_lock_path)
+                return entry[1]
+            PoetryLockIndex.misses += 1
+        with open(poetry_lock_path, "r") as f:
+            tables = TomlParseCache.parse(f.read())
+        index = MappingProxyType(PoetryLockIndex.build_index(tables))
+        with PoetryLockIndex._lock:
+            PoetryLockIndex._indexes[poetry_lock_path] = (stat_key, index)
+            PoetryLockIndex._indexes.move_to_end(poetry_lock_path)
+            while len(PoetryLockIndex._indexes) > PoetryLockIndex.max_entries:
+                PoetryLockIndex._indexes.popitem(last=False)
+        return index
+
+    @staticmethod
+    def get(poetry_lock_path, name: str) -> Union[PoetryLockPackage, None]:
+        """
+        Returns the locked package called name (in any spelling), or None
+
+        :param poetry_lock_path:
+        :param name:
+        :type name: str
+        :rtype: Union[PoetryLockPackage, None]
+
+        """
+        return PoetryLockIndex.load(poetry_lock_path).get(PyprojectTomlEditor.canonicalize_name(name))
+
+    @staticmethod
+    def get_version(poetry_lock_path, name: str) -> str:
+        """
+        Returns the locked version of name, or "" if it isn't locked
+
+        :param poetry_lock_path:
+        :param name:
+        :type name: str
+        :rtype: str
+
+        """
+        package = PoetryLockIndex.get(poetry_lock_path, name)
+        return "" if package is None else package.version
+
+    @staticmethod
+    def invalidate(poetry_lock_path=None):
+        """
+        Forgets poetry_lock_path, or every lock if it's None
+
+        :param poetry_lock_path:  (Default value = None)
+
+        """
+        with PoetryLockIndex._lock:
+            if poetry_lock_path is None:
+                PoetryLockIndex._indexes.clear()
+            else:
+                PoetryLockIndex._indexes.pop(Path(poetry_lock_path).resolve(), None)
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """ """
+        with PoetryLockIndex._lock:
+            return {
+                "hits": PoetryLockIndex.hits,
+                "misses": PoetryLockIndex.misses,
+                "entries": len(PoetryLockIndex._indexes),
+            }
+
+    @staticmethod
+    def reset_stats():
+        """ """
+        with PoetryLockIndex._lock:
+            PoetryLockIndex.hits = 0
+            PoetryLockIndex.misses = 0
+
+
+class HydrationReport(NamedTuple):
+    """
+    Outcome of LockHydrator.hydrate; skipped packages (git, path and url dependencies, or locks without hashes) are
+    left for `poetry install`
+    """
+
+    rc: int
+    installed: List[str]
+    skipped: List[str]
+    failed: List[str]
+    duration: float
+
+
+class LockHydrator:
+    """
+    Installs the packages pinned in a poetry.lock into a conda env without poetry's serial installer.
+
+    Every locked artifact is downloaded concurrently (`pip download --no-deps --require-hashes`) into a wheelhouse shared
+    by every project, then everything is installed by a single `pip install --no-deps --no-index --require-hashes`, so
+    nothing is resolved and every file is checked against the lock's hashes. Markers are evaluated against the env's
+    python version and optional packages are only installed for the requested extras, like `poetry install` does.
+    Packages locked without a wheel are skipped, since building an sdist needs its build requirements from an index.
+    """
+
+    max_workers: int = 8
+    unhashable_source_types = ("git", "directory", "file", "url")
+
+    @staticmethod
+    def get_wheelhouse() -> Path:
+        """ """
+        return CondaSearchCache.get_cache_dir().joinpath("wheelhouse")
+
+    @staticmethod
+    def get_marker_environment(python_version: str) -> Dict[str, str]:
+        """
+        Returns the marker variables that differ between this process and an env running python_version
+
+        :param python_version: i.e. "3.10.12"
+        :type python_version: str
+        :rtype: Dict[str, str]
+
+        """
+        if not python_version:
+            return {}
+        return {"python_version": ".".join(python_version.split(".")[:2]), "python_full_version": python_version}
+
+    @staticmethod
+    def has_wheel(package: PoetryLockPackage) -> bool:
+        """
+        Returns True if poetry.lock lists a wheel for package, i.e. it isn't only available as an sdist
+
+        :param package:
+        :type package: PoetryLockPackage
+        :rtype: bool
+
+        """
+        return any(str(f.get("file", "")).endswith(".whl") for f in package.files if isinstance(f, Mapping))
+
+    @staticmethod
+    def select_packages(poetry_lock_path, python_version: str = "", extras: List[str] = None):
+        """
+        Splits the locked packages that apply to the env into (hashed wheels pip can install, skipped packages)
+
+        :param poetry_lock_path:
+        :param python_version: python version of the env markers are evaluated for  (Default value = "")
+        :type python_version: str
+        :param extras: extras of the project to install optional packages for  (Default value = None)
+        :type extras: List[str]
+
+        """
+        index = PoetryLockIndex.load(poetry_lock_path)
+        extra_tables = TomlParseCache.get_tables(poetry_lock_path).get("extras", {})
+        wanted_optional = {
+            PyprojectTomlEditor.canonicalize_name(re.split(r"[\s\[(;<>=!~]", n, maxsplit=1)[0])
+            for extra in (extras or [])
+            for n in extra_tables.get(extra, ())
+        }
+        try:
+            Marker = import_optional_dependency("Marker")
+        except ImportError:
+            Marker = None
+            print("packaging isn't installed, locked packages with markers are left to `poetry install`")
+        environment = LockHydrator.get_marker_environment(python_version)
+        hashed, skipped = [], []
+        for canonical_name, package in index.items():
+            if package.optional and canonical_name not in wanted_optional:
+                continue
+            if isinstance(package.markers, str) and package.markers:
+                if Marker is None:
+                    skipped.append(package)
+                    continue
+                if not Marker(package.markers).evaluate(environment):
+                    continue
+            source_type = package.source.get("type", "") if package.source else ""
+            if (source_type in LockHydrator.unhashable_source_types) or not package.hashes:
+                skipped.append(package)
+            elif not LockHydrator.has_wheel(package):
+                # `pip install --no-index` couldn't fetch the build requirements, `poetry install` builds these
+                skipped.append(package)
+            else:
+                hashed.append(package)
+        return hashed, skipped
+
+    @staticmethod
+    def get_requirement_line(package: PoetryLockPackage) -> str:
+        """
+        Returns the hash-checked requirements.txt line of package
+
+        :param package:
+        :type package: PoetryLockPackage
+        :rtype: str
+
+        """
+        hashes = " ".join(f"--hash={h}" for h in package.hashes)
+        return f"{package.name}=={package.version} {hashes}"
+
+    @staticmethod
+    def get_index_args(package: PoetryLockPackage) -> List[str]:
+        """
+        Returns the pip flags that point at the private repository package was locked from, if any
+
+        :param package:
+        :type package: PoetryLockPackage
+        :rtype: List[str]
+
+        """
+        if package.source and package.source.get("type") == "legacy" and package.source.get("url"):
+            return ["--index-url", package.source["url"]]
+        return []
+
+    @staticmethod
+    def write_requirements(packages: List[PoetryLockPackage], requirements_dir: str) -> str:
+        """
+        Writes the requirements file of packages to requirements_dir
+
+        :param packages:
+        :type packages: List[PoetryLockPackage]
+        :param requirements_dir:
+        :type requirements_dir: str
+        :rtype: str
+
+        """
+        fd, requirements_path = tempfile.mkstemp(suffix=".txt", dir=requirements_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(LockHydrator.get_requirement_line(p) for p in packages) + "\n")
+        return requirements_path
+
+    @staticmethod
+    def download(env_python: str, package: PoetryLockPackage, wheelhouse: Path, requirements_dir: str,
+                 sinks: List[OutputSink] = None) -> CommandResult:
+        """
+        Downloads the artifact of package the env can install into wheelhouse, checking its hash
+
+        :param env_python:
+        :type env_python: str
+        :param package:
+        :type package: PoetryLockPackage
+        :param wheelhouse:
+        :type wheelhouse: Path
+        :param requirements_dir:
+        :type requirements_dir: str
+        :param sinks:  (Default value = None)
+        :type sinks: List[OutputSink]
+        :rtype: CommandResult
+
+        """
+        requirements_path = LockHydrator.write_requirements([package], requirements_dir)
+        cmd_args = [
+            env_python, "-m", "pip", "download", "--no-deps", "--require-hashes", "--disable-pip-version-check",
+            "-d", wheelhouse.as_posix(), "-r", requirements_path, *LockHydrator.get_index_args(package),
+        ]
+        return CommonPSCommands.stream_command(cmd_args, sinks=sinks, close_sinks=False)
+
+    @staticmethod
+    def hydrate(env_name: str, poetry_lock_path, extras: List[str] = None, max_workers: int = None,
+                sinks: List[OutputSink] = None) -> HydrationReport:
+        """
+        Downloads every locked package that applies to env_name concurrently and installs them in one pip call
+
+        :param env_name:
+        :type env_name: str
+        :param poetry_lock_path:
+        :param extras:  (Default value = None)
+        :type extras: List[str]
+        :param max_workers: concurrent downloads  (Default value = None) defaults to LockHydrator.max_workers
+        :type max_workers: int
+        :param sinks: receive the output of pip  (Default value = None)
+        :type sinks: List[OutputSink]
+        :rtype: HydrationReport
+
+        """
+        start = time.time()
+        record = CondaEnvIndex.lookup(env_name)
+        assert record is not None, f"Unable to find conda env {env_name!r}"
+        env_python = KernelSpecInstaller.get_env_python(record.prefix)
+        packages, skipped = LockHydrator.select_packages(poetry_lock_path, record.python_version, extras=extras)
+        skipped_names = [p.name for p in skipped]
+        if not packages:
+            return HydrationReport(0, [], skipped_names, [], time.time() - start)
+        wheelhouse = LockHydrator.get_wheelhouse()
+        wheelhouse.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix="lock-hydration-") as requirements_dir:
+            with ThreadPoolExecutor(max_workers=max_workers or LockHydrator.max_workers) as pool:
+                results = list(
+                    pool.map(lambda p: LockHydrator.download(env_python, p, wheelhouse, requirements_dir, sinks),
+                             packages)
+                )
+            failed = [p.name for p, result in zip(packages, results) if result.rc != 0]
+            if failed:
+                print(f"Unable to download {failed}")
+                return HydrationReport(1, [], skipped_names, failed, time.time() - start)
+            requirements_path = LockHydrator.write_requirements(packages, requirements_dir)
+            cmd_args = [
+                env_python, "-m", "pip", "install", "--no-deps", "--no-index", "--require-hashes",
+                "--disable-pip-version-check", "--find-links", wheelhouse.as_posix(), "-r", requirements_path,
+            ]
+            result = CommonPSCommands.stream_command(cmd_args, sinks=sinks, close_sinks=False)
+        installed = [p.name for p in packages] if result.rc == 0 else []
+        failed = [] if result.rc == 0 else [p.name for p in packages]
+        return HydrationReport(result.rc, installed, skipped_names, failed, time.time() - start)
+
+
+class PoetryLockCache:
+    """
+    Content addressed cache of poetry.lock files, stored under $XDG_CACHE_HOME/project_manager/locks.
+
+    The key hashes the dependency tables (main, dev and groups), python constraint, sources and extras of a
+    pyproject.toml after normalizing names and pins, so projects declaring the same dependencies (in any order or
+    spelling) share a resolution. A hit is dropped in with the project's own content-hash, so poetry accepts it as up to
+    date. The store is bounded by max_entries and max_bytes, evicting the least recently used locks.
+
+    Path dependencies are keyed on their resolved location and a hash of their metadata files, so editing a local
+    package's dependencies misses the cache. Projects with develop path dependencies or git dependencies that don't
+    pin a rev or tag aren't cached at all, since those can resolve differently without pyproject.toml changing.
+    """
+
+    max_entries: int = 256
+    max_bytes: int = 64 * 1024 * 1024
+    hits = 0
+    misses = 0
+    stores = 0
+    evictions = 0
+    _lock = threading.Lock()
+    _content_hash_pattern = re.compile(r'^content-hash\s*=\s*"[0-9a-f]*"\s*$', re.MULTILINE)
+    _metadata_file_names = ("pyproject.toml", "setup.cfg", "setup.py")
+
+    @staticmethod
+    def get_cache_dir() -> Path:
+        """ """
+        return CondaSearchCache.get_cache_dir().joinpath("locks")
+
+    @staticmethod
+    def thaw(value):
+        """
+        Turns the read-only views of TomlParseCache back into dicts and lists
+
+        :param value:
+
+        """
+        if isinstance(value, Mapping):
+            return {k: PoetryLockCache.thaw(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [PoetryLockCache.thaw(v) for v in value]
+        return value
+
+    @staticmethod
+    def get_poetry_config(pyproject_toml_path) -> Dict[str, Any]:
+        """
+        Returns the [tool.poetry] table of pyproject_toml_path as plain dicts
+
+        :param pyproject_toml_path:
+        :rtype: Dict[str, Any]
+
+        """
+        tables = CommonPSCommands.read_toml(pyproject_toml_path, start_line="")
+        return PoetryLockCache.thaw(tables.get("tool.poetry", {}))
+
+    @staticmethod
+    def get_content_hash(poetry_config: Dict[str, Any]) -> str:
+        """
+        Returns the content-hash poetry (1.2+) writes to poetry.lock for a [tool.poetry] table, computed like
+        Locker._get_content_hash: the legacy keys are always hashed (as null when missing), "group" only when present
+
+        :param poetry_config:
+        :type poetry_config: Dict[str, Any]
+        :rtype: str
+
+        """
+        legacy_keys = ("dependencies", "source", "extras", "dev-dependencies")
+        relevant_content = {key: poetry_config.get(key) for key in legacy_keys}
+        if poetry_config.get("group") is not None:
+            relevant_content["group"] = poetry_config["group"]
+        return hashlib.sha256(json.dumps(relevant_content, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def normalize_dependencies(dependencies) -> List[List[Any]]:
+        """
+        Returns a dependency table as sorted [normalized name, normalized pin] pairs
+
+        :param dependencies:
+
+        """
+        return sorted(
+            [PyprojectTomlEditor.canonicalize_name(name), DependencySyncPlanner.normalize_constraint(val)]
+            for name, val in (dependencies or {}).items()
+        )
+
+    @staticmethod
+    def get_local_dependencies(
+            dependency_tables: List[Dict[str, Any]], project_dir: Path
+    ) -> Union[List[List[str]], None]:
+        """
+        Returns [name, resolved path, hash of its metadata] of every path dependency in dependency_tables, or None if
+        one of them can change without pyproject.toml changing (a develop or missing path, a git dependency without a
+        rev or tag)
+
+        :param dependency_tables:
+        :type dependency_tables: List[Dict[str, Any]]
+        :param project_dir: directory relative paths are resolved against
+        :type project_dir: Path
+        :rtype: Union[List[List[str]], None]
+
+        """
+        local_dependencies = []
+        for dependencies in dependency_tables:
+            for name, val in (dependencies or {}).items():
+                for constraint in val if isinstance(val, list) else [val]:
+                    if not isinstance(constraint, Mapping):
+                        continue
+                    if constraint.get("git") and not (constraint.get("rev") or constraint.get("tag")):
+                        return None
+                    if not constraint.get("path"):
+                        continue
+                    if constraint.get("develop"):
+                        return None
+                    path = Path(project_dir).joinpath(constraint["path"]).resolve()
+                    if path.is_dir():
+                        metadata_paths = [path.joinpath(n) for n in PoetryLockCache._metadata_file_names]
+                    else:
+                        metadata_paths = [path]
+                    metadata_paths = [p for p in metadata_paths if p.is_file()]
+                    if not metadata_paths:
+                        return None
+                    metadata_hash = hashlib.sha256()
+                    for metadata_path in metadata_paths:
+                        metadata_hash.update(metadata_path.name.encode())
+                        metadata_hash.update(metadata_path.read_bytes())
+                    local_dependencies.append(
+                        [PyprojectTomlEditor.canonicalize_name(name), path.as_posix(), metadata_hash.hexdigest()]
+                    )
+        return sorted(local_dependencies)
+
+    @staticmethod
+    def get_key(pyproject_toml_path) -> Union[str, None]:
+        """
+        Hashes the resolution inputs of pyproject_toml_path, returns None if the project can't be cached (see
+        get_local_dependencies)
+
+        :param pyproject_toml_path:
+        :rtype: Union[str, None]
+
+        """
+        poetry_config = PoetryLockCache.get_poetry_config(pyproject_toml_path)
+        dependencies = dict(poetry_config.get("dependencies", {}))
+        python_constraint = DependencySyncPlanner.normalize_constraint(dependencies.pop("python", ""))
+        groups = {"dev": poetry_config.get("dev-dependencies", {})}
+        for group_name, group in poetry_config.get("group", {}).items():
+            groups[group_name] = {**groups.get(group_name, {}), **group.get("dependencies", {})}
+        local_dependencies = PoetryLockCache.get_local_dependencies(
+            [dependencies, *groups.values()], Path(pyproject_toml_path).parent
+        )
+        if local_dependencies is None:
+            return None
+        key_parts = {
+            "local": local_dependencies,
+            "python": python_constraint,
+            "dependencies": PoetryLockCache.normalize_dependencies(dependencies),
+            "groups": {g: PoetryLockCache.normalize_dependencies(d) for g, d in groups.items() if d},
+            "sources": sorted(
+                [s.get("name", ""), s.get("url", ""), str(s.get("priority", s.get("default", "")))]
+                for s in poetry_config.get("source", [])
+            ),
+            "extras": {
+                e: sorted(PyprojectTomlEditor.canonicalize_name(n) for n in names)
+                for e, names in poetry_config.get("extras", {}).items()
+            },
+        }
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def get_entry_path(key: str) -> Path:
+        """ """
+        return PoetryLockCache.get_cache_dir().joinpath(f"{key}.lock")
+
+    @staticmethod
+    def count(stat: str, amount: int = 1):
+        """ """
+        with PoetryLockCache._lock:
+            setattr(PoetryLockCache, stat, getattr(PoetryLockCache, stat) + amount)
+
+    @staticmethod
+    def lookup(key: str) -> Union[Path, None]:
+        """
+        Returns the poetry.lock stored under key (marking it as recently used), or None on a miss
+
+        :param key:
+        :type key: str
+        :rtype: Union[Path, None]
+
+        """
+        entry_path = PoetryLockCache.get_entry_path(key)
+        try:
+            os.utime(entry_path)
+        except OSError:
+            PoetryLockCache.count("misses")
+            return None
+        PoetryLockCache.count("hits")
+        return entry_path
+
+    @staticmethod
+    def restore(entry_path: Path, dir_containing_pyproject_toml: str) -> Path:
+        """
+        Atomically writes a cached lock as the poetry.lock of dir_containing_pyproject_toml, with its content-hash
+
+        :param entry_path:
+        :type entry_path: Path
+        :param dir_containing_pyproject_toml:
+        :type dir_containing_pyproject_toml: str
+        :rtype: Path
+
+        """
+        pyproject_toml_path = Path(dir_containing_pyproject_toml).joinpath("pyproject.toml")
+        content_hash = PoetryLockCache.get_content_hash(PoetryLockCache.get_poetry_config(pyproject_toml_path))
+        lock_text = PoetryLockCache._content_hash_pattern.sub(
+            f'content-hash = "{content_hash}"', entry_path.read_text()
+        )
+        poetry_lock_path = pyproject_toml_path.with_name("poetry.lock")
+        tmp_path = poetry_lock_path.with_name(f"poetry.lock.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(lock_text)
+        os.replace(tmp_path, poetry_lock_path)
+        return poetry_lock_path
+
+    @staticmethod
+    def store(key: str, poetry_lock_path) -> Path:
+        """
+        Atomically stores poetry_lock_path under key and evicts the least recently used entries over the bounds
+
+        :param key:
+        :type key: str
+        :param poetry_lock_path:
+        :rtype: Path
+
+        """
+        lock_text = Path(poetry_lock_path).read_text()
+        TomlParseCache.parse(lock_text)  # never store a truncated or otherwise broken lock
+        entry_path = PoetryLockCache.get_entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = entry_path.with_name(f"{entry_path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(lock_text)
+        os.replace(tmp_path, entry_path)
+        PoetryLockCache.count("stores")
+        PoetryLockCache.evict()
+        return entry_path
+
+    @staticmethod
+    def get_entries() -> List[tuple]:
+        """
+        Returns (path, stat) of every entry, least recently used first
+
+        :rtype: List[tuple]
+
+        """
+        entries = []
+        for entry_path in PoetryLockCache.get_cache_dir().glob("*.lock"):
+            try:
+                entries.append((entry_path, entry_path.stat()))
+            except OSError:
+                continue
+        return sorted(entries, key=lambda e: e[1].st_mtime)
+
+    @staticmethod
+    def evict(max_entries: int = None, max_bytes: int = None) -> int:
+        """
+        Removes the least recently used entries until the store is within max_entries and max_bytes
+
+        :param max_entries:  (Default value = None) defaults to PoetryLockCache.max_entries
+        :type max_entries: int
+        :param max_bytes:  (Default value = None) defaults to PoetryLockCache.max_bytes
+        :type max_bytes: int
+        :returns: the number of entries removed
+        :rtype: int
+
+        """
+        max_entries = PoetryLockCache.max_entries if max_entries is None else max_entries
+        max_bytes = PoetryLockCache.max_bytes if max_bytes is None else max_bytes
+        entries = PoetryLockCache.get_entries()
+        total_bytes = sum(stat.st_size for _, stat in entries)
+        removed = 0
+        for entry_path, stat in entries:
+            if (len(entries) - removed <= max_entries) and (total_bytes <= max_bytes):
+                break
+            entry_path.unlink(missing_ok=True)
+            total_bytes -= stat.st_size
+            removed += 1
+        PoetryLockCache.count("evictions", removed)
+        return removed
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """ """
+        entries = PoetryLockCache.get_entries()
+        with PoetryLockCache._lock:
+            return {
+                "hits": PoetryLockCache.hits,
+                "misses": PoetryLockCache.misses,
+                "stores": PoetryLockCache.stores,
+                "evictions": PoetryLockCache.evictions,
+                "entries": len(entries),
+                "bytes": sum(stat.st_size for _, stat in entries),
+            }
+
+    @staticmethod
+    def reset_stats():
+        """ """
+        with PoetryLockCache._lock:
+            PoetryLockCache.hits = PoetryLockCache.misses = PoetryLockCache.stores = PoetryLockCache.evictions = 0
+
+
+class CondaDiscoveryCache:
+    """
+    Memoizes conda discovery (conda base, conda.sh and activation strs) for the lifetime of the process.
+
+    Values are keyed on CONDA_EXE and PATH, so switching to another conda installation misses the cache instead of
+    returning stale paths. Empty values are never cached.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    _values = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_key():
+        """ """
+        return os.environ.get("CONDA_EXE", ""), os.environ.get("PATH", "")
+
+    @staticmethod
+    def get_or_compute(name, compute: Callable[[], Any]):
+        """
+        Returns the memoized value for name or computes (and stores) it
+
+        :param name: hashable name of the value (i.e. "conda_base" or ("activate_str", env_name))
+        :param compute:
+        :type compute: Callable[[], Any]
+
+        """
+        key = (name, CondaDiscoveryCache.get_key())
+        with CondaDiscoveryCache._lock:
+            if key in CondaDiscoveryCache._values:
+                CondaDiscoveryCache.hits += 1
+                return CondaDiscoveryCache._values[key]
+            CondaDiscoveryCache.misses += 1
+        value = compute()
+        if value:
+            with CondaDiscoveryCache._lock:
+                CondaDiscoveryCache._values[key] = value
+        return value
+
+    @staticmethod
+    def invalidate(name=None):
+        """
+        Forgets name (for every CONDA_EXE/PATH), or everything if name is None
+
+        :param name:  (Default value = None)
+
+        """
+        with CondaDiscoveryCache._lock:
+            if name is None:
+                CondaDiscoveryCache._values.clear()
+            else:
+                for key in [k for k in CondaDiscoveryCache._values if k[0] == name]:
+                    del CondaDiscoveryCache._values[key]
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """ """
+        with CondaDiscoveryCache._lock:
+            return {
+                "hits": CondaDiscoveryCache.hits,
+                "misses": CondaDiscoveryCache.misses,
+                "entries": len(CondaDiscoveryCache._values),
+            }
+
+    @staticmethod
+    def reset_stats():
+        """ """
+        with CondaDiscoveryCache._lock:
+            CondaDiscoveryCache.hits = 0
+            CondaDiscoveryCache.misses = 0
+
+
+class CondaShellSession:
+    """
+    A long-lived bash process that already sourced conda.sh and activated one conda env.
+
+    Commands are written to its stdin, each in its own subshell, followed by a sentinel line carrying the return
+    code, so running a command in the env costs a fork instead of a new shell plus a conda activation.
+    """
+
+    def __init__(self, env_name: str, act_env_str: str = None):
+        if act_env_str is None:
+            act_env_str = CondaEnvManager.activate_conda_env(env_name, return_cmd=True)
+        self.env_name = env_name
+        self.act_env_str = act_env_str
+        self.sentinel = f"__project_manager_rc_{uuid.uuid4().hex}__".encode()
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.p = subprocess.Popen(
+            [shutil.which("bash") or "/bin/bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+        rc = self.send(act_env_str, []).rc
+        if rc != 0:
+            self.close()
+            raise RuntimeError(f"Unable to activate {env_name!r} in a shell session (rc={rc})")
+
+    def is_alive(self) -> bool:
+        """ """
+        return self.p.poll() is None
+
+    def send(self, script: str, sinks: List[OutputSink]) -> CommandResult:
+        """
+        Writes script to the shell followed by the sentinel and streams output until the sentinel comes back
+
+        :param script:
+        :type script: str
+        :param sinks:
+        :type sinks: List[OutputSink]
+        :rtype: CommandResult
+
+        """
+        start = time.perf_counter()
+        sentinel = self.sentinel.decode()
+        self.p.stdin.write(f"{script}\nprintf '%s %d\\n' '{sentinel}' \"$?\"\n".encode())
+        self.p.stdin.flush()
+        n_bytes = 0
+        partial_line = b""
+        rc = None
+        while rc is None:
+            chunk = os.read(self.p.stdout.fileno(), 65536)
+            if not chunk:
+                self.close()
+                raise RuntimeError(f"The shell session for {self.env_name!r} exited unexpectedly")
+            *complete_lines, partial_line = (partial_line + chunk).split(b"\n")
+            for raw_line in complete_lines:
+                sentinel_idx = raw_line.find(self.sentinel)
+                if sentinel_idx == -1:
+                    n_bytes += len(raw_line) + 1
+                    CommonPSCommands.dispatch_line(sinks, "stdout", raw_line)
+                    continue
+                if sentinel_idx:  # output that didn't end with a new line
+                    n_bytes += sentinel_idx
+                    CommonPSCommands.dispatch_line(sinks, "stdout", raw_line[:sentinel_idx])
+                rc = int(raw_line[sentinel_idx + len(self.sentinel):])
+        self.last_used = time.monotonic()
+        return CommandResult(rc, time.perf_counter() - start, n_bytes, 0, script)
+
+    def run(self, cmds: Union[List[str], str], cwd: str = None, sinks: List[OutputSink] = None) -> CommandResult:
+        """
+        Runs cmds (chained with &&) in a subshell of the activated shell, so exits, cds and exports can't leak into
+        the session. stderr is merged into stdout.
+
+        :param cmds:
+        :type cmds: Union[List[str], str]
+        :param cwd:  (Default value = None)
+        :type cwd: str
+        :param sinks:  (Default value = None)
+        :type sinks: List[OutputSink]
+        :rtype: CommandResult
+
+        """
+        if isinstance(cmds, str):
+            cmds = [cmds]
+        cmd = " && ".join(cmds)
+        if cwd is not None:
+            cmd = f"cd {shlex.quote(Path(cwd).as_posix())} && {cmd}"
+        sinks = list(sinks or [])
+        try:
+            with self.lock:
+                result = self.send(f"( {cmd}\n) < /dev/null", sinks)
+        finally:
+            for sink in sinks:
+                sink.close()
+        return result._replace(cmd_args=cmds)
+
+    def close(self):
+        """ """
+        if self.is_alive():
+            try:
+                self.p.stdin.close()
+                self.p.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.p.kill()
+                self.p.wait()
+        for pipe in (self.p.stdin, self.p.stdout):
+            if not pipe.closed:
+                pipe.close()
+
+
+class CondaShellSessionPool:
+    """
+    Keeps at most max_sessions pre-activated CondaShellSessions (one per conda env).
+
+    The least recently used session is evicted when the pool is full, and sessions idle for longer than idle_ttl
+    seconds are closed the next time the pool is used. Sessions handed out by acquire stay checked out until release is
+    called and are never evicted in the meantime.
+    """
+
+    max_sessions: int = 4
+    idle_ttl: float = 600.0
+    _sessions = OrderedDict()
+    _checkouts = defaultdict(int)
+    _lock = threading.Lock()
+
+    @staticmethod
+    def is_supported() -> bool:
+        """ """
+        return (platform.system() != "Windows") and (shutil.which("bash") is not None)
+
+    @staticmethod
+    def evict_idle():
+        """ """
+        with CondaShellSessionPool._lock:
+            CondaShellSessionPool._evict_idle_locked()
+
+    @staticmethod
+    def _evict_idle_locked():
+        now = time.monotonic()
+        for env_name, session in list(CondaShellSessionPool._sessions.items()):
+            if CondaShellSessionPool._checkouts.get(env_name):
+                continue
+            expired = (now - session.last_used) > CondaShellSessionPool.idle_ttl
+            if (expired or not session.is_alive()) and session.lock.acquire(blocking=False):
+                try:
+                    session.close()
+                finally:
+                    session.lock.release()
+                del CondaShellSessionPool._sessions[env_name]
+
+    @staticmethod
+    def _pop_lru_locked() -> List[CondaShellSession]:
+        sessions = CondaShellSessionPool._sessions
+        evicted = []
+        for lru_env_name in list(sessions):
+            if len(sessions) <= CondaShellSessionPool.max_sessions:
+                break
+            if not CondaShellSessionPool._checkouts.get(lru_env_name):
+                evicted.append(sessions.pop(lru_env_name))
+        return evicted
+
+    @staticmethod
+    def _close_sessions(sessions: List[CondaShellSession]):
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+    @staticmethod
+    def acquire(env_name: str, act_env_str: str = None) -> CondaShellSession:
+        """
+        Checks out the live session for env_name, starting one if needed. Every acquire must be paired with a release.
+
+        :param env_name:
+        :type env_name: str
+        :param act_env_str:  (Default value = None)
+        :type act_env_str: str
+        :rtype: CondaShellSession
+
+        """
+        with CondaShellSessionPool._lock:
+            CondaShellSessionPool._evict_idle_locked()
+            session = CondaShellSessionPool._sessions.get(env_name)
+            if session is not None:
+                CondaShellSessionPool._sessions.move_to_end(env_name)
+                CondaShellSessionPool._checkouts[env_name] += 1
+                return session
+        # starting bash and activating the env takes a while, so other envs' sessions stay usable meanwhile
+        new_session = CondaShellSession(env_name, act_env_str=act_env_str)
+        with CondaShellSessionPool._lock:
+            session = CondaShellSessionPool._sessions.get(env_name)
+            if session is None:
+                session = CondaShellSessionPool._sessions[env_name] = new_session
+                new_session = None
+            CondaShellSessionPool._sessions.move_to_end(env_name)
+            CondaShellSessionPool._checkouts[env_name] += 1
+            evicted = CondaShellSessionPool._pop_lru_locked()
+        if new_session is not None:
+            # another thread started a session for env_name first
+            evicted.append(new_session)
+        CondaShellSessionPool._close_sessions(evicted)
+        return session
+
+    @staticmethod
+    def release(env_name: str):
+        """
+        Checks a session acquired for env_name back in, evicting sessions the pool kept past max_sessions
+
+        :param env_name:
+        :type env_name: str
+
+        """
+        with CondaShellSessionPool._lock:
+            checkouts = CondaShellSessionPool._checkouts
+            checkouts[env_name] -= 1
+            if checkouts[env_name] <= 0:
+                del checkouts[env_name]
+            evicted = CondaShellSessionPool._pop_lru_locked()
+        CondaShellSessionPool._close_sessions(evicted)
+
+    @staticmethod
+    def run(
+            env_name: str,
+            cmds: Union[List[str], str],
+            act_env_str: str = None,
+            cwd: str = None,
+            sinks: List[OutputSink] = None,
+    ) -> CommandResult:
+        """
+        Runs cmds in the pre-activated session of env_name
+
+        :param env_name:
+        :type env_name: str
+        :param cmds:
+        :type cmds: Union[List[str], str]
+        :param act_env_str:  (Default value = None)
+        :type act_env_str: str
+        :param cwd:  (Default value = None)
+        :type cwd: str
+        :param sinks:  (Default value = None)
+        :type sinks: List[OutputSink]
+        :rtype: CommandResult
+
+        """
+        session = CondaShellSessionPool.acquire(env_name, act_env_str=act_env_str)
+        try:
+            return session.run(cmds, cwd=cwd, sinks=sinks)
+        finally:
+            CondaShellSessionPool.release(env_name)
+
+    @staticmethod
+    def close_all():
+        """ """
+        with CondaShellSessionPool._lock:
+            while CondaShellSessionPool._sessions:
+                _, session = CondaShellSessionPool._sessions.popitem()
+                with session.lock:
+                    session.close()
+            CondaShellSessionPool._checkouts.clear()
+
+
+atexit.register(CondaShellSessionPool.close_all)
+
+
+class CondaActivationCache:
+    """
+    Caches the environment variables that `conda activate <env>` changes (PATH, CONDA_PREFIX, ...), so commands can
+    run in an env with shell=False and without sourcing conda.sh.
+
+    A delta is captured once per env and recaptured when <env prefix>/conda-meta/history changes (i.e. after packages
+    that ship activation scripts were installed or removed).
+    """
+
+    _deltas = {}
+    _lock = threading.Lock()
+    _shell_vars = {"_", "SHLVL", "PWD", "OLDPWD", "PS1"}
+
+    @staticmethod
+    def get_history_stamp(env_prefix: str):
+        """
+        Returns (mtime_ns, size) of conda-meta/history for env_prefix, or None if it doesn't exist
+
+        :param env_prefix:
+        :type env_prefix: str
+
+        """
+        try:
+            st = os.stat(Path(env_prefix).joinpath("conda-meta", "history"))
+        except (OSError, TypeError):
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def capture_activation_delta(env_name: str, act_env_str: str = None) -> Dict[str, Union[str, None]]:
+        """
+        Activates env_name once in a shell and returns the variables it set or changed (removed variables map to None)
+
+        :param env_name:
+        :type env_name: str
+        :param act_env_str:  (Default value = None)
+        :type act_env_str: str
+        :rtype: Dict[str, Union[str, None]]
+
+        """
+        if act_env_str is None:
+            act_env_str = CondaEnvManager.activate_conda_env(env_name, return_cmd=True)
+        dump_environ = f"{shlex.quote(sys.executable)} -c \"import json, os; print(json.dumps(dict(os.environ)))\""
+        shell_kwargs = {}
+        if platform.system() == "Windows":
+            dump_environ = f'"{sys.executable}" -c "import json, os; print(json.dumps(dict(os.environ)))"'
+            cmd = f"{dump_environ} && call {act_env_str} && {dump_environ}"
+        else:
+            cmd = f"{dump_environ} && {act_env_str} && {dump_environ}"
+            shell_kwargs["executable"] = shutil.which("bash")  # conda.sh is sourced with `source`
+        rc, text = CommonPSCommands.run_command(
+            cmd, text=True, shell=True, verbose=False, collect_stripped_text=True, **shell_kwargs
+        )
+        all_environs = [json.loads(l) for l in text if l.startswith("{")]
+        assert (rc == 0) and (len(all_environs) == 2), f"Unable to activate {env_name!r} (rc={rc})"
+        before, after = all_environs
+        delta = {k: v for k, v in after.items() if before.get(k) != v}
+        delta.update({k: None for k in before if k not in after})
+        for shell_var in CondaActivationCache._shell_vars:
+            delta.pop(shell_var, None)
+        return delta
+
+    @staticmethod
+    def get_activation_delta(env_name: str, act_env_str: str = None) -> Dict[str, Union[str, None]]:
+        """
+        Returns the cached activation delta of env_name, capturing it if it's missing or conda-meta/history changed
+
+        :param env_name:
+        :type env_name: str
+        :param act_env_str:  (Default value = None)
+        :type act_env_str: str
+        :rtype: Dict[str, Union[str, None]]
+
+        """
+        with CondaActivationCache._lock:
+            cached = CondaActivationCache._deltas.get(env_name)
+        if cached is not None:
+            history_stamp, delta = cached
+            if CondaActivationCache.get_history_stamp(delta.get("CONDA_PREFIX")) == history_stamp:
+                return delta
+        delta = CondaActivationCache.capture_activation_delta(env_name, act_env_str=act_env_str)
+        history_stamp = CondaActivationCache.get_history_stamp(delta.get("CONDA_PREFIX"))
+        with CondaActivationCache._lock:
+            CondaActivationCache._deltas[env_name] = (history_stamp, delta)
+        return delta
+
+    @staticmethod
+    def get_activated_environ(env_name: str, act_env_str: str = None) -> Dict[str, str]:
+        """
+        Returns a copy of os.environ as it would look after activating env_name
+
+        :param env_name:
+        :type env_name: str
+        :param act_env_str:  (Default value = None)
+        :type act_env_str: str
+        :rtype: Dict[str, str]
+
+        """
+        delta = CondaActivationCache.get_activation_delta(env_name, act_env_str=act_env_str)
+        env = dict(os.environ)
+        for k, v in delta.items():
+            if v is None:
+                env.pop(k, None)
+            else:
+                env[k] = v
+        return env
+
+    @staticmethod
+    def invalidate(env_name: str = None):
+        """
+        Forgets the delta of env_name, or of every env if env_name is None
+
+        :param env_name:  (Default value = None)
+        :type env_name: str
+
+        """
+        with CondaActivationCache._lock:
+            if env_name is None:
+                CondaActivationCache._deltas.clear()
+            else:
+                CondaActivationCache._deltas.pop(env_name, None)
+
+
+class AsyncCommonPSCommands:
+    """
+    asyncio twins of CommonPSCommands.run_command and CommonPSCommands.chain_and_execute_commands.
+
+    Every command holds a slot of a per event loop semaphore while it runs, so many projects can be driven from one
+    event loop without starting more than max_concurrency external tools at once.
+    """
+
+    max_concurrency: int = 8
+    _semaphores = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def set_max_concurrency(max_concurrency: int):
+        """
+        Sets how many commands may run at the same time in one event loop
+
+        :param max_concurrency:
+        :type max_concurrency: int
+
+        """
+        assert max_concurrency > 0
+        AsyncCommonPSCommands.max_concurrency = max_concurrency
+        AsyncCommonPSCommands._semaphores = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def get_semaphore() -> asyncio.Semaphore:
+        """ """
+        loop = asyncio.get_running_loop()
+        semaphore = AsyncCommonPSCommands._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(AsyncCommonPSCommands.max_concurrency)
+            AsyncCommonPSCommands._semaphores[loop] = semaphore
+        return semaphore
+
+    @staticmethod
+    def get_exec_args(cmd_args: Union[List[str], str], shell: bool = False) -> List[str]:
+        """
+        Turns cmd_args into an argv list for asyncio.create_subprocess_exec; shell commands are run through the
+        same shell that subprocess.Popen(shell=True) would use
+
+        :param cmd_args:
+        :type cmd_args: Union[List[str], str]
+        :param shell:  (Default value = False)
+        :type shell: bool
+        :rtype: List[str]
+
+        """
+        if shell:
+            if not isinstance(cmd_args, str):
+                cmd_args = " ".join(cmd_args)
+            if platform.system() == "Windows":
+                return [os.environ.get("COMSPEC", "cmd.exe"), "/c", cmd_args]
+            return ["/bin/sh", "-c", cmd_args]
+        if isinstance(cmd_args, str):
+            return shlex.split(cmd_args)
+        return list(cmd_args)
+
+    @staticmethod
+    async def pump_stream(reader: asyncio.StreamReader, stream: str, sinks: List[OutputSink]) -> int:
+        """
+        Hands every line of reader to sinks and returns the number of bytes read
+
+        :param reader:
+        :param stream: "stdout" or "stderr"
+        :param sinks:
+        :rtype: int
+
+        """
+        n_bytes = 0
+        while True:
+            try:
+                raw_line = await reader.readline()
+            except ValueError:  # line is longer than the stream limit
+                raw_line = await reader.read(2 ** 16)
+            if not raw_line:
+                return n_bytes
+            n_bytes += len(raw_line)
+            CommonPSCommands.dispatch_line(sinks, stream, raw_line)
+
+    @staticmethod
+    async def stream_command(
+            cmd_args: Union[List[str], str],
+            sinks: List[OutputSink] = None,
+            shell: bool = False,
+            input_data: Union[bytes, str] = None,
+            **kwargs
+    ) -> CommandResult:
+        """
+        Runs a command with asyncio.create_subprocess_exec and streams stdout and stderr to sinks
+
+        :param cmd_args:
+        :type cmd_args: Union[List[str], str]
+        :param sinks:  (Default value = None)
+        :type sinks: List[OutputSink]
+        :param shell:  (Default value = False)
+        :type shell: bool
+        :param input_data: data written to stdin of the child process  (Default value = None)
+        :type input_data: Union[bytes, str]
+        :param **kwargs: passed to asyncio.create_subprocess_exec (i.e. cwd, env)
+        :rtype: CommandResult
+
+        """
+        sinks = list(sinks or [])
+        for text_kwarg in ("text", "universal_newlines", "encoding", "errors", "stdin", "stdout", "stderr"):
+            kwargs.pop(text_kwarg, None)
+        if isinstance(input_data, str):
+            input_data = input_data.encode()
+        exec_args = AsyncCommonPSCommands.get_exec_args(cmd_args, shell=shell)
+        async with AsyncCommonPSCommands.get_semaphore():
+            start = time.perf_counter()
+            p = await asyncio.create_subprocess_exec(
+                *exec_args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                **kwargs
+            )
+            try:
+                if input_data:
+                    p.stdin.write(input_data)
+                    await p.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                p.stdin.close()
+            try:
+                stdout_bytes, stderr_bytes = await asyncio.gather(
+                    AsyncCommonPSCommands.pump_stream(p.stdout, "stdout", sinks),
+                    AsyncCommonPSCommands.pump_stream(p.stderr, "stderr", sinks),
+                )
+                rc = await p.wait()
+            finally:
+                for sink in sinks:
+                    sink.close()
+            duration = time.perf_counter() - start
+        return CommandResult(rc, duration, stdout_bytes, stderr_bytes, cmd_args)
+
+    @staticmethod
+    async def run_command(
+            cmd_args: Union[List[str], str],
+            collect_stripped_text: bool = False,
+            verbose: bool = True,
+            sinks: List[OutputSink] = None,
+            return_result: bool = False,
+            **kwargs
+    ) -> Union[int, CommandResult]:
+        """
+        async twin of CommonPSCommands.run_command
+
+        :param cmd_args:
+        :type cmd_args: Union[List[str], str]
+        :param collect_stripped_text:  (Default value = False)
+        :type collect_stripped_text: bool
+        :param verbose:  (Default value = True)
+        :type verbose: bool
+        :param sinks: extra sinks that receive the output  (Default value = None)
+        :type sinks: List[OutputSink]
+        :param return_result: return a CommandResult instead of the return code  (Default value = False)
+        :type return_result: bool
+        :param **kwargs: passed to AsyncCommonPSCommands.stream_command
+        :rtype: Union[int, CommandResult]
+
+        """
+        all_sinks, text_collected = CommonPSCommands.get_output_sinks(sinks, verbose, collect_stripped_text)
+        result = await AsyncCommonPSCommands.stream_command(cmd_args, sinks=all_sinks, **kwargs)
+        return CommonPSCommands.format_command_result(
+            result, text_collected, verbose, collect_stripped_text, return_result
+        )
+
+    @staticmethod
+    async def chain_and_execute_commands(cmds: List[str], **kwargs) -> int:
+        """
+        async twin of CommonPSCommands.chain_and_execute_commands
+
+        :param cmds:
+        :type cmds: List[str]
+        :param **kwargs:
+        :rtype: int
+
+        """
+        cmd = " && ".join(cmds)
+        kwargs["shell"] = True
+        rc = await AsyncCommonPSCommands.run_command(cmd, **kwargs)
+        return rc
+
+
+class AsyncCondaEnvManager:
+    """
+    asyncio twins of the CondaEnvManager workflows
+    """
+
+    @staticmethod
+    async def create_conda_env(env_name: str, python_version: str, **kwargs) -> int:
+        """
+
+
+        :param env_name:
+        :type env_name: str
+        :param python_version:
+        :type python_version: str
+        :param **kwargs:
+        :rtype: int
+
+        """
+        python_version_str = await asyncio.to_thread(CondaEnvManager.get_python_version_for_conda, python_version)
+        args = ["conda", "create", "-n", env_name, python_version_str]
+        rc = await AsyncCommonPSCommands.run_command(args, input_data="yes\n", **kwargs)
+        return rc
+
+    @staticmethod
+    async def init_prev_made_conda_env(env_name: str, **kwargs) -> int:
+        """
+
+
+        :param env_name:
+        :type env_name: str
+        :param **kwargs:
+        :rtype: int
+
+        """
+        act_env = await asyncio.to_thread(CondaEnvManager.activate_conda_env, env_name, True)
+        all_step_cmds = [
+            CondaEnvManager.reset_conda_channel_priority(act_env, return_cmd=True),
+            CondaEnvManager.upgrade_pip(act_env, return_cmd=True),
+            CondaEnvManager.install_ipykernel(act_env, return_cmd=True),
+            CondaEnvManager.add_conda_forge_priority(act_env, return_cmd=True),
+        ]
+        rc = 0
+        for step_cmds in all_step_cmds:
+            rc = await AsyncCommonPSCommands.chain_and_execute_commands(step_cmds, **kwargs)
+            assert rc == 0
+        rc = await asyncio.to_thread(CondaEnvManager.register_kernel, env_name)
+        assert rc == 0
+        return rc
+
+    @staticmethod
+    async def create_and_init_conda_env(clean_env_name: str, python_version: str, **kwargs) -> None:
+        """
+
+
+        :param clean_env_name:
+        :type clean_env_name: str
+        :param python_version:
+        :type python_version: str
+        :param **kwargs:
+        :rtype: None
+
+        """
+        rc = await AsyncCondaEnvManager.create_conda_env(clean_env_name, python_version, **kwargs)
+        assert rc == 0
+        rc = await AsyncCondaEnvManager.init_prev_made_conda_env(clean_env_name, **kwargs)
+        assert rc == 0
+
+    @staticmethod
+    async def uninstall_kernel(kernel_name: str = "", **kwargs) -> int:
+        """
+
+
+        :param kernel_name:  (Default value = "")
+        :type kernel_name: str
+        :param **kwargs:
+        :rtype: int
+
+        """
+        kernel_cmd = ["jupyter", "kernelspec", "uninstall", kernel_name, "-y"]
+        rc = await AsyncCommonPSCommands.run_command(kernel_cmd, input_data="yes\n", **kwargs)
+        return rc
+
+    @staticmethod
+    async def uninstall_conda_env(conda_env_name: str = "", **kwargs) -> int:
+        """
+
+
+        :param conda_env_name:  (Default value = "")
+        :type conda_env_name: str
+        :param **kwargs:
+        :rtype: int
+
+        """
+        conda_cmd = ["conda", "env", "remove", "-n", conda_env_name]
+        rc = await AsyncCommonPSCommands.run_command(conda_cmd, **kwargs)
+        return rc
+
+    @staticmethod
+    async def uninstall_conda_and_kernel(conda_env_name: str = "", kernel_name: str = "", **kwargs):
+        """
+        async twin of CondaEnvManager.uninstall_conda_and_kernel, the kernel and the env are removed concurrently
+
+        :param conda_env_name:  (Default value = "")
+        :type conda_env_name: str
+        :param kernel_name:  (Default value = "")
+        :type kernel_name: str
+        :param **kwargs:
+
+        """
+        if (not conda_env_name) and (not kernel_name):
+            print("Please specify the env name and kernel name!")
+            return -1
+        if conda_env_name and (not kernel_name):
+            kernel_name = conda_env_name
+        if kernel_name and (not conda_env_name):
+            conda_env_name = kernel_name
+
+        rc1, rc2 = await asyncio.gather(
+            AsyncCondaEnvManager.uninstall_kernel(kernel_name, **kwargs),
+            AsyncCondaEnvManager.uninstall_conda_env(conda_env_name, **kwargs),
+        )
+        if rc1 == rc2:
+            return rc1
+        else:
+            return rc1, rc2
+
+
+class AsyncPoetryProjectManager:
+    """
+    asyncio twins of the PoetryProjectManager workflows
+    """
+
+    @staticmethod
+    async def execute_poetry_cmd(poetry_cmd: str, poetry_proj_dir: str, env_name: str, **kwargs) -> int:
+        """
+        Unlike PoetryProjectManager.execute_poetry_cmd this never changes the working directory of the process, so
+        many projects can run at the same time
+
+        :param poetry_cmd:
+        :type poetry_cmd: str
+        :param poetry_proj_dir:
+        :type poetry_proj_dir: str
+        :param env_name:
+        :type env_name: str
+        :param **kwargs:
+        :rtype: int
+
+        """
+        act_env_str = await asyncio.to_thread(CondaEnvManager.activate_conda_env, env_name, True)
+        kwargs["cwd"] = poetry_proj_dir
+        rc = await AsyncCommonPSCommands.chain_and_execute_commands([act_env_str, poetry_cmd], **kwargs)
+        return rc
+
+
 class SublimeBuildConfigGenerator:
     """ """
 